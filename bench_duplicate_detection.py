@@ -0,0 +1,151 @@
+"""
+Check the duplicate detection of f1 (see h_fingerprint_helpers).
+
+A set of short recordings is made along with a copy of each that f1 must find:
+an excerpt (half of the recording, around its loudest point, trimmed at both
+ends) and a re-encoding (at another sample rate,
+gained and with a little noise added). Long unrelated noise recordings are
+made too, and are kept first, so every short file is checked against them (a
+long recording holds most of the possible hashes somewhere, so it must not
+match a short file by chance). Exits with an error if a copy is missed or an
+unrelated file is matched.
+
+    python bench_duplicate_detection.py
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_fingerprint_helpers as fp
+import bench_make_synthetic_corpus as corpus
+# folder navigation modules
+import os
+import sys
+import tempfile
+# audio generation modules
+import numpy as np
+from math import gcd
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the seed of the random generator, the same seed gives the same recordings
+CHECK_SEED = 0
+# the number of short recordings (each with an excerpt and a re-encoded copy)
+NUM_ORIGINALS = 24
+# the range of the durations of the short recordings in seconds
+ORIGINAL_DURATION_S = (2.0, 8.0)
+# the durations of the long unrelated recordings in seconds
+LONG_NEGATIVE_DURATIONS_S = [60, 300, 900]
+# the sample rate of the long recordings
+LONG_NEGATIVE_SAMPLE_RATE = 16000
+# the sample rate the copies are re-encoded at
+REENCODE_SAMPLE_RATE = 22050
+# the number of threads fingerprinting the files
+NUM_THREADS = 4
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    # the check files are not added to the real file catalog
+    fdef.USE_FILE_CATALOG = False
+    with tempfile.TemporaryDirectory() as check_folder:
+        files, expected = make_check_files(check_folder, np.random.default_rng(CHECK_SEED))
+        fingerprints = fp.get_fingerprints(files, NUM_THREADS)
+        clusters = fp.find_duplicate_clusters(fingerprints)
+    found = {duplicate["path"]: cluster["kept"] for cluster in clusters for duplicate in cluster["duplicates"]}
+
+    missed = [copy for copy, original in expected.items() if found.get(copy) != original]
+    wrong = [(copy, kept) for copy, kept in found.items() if expected.get(copy) != kept]
+    print(f"Found {len(expected) - len(missed)}/{len(expected)} copies, "
+          f"{len(wrong)} wrong matches (against {len(LONG_NEGATIVE_DURATIONS_S)} long recordings "
+          f"of up to {max(LONG_NEGATIVE_DURATIONS_S)}s)")
+    for copy in missed:
+        print(f"    missed {os.path.basename(copy)}")
+    for copy, kept in wrong:
+        print(f"    wrongly matched {os.path.basename(copy)} to {os.path.basename(kept)}")
+    if missed or wrong:
+        sys.exit(1)
+
+
+
+"""
+make the recordings of the check in the given folder, the long recordings first
+
+    check_folder: the folder to make the recordings in
+    rng: the numpy random Generator
+
+    returns: (the paths of all the recordings in order,
+              a dict of the path of each copy -> the path of its original)
+"""
+def make_check_files(check_folder, rng):
+    from scipy.signal import resample_poly
+    files = []
+    for number, duration_s in enumerate(LONG_NEGATIVE_DURATIONS_S):
+        file = os.path.join(check_folder, f"long_negative_{number:02}.wav")
+        write_long_noise(rng, file, duration_s)
+        files.append(file)
+
+    expected = {}
+    copies = []
+    for number in range(NUM_ORIGINALS):
+        original = corpus.write_random_file(rng, os.path.join(check_folder, f"original_{number:02}.wav"),
+                                            ORIGINAL_DURATION_S, scratch=bool(number % 2), channels=1)
+        files.append(original)
+        samples, sample_rate = fh.load_wav_samples(original)
+        samples = samples[:, 0].astype(np.float32)
+
+        # half of the recording around its loudest point (the rest of it may
+        # only be the noise floor), trimmed off the spectrogram frame grid
+        excerpt = os.path.join(check_folder, f"excerpt_{number:02}.wav")
+        loudest = int(np.argmax(np.abs(samples)))
+        start = min(max(loudest - len(samples) // 4, 0), len(samples) // 2) + int(rng.integers(1, 100))
+        fh.write_wav_pcm16(excerpt, to_pcm16(samples[start : start + len(samples) // 2]), sample_rate)
+        copies.append((excerpt, original))
+
+        reencoded = os.path.join(check_folder, f"reencoded_{number:02}.wav")
+        divisor = gcd(REENCODE_SAMPLE_RATE, sample_rate)
+        resampled = resample_poly(samples, REENCODE_SAMPLE_RATE // divisor, sample_rate // divisor)
+        resampled = resampled * rng.uniform(0.5, 1.5) + rng.normal(0, 30, len(resampled))
+        fh.write_wav_pcm16(reencoded, to_pcm16(resampled), REENCODE_SAMPLE_RATE)
+        copies.append((reencoded, original))
+
+    for copy, original in copies:
+        files.append(copy)
+        expected[copy] = original
+    return files, expected
+
+"""
+write a long recording of the noise floor (a block at a time)
+
+    rng: the numpy random Generator
+    file: the path to the new wav file
+    duration_s: the duration in seconds
+"""
+def write_long_noise(rng, file, duration_s):
+    level = rng.uniform(0.005, 0.05) * fdef.MAX_16BIT_AMP
+    block_frames = 60 * LONG_NEGATIVE_SAMPLE_RATE
+    num_frames = duration_s * LONG_NEGATIVE_SAMPLE_RATE
+    blocks = (to_pcm16(rng.standard_normal(min(block_frames, num_frames - start)) * level)
+              for start in range(0, num_frames, block_frames))
+    fh.write_wav_pcm16_blocks(file, blocks, 1, LONG_NEGATIVE_SAMPLE_RATE)
+
+"""
+round and clip the samples to 16 bit
+
+    returns: int16 array of the samples
+"""
+def to_pcm16(samples):
+    return np.clip(np.rint(samples), -fdef.MAX_16BIT_AMP, fdef.MAX_16BIT_AMP - 1).astype(np.int16)
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
@@ -0,0 +1,87 @@
+"""
+Check the startup cost of the cli and the stages.
+
+Each module is imported in a fresh interpreter and the import is timed.
+Importing a module must stay within IMPORT_TIME_BUDGET_S, and must not pull
+in any of HEAVY_MODULES (they should only be imported by the code paths that
+use them). Exits with an error if any module is over budget.
+
+    python bench_import_time.py
+"""
+# modules used for timing the imports
+import json
+import subprocess
+import sys
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the modules to import, in order
+MODULES_TO_CHECK = ["catscat", "f1_move_all_data_to_clean_folder", "f2_convert_to_mono_16kHz",
+                    "f3_normalise_amp", "f4_0_extract_1_2s_target_sound", "f4_1_extract_scratches",
+                    "f5_perturb_amp", "f6_extract_log_mel_features", "f2_to_f5_fused_pipeline",
+                    "f1_to_f5_pipelined"]
+# the modules that are slow to import, none of them should be imported
+# just by importing the cli or a stage
+HEAVY_MODULES = ["pydub", "librosa", "matplotlib", "scipy"]
+# the longest importing a module may take (in seconds)
+IMPORT_TIME_BUDGET_S = 1.0
+# the number of times each module is imported (the fastest is kept)
+NUM_REPEATS = 3
+# the code run in the fresh interpreter to time the import
+TIMING_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy_modules}))
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    failures = []
+    for module in MODULES_TO_CHECK:
+        seconds, heavy = time_import(module)
+        over_budget = seconds > IMPORT_TIME_BUDGET_S
+        print(f"{module:<36}{seconds * 1000:>8.1f} ms"
+              f"{'  OVER BUDGET' if over_budget else ''}"
+              f"{'  imports ' + ', '.join(heavy) if heavy else ''}")
+        if over_budget or heavy:
+            failures.append(module)
+
+    if failures:
+        print(f"\n{len(failures)} module(s) failed the import check "
+              f"(budget {IMPORT_TIME_BUDGET_S}s, no {', '.join(HEAVY_MODULES)})")
+        sys.exit(1)
+    print(f"\nAll modules import within {IMPORT_TIME_BUDGET_S}s")
+
+
+
+"""
+time importing the given module in a fresh interpreter
+
+    returns: (the fastest import time in seconds, the heavy modules it imported)
+"""
+def time_import(module):
+    code = TIMING_CODE.format(module=module, heavy_modules=HEAVY_MODULES)
+    timings = []
+    for _ in range(NUM_REPEATS):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True,
+                                text=True, check=True).stdout
+        timings.append(json.loads(output.strip().splitlines()[-1]))
+    return min(timing["seconds"] for timing in timings), timings[0]["heavy"]
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
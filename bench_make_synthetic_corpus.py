@@ -0,0 +1,173 @@
+"""
+Fabricate a synthetic corpus in the exact layout f1 expects, so the pipeline
+can be benchmarked without the private raw data folder.
+
+    {BENCH_RAW_DATA_FOLDER}/1_Kaggle/clean/Positive/Annoyance_Meow/*.wav
+    {BENCH_RAW_DATA_FOLDER}/1_Kaggle/clean/Negative/*.wav
+    {BENCH_RAW_DATA_FOLDER}/3_CHiME/clean/Negative/chunks/*.16kHz.wav (and *.48kHz.wav)
+
+The files have mixed sample rates, channel counts and durations. Each positive
+file holds one or more loud events (a harmonic "meow" or a noise burst
+"scratch") over a quiet noise floor, so every stage has real work to do.
+The corpus is the same for the same CORPUS_SEED.
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+# folder navigation modules
+import os
+import shutil
+# audio generation modules
+import numpy as np
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# path to the synthetic raw data folder
+DEST_FOLDER = fdef.BENCH_RAW_DATA_FOLDER
+# the seed of the random generator, the same seed gives the same corpus
+CORPUS_SEED = 0
+#---------------------------------------#
+
+#---------------------------------------#
+# CORPUS OPTIONS
+#---------------------------------------#
+# the sources with positive (and some negative) recordings
+POSITIVE_SOURCES = ["1_Kaggle", "2_Freesound"]
+# the sources with only negative recordings, in the CHiME layout
+# (each chunk as both a 16kHz and a 48kHz file)
+CHIME_SOURCES = ["3_CHiME"]
+# the positive sub categories, the scratches are handled by f4_1
+POSITIVE_SUB_CATEGORIES = ["Annoyance_Meow", "Hunger_Meow", "Hiss", "Purr",
+                           "Soft_Scratch", "Hard_Scratch", "Board_Scratch", "Pole_Scratch"]
+# the number of files in each positive sub category of each source
+FILES_PER_SUB_CATEGORY = 8
+# the number of negative files of each source
+NEGATIVE_FILES_PER_SOURCE = 8
+# the sample rates and channel counts the files are drawn from
+SAMPLE_RATES = [44100, 48000, 22050, 16000, 8000]
+CHANNEL_COUNTS = [1, 2]
+# the range of the file durations in seconds
+POSITIVE_DURATION_S = (0.5, 6.0)
+NEGATIVE_DURATION_S = (5.0, 30.0)
+# the range of the number of loud events in each positive file
+EVENTS_PER_FILE = (1, 3)
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    make_corpus(DEST_FOLDER, CORPUS_SEED)
+
+
+
+"""
+make the synthetic corpus in the given folder, replacing any existing corpus
+
+    dest_folder: the folder to make the corpus in (laid out as the raw data folder)
+    seed: the seed of the random generator
+
+    returns: a dict of the number of files and bytes written
+"""
+def make_corpus(dest_folder, seed=CORPUS_SEED):
+    if os.path.exists(dest_folder):
+        shutil.rmtree(dest_folder)
+    rng = np.random.default_rng(seed)
+
+    files = []
+    for source in POSITIVE_SOURCES:
+        clean_folder = os.path.join(dest_folder, source, fdef.CLEAN_DATA_LOCATION)
+        for sub_category in POSITIVE_SUB_CATEGORIES:
+            scratch = sub_category.endswith("Scratch")
+            for file_num in range(FILES_PER_SUB_CATEGORY):
+                file = os.path.join(clean_folder, "Positive", sub_category, f"{sub_category}_{file_num:04}.wav")
+                files.append(write_random_file(rng, file, POSITIVE_DURATION_S, scratch=scratch))
+        for file_num in range(NEGATIVE_FILES_PER_SOURCE):
+            file = os.path.join(clean_folder, "Negative", f"background_{file_num:04}.wav")
+            files.append(write_random_file(rng, file, NEGATIVE_DURATION_S, num_events=0))
+
+    for source in CHIME_SOURCES:
+        chunk_folder = os.path.join(dest_folder, source, fdef.CLEAN_DATA_LOCATION, "Negative", "chunks")
+        for file_num in range(NEGATIVE_FILES_PER_SOURCE):
+            chunk_name = f"CR_lounge_{file_num:06}.s0_chunk{file_num % 10}"
+            # the same chunk at both rates, f1 skips the 48kHz copy
+            chunk_rng = np.random.default_rng(rng.integers(2 ** 32))
+            files.append(write_random_file(chunk_rng, os.path.join(chunk_folder, f"{chunk_name}.16kHz.wav"),
+                                           (4.0, 4.0), num_events=0, sample_rate=16000, channels=1))
+            chunk_rng = np.random.default_rng(rng.integers(2 ** 32))
+            files.append(write_random_file(chunk_rng, os.path.join(chunk_folder, f"{chunk_name}.48kHz.wav"),
+                                           (4.0, 4.0), num_events=0, sample_rate=48000, channels=1))
+        # the non wav files of the CHiME dataset are skipped by f1
+        with open(os.path.join(chunk_folder, "chunks.csv"), 'w') as f:
+            f.write("chunk,annotation\n")
+
+    corpus_info = {"files": len(files), "bytes": sum(os.path.getsize(file) for file in files), "seed": seed}
+    print(f"Made {corpus_info['files']} files ({corpus_info['bytes'] / 1e6:.1f} MB) in {dest_folder}")
+    return corpus_info
+
+"""
+write a random recording to the given file
+
+    rng: the numpy random Generator
+    file: the path to the new wav file
+    duration_range_s: the (min, max) duration in seconds
+    num_events: the number of loud events, None for a random number
+    scratch: whether the events are noise bursts (scratches) rather than tones
+    sample_rate: the sample rate, None for a random one of SAMPLE_RATES
+    channels: the number of channels, None for a random one of CHANNEL_COUNTS
+
+    returns: the path to the file
+"""
+def write_random_file(rng, file, duration_range_s, num_events=None, scratch=False,
+                      sample_rate=None, channels=None):
+    if sample_rate is None:
+        sample_rate = int(rng.choice(SAMPLE_RATES))
+    if channels is None:
+        channels = int(rng.choice(CHANNEL_COUNTS))
+    if num_events is None:
+        num_events = int(rng.integers(EVENTS_PER_FILE[0], EVENTS_PER_FILE[1] + 1))
+    num_frames = int(rng.uniform(*duration_range_s) * sample_rate)
+
+    audio = make_random_audio(rng, num_frames, sample_rate, num_events, scratch)
+    # the channels differ slightly, as from a real stereo recording
+    audio = audio[:, np.newaxis] * rng.uniform(0.8, 1.0, size=channels)
+    samples = np.clip(np.rint(audio * fdef.MAX_16BIT_AMP), -fdef.MAX_16BIT_AMP, fdef.MAX_16BIT_AMP - 1)
+
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    fh.write_wav_pcm16(file, samples.astype(np.int16), sample_rate)
+    return file
+
+"""
+make a random mono recording: a quiet noise floor with some loud events
+
+    returns: float array of the audio (full scale is 1.0)
+"""
+def make_random_audio(rng, num_frames, sample_rate, num_events, scratch):
+    audio = rng.standard_normal(num_frames) * rng.uniform(0.005, 0.05)
+    for _ in range(num_events):
+        event_length = min(int(rng.uniform(0.1, 0.8) * sample_rate), num_frames)
+        event_start = int(rng.integers(0, num_frames - event_length + 1))
+
+        if scratch: # a broadband noise burst
+            event = rng.standard_normal(event_length) * 0.3
+        else: # a harmonic tone with a falling pitch
+            pitch = rng.uniform(300, 1200) * np.linspace(1.0, 0.7, event_length)
+            phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+            event = sum(np.sin(harmonic * phase) / harmonic for harmonic in (1, 2, 3))
+        event *= np.hanning(event_length) * rng.uniform(0.2, 0.9)
+        audio[event_start : event_start + event_length] += event
+
+    return audio
+
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
@@ -0,0 +1,217 @@
+"""
+Time each stage (f1 - f6) on the synthetic corpus and record the throughput.
+
+Each stage is run in a fresh process, reading the outputs of the stage before
+it from within the benchmark folder (the real data folders are never touched).
+For each stage the files/sec, MB/sec (of the stage inputs) and peak RSS (of
+the stage process and its workers) are recorded. The results of each run are
+written to BENCH_RESULTS_FOLDER as json, so runs can be compared over time.
+
+    python bench_make_synthetic_corpus.py
+    python bench_stage_throughput.py
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+# folder navigation modules
+import os
+import shutil
+import sys
+# modules used for timing the stages and recording the results
+import importlib
+import json
+import platform
+import resource
+import subprocess
+import time
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# path to the benchmark folder
+BENCH_FOLDER = fdef.BENCH_FOLDER
+# path to the synthetic raw data folder (the f1 source)
+BENCH_RAW_DATA_FOLDER = fdef.BENCH_RAW_DATA_FOLDER
+# path to the results folder
+BENCH_RESULTS_FOLDER = fdef.BENCH_RESULTS_FOLDER
+# the stages to time, in order
+STAGES_TO_RUN = ["f1", "f2", "f3", "f4_0", "f4_1", "f5", "f6"]
+# the module of each stage, and the folders it reads from and writes
+# to within the benchmark folder (the same layout as the real data)
+STAGE_MODULES = {"f1": "f1_move_all_data_to_clean_folder", "f2": "f2_convert_to_mono_16kHz",
+                 "f3": "f3_normalise_amp", "f4_0": "f4_0_extract_1_2s_target_sound",
+                 "f4_1": "f4_1_extract_scratches", "f5": "f5_perturb_amp",
+                 "f6": "f6_extract_log_mel_features"}
+STAGE_FOLDERS = {"f1": ("raw-data", "data"),
+                 "f2": ("data", "transformed-data/mono_16khz"),
+                 "f3": ("transformed-data/mono_16khz", "transformed-data/amp_normalised"),
+                 "f4_0": ("transformed-data/amp_normalised", "transformed-data/targeted_1-2s"),
+                 "f4_1": ("transformed-data/amp_normalised", "transformed-data/targeted_1-2s"),
+                 "f5": ("transformed-data/targeted_1-2s", "transformed-data/amp_perturbed"),
+                 "f6": ("transformed-data/amp_perturbed", "transformed-data/log_mel_features")}
+# the graph options of the stages, turned off while timing
+GRAPH_OPTIONS = ["SHOW_NORMALISED_GRAPHS", "SHOW_SHIFTED_GRAPHS", "SHOW_DIFF_AMP_GRAPHS"]
+#---------------------------------------#
+
+
+
+"""
+main function
+run with "--stage <stage> <result file>" to time a single stage
+(this is how each stage is run in its own process)
+"""
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--stage":
+        write_json(sys.argv[3], time_stage(sys.argv[2]))
+    else:
+        run_benchmark()
+
+
+
+"""
+time all of STAGES_TO_RUN on the synthetic corpus, each in a fresh process,
+and write the results to BENCH_RESULTS_FOLDER
+
+    returns: the path to the results file
+"""
+def run_benchmark():
+    if not os.path.isdir(BENCH_RAW_DATA_FOLDER):
+        raise FileNotFoundError(f"No synthetic corpus at {BENCH_RAW_DATA_FOLDER}, "
+                                f"run bench_make_synthetic_corpus.py first")
+    # start from empty outputs, so every stage does all of its work
+    for folder in ["data", "transformed-data"]:
+        shutil.rmtree(os.path.join(BENCH_FOLDER, folder), ignore_errors=True)
+
+    os.makedirs(BENCH_RESULTS_FOLDER, exist_ok=True)
+    run_time = time.strftime("%Y%m%d-%H%M%S")
+    stage_results = []
+    for stage in STAGES_TO_RUN:
+        print(f"Timing {stage}...")
+        stage_results.append(run_stage_process(stage))
+        print_stage_result(stage_results[-1])
+
+    results = {"run_time": run_time, "git_commit": get_git_commit(),
+               "python": platform.python_version(), "machine": platform.machine(),
+               "cpu_count": os.cpu_count(), "num_workers": fdef.NUM_WORKERS,
+               "stages": stage_results}
+    results_path = os.path.join(BENCH_RESULTS_FOLDER, f"bench_{run_time}.json")
+    write_json(results_path, results)
+    print(f"Results written to {results_path}")
+    return results_path
+
+"""
+time the given stage in a fresh process (so the peak RSS is its own)
+
+    returns: the dict of the stage results
+"""
+def run_stage_process(stage):
+    result_path = os.path.join(BENCH_RESULTS_FOLDER, f".{stage}_result.json")
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--stage", stage, result_path],
+                   check=True)
+    with open(result_path, 'r') as f:
+        result = json.load(f)
+    os.remove(result_path)
+    return result
+
+"""
+run the given stage on the benchmark folders (within this process) and time it
+
+    stage: the stage name, e.g. "f2"
+
+    returns: a dict of the files, bytes, seconds, files/sec, MB/sec and peak RSS
+"""
+def time_stage(stage):
+    source, dest = [os.path.join(BENCH_FOLDER, folder) for folder in STAGE_FOLDERS[stage]]
+    module = point_stage_at_bench_folders(stage, source, dest)
+
+    input_files = get_wav_files(source)
+    input_bytes = sum(os.path.getsize(file) for file in input_files)
+
+    start = time.perf_counter()
+    module.main()
+    seconds = time.perf_counter() - start
+    print()
+
+    output_files = get_wav_files(dest)
+    return {"stage": stage, "input_files": len(input_files), "input_bytes": input_bytes,
+            "output_files": len(output_files),
+            "output_bytes": sum(os.path.getsize(file) for file in output_files),
+            "seconds": seconds,
+            "files_per_sec": len(input_files) / seconds if seconds else None,
+            "mb_per_sec": input_bytes / 1e6 / seconds if seconds else None,
+            "peak_rss_mb": get_peak_rss_mb()}
+
+"""
+import the given stage and point its folders (and the manifests, file catalog
+and instrumentation records) at the benchmark folder, with the graphs turned off
+
+    returns: the stage module
+"""
+def point_stage_at_bench_folders(stage, source, dest):
+    fdef.MANIFEST_FOLDER = os.path.join(BENCH_FOLDER, "transformed-data", "manifests")
+    fdef.INSTRUMENTATION_FOLDER = os.path.join(BENCH_FOLDER, "transformed-data", "instrumentation")
+    fdef.CATALOG_PATH = os.path.join(BENCH_FOLDER, "transformed-data", "catalog.sqlite")
+    fdef.DUPLICATES_REPORT_PATH = os.path.join(BENCH_FOLDER, "transformed-data", "duplicates.json")
+    fdef.JOURNAL_FOLDER = os.path.join(BENCH_FOLDER, "transformed-data", "journals")
+    fdef.WORK_QUEUE_FOLDER = os.path.join(BENCH_FOLDER, "transformed-data", "work_queues")
+    module = importlib.import_module(STAGE_MODULES[stage])
+    module.SOURCE_FOLDER = source
+    module.DEST_FOLDER = dest
+    for option in GRAPH_OPTIONS:
+        if hasattr(module, option):
+            setattr(module, option, False)
+    return module
+
+"""
+find all the wav files within the given folder (including subfolders)
+"""
+def get_wav_files(folder):
+    return [file for file in fh.make_path_list(folder) if file.endswith(".wav")]
+
+"""
+find the peak resident memory of this process and of its (worker) child processes
+
+    returns: the larger of the two, in MB
+"""
+def get_peak_rss_mb():
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak_kb /= 1024
+    return peak_kb / 1024
+
+"""
+find the commit the benchmark is run on, None if not in a git repository
+"""
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+"""
+write the given results to a json file
+"""
+def write_json(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+
+"""
+print a one line summary of the stage results
+"""
+def print_stage_result(result):
+    print(f"{result['stage']}: {result['input_files']} files in {result['seconds']:.2f}s, "
+          f"{result['files_per_sec']:.1f} files/s, {result['mb_per_sec']:.1f} MB/s, "
+          f"peak RSS {result['peak_rss_mb']:.0f} MB")
+
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
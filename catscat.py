@@ -0,0 +1,177 @@
+"""
+A single entry point for running the stages.
+
+Each stage has its own subcommand, and "run" chains several stages in one
+process (so the interpreter and the shared helpers are only started once):
+
+    python catscat.py f2
+    python catscat.py run f2 f3 f4_0 f4_1 f5 f6
+    python catscat.py --workers 4 --full run f3 f4_0
+    python catscat.py --resume run f1 f2 f3 f4_0 f4_1 f5
+
+To spread the stages over several hosts sharing the data folders, run the
+stages with --distributed on one host and "worker" on each of the others:
+
+    python catscat.py --distributed run f2 f3 f4_0 f4_1 f5
+    python catscat.py worker
+
+The heavy audio and graphing modules are only imported by the stages when
+they are needed, so short incremental runs start quickly. The graphs are
+turned off unless --graphs is given.
+"""
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+import h_journal_helpers as jh
+import h_writer_helpers as wh
+import h_work_queue_helpers as qh
+# modules used for parsing the command line and loading the stages
+import argparse
+import importlib
+import time
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the module of each stage (only imported when the stage is run)
+STAGE_MODULES = {"f1": "f1_move_all_data_to_clean_folder", "f2": "f2_convert_to_mono_16kHz",
+                 "f3": "f3_normalise_amp", "f4_0": "f4_0_extract_1_2s_target_sound",
+                 "f4_1": "f4_1_extract_scratches", "f5": "f5_perturb_amp",
+                 "f6": "f6_extract_log_mel_features", "fused": "f2_to_f5_fused_pipeline",
+                 "pipelined": "f1_to_f5_pipelined"}
+# the description of each stage (for the help message)
+STAGE_DESCRIPTIONS = {"f1": "move all the raw data into the final data folder",
+                      "f2": "convert to mono & 16kHz",
+                      "f3": "normalise the amplitude",
+                      "f4_0": "extract the 1-2s target sound",
+                      "f4_1": "extract the scratches",
+                      "f5": "perturb the amplitude",
+                      "f6": "extract the log-mel features of the final clips",
+                      "fused": "run f2 -> f5 on each file in a single pass",
+                      "pipelined": "run f1 -> f5 with each file moving on as soon as it is ready"}
+# the graph options of the stages, turned off unless --graphs is given
+GRAPH_OPTIONS = ["SHOW_NORMALISED_GRAPHS", "SHOW_SHIFTED_GRAPHS", "SHOW_DIFF_AMP_GRAPHS"]
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    apply_options(args)
+    if args.command == "worker":
+        unknown_stages = [stage for stage in args.stages if stage not in STAGE_MODULES]
+        if unknown_stages:
+            parser.error(f"unknown stages: {', '.join(unknown_stages)}")
+        run_worker(args.stages or list(STAGE_MODULES), args)
+        return
+    stages = args.stages if args.command == "run" else [args.command]
+    run_stages(stages, args)
+
+
+
+"""
+make the command line parser, with a subcommand for each stage and "run"
+"""
+def make_parser():
+    parser = argparse.ArgumentParser(prog="catscat", description="Run the catscat data processing stages.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help=f"number of worker processes, 0 uses all the cores (default {fdef.NUM_WORKERS})")
+    parser.add_argument("--full", action="store_true",
+                        help="reprocess every file, not only those that changed since the last run")
+    parser.add_argument("--distributed", action="store_true",
+                        help="hand the files out through a shared work queue, for workers on other hosts")
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on from where a killed run of each stage stopped")
+    parser.add_argument("--clean", action="store_true",
+                        help="clean out the destination folder of each stage first")
+    parser.add_argument("--graphs", action="store_true",
+                        help="show the graphs of the stages")
+    parser.add_argument("--no-catalog", action="store_true",
+                        help="walk the folders rather than using the file catalog")
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for stage, description in STAGE_DESCRIPTIONS.items():
+        subparsers.add_parser(stage, help=description)
+    run_parser = subparsers.add_parser("run", help="run several stages one after the other")
+    run_parser.add_argument("stages", nargs="+", choices=list(STAGE_MODULES),
+                            help="the stages to run, in order")
+    worker_parser = subparsers.add_parser("worker", help="work on the queues of distributed stage runs")
+    # (not checked with choices, which rejects an empty list)
+    worker_parser.add_argument("stages", nargs="*", metavar="stage",
+                               help=f"the stages to work on, any of {', '.join(STAGE_MODULES)} (default all)")
+    return parser
+
+"""
+apply the global command line options to the definitions
+(before any stage is imported)
+"""
+def apply_options(args):
+    if args.workers is not None:
+        fdef.NUM_WORKERS = args.workers or None
+    if args.full:
+        fdef.INCREMENTAL_RUNS = False
+    if args.resume:
+        fdef.RESUME_RUNS = True
+    if args.distributed:
+        fdef.DISTRIBUTED_RUNS = True
+    if args.no_catalog:
+        fdef.USE_FILE_CATALOG = False
+
+"""
+import and run each of the given stages in turn
+
+    stages: the stage names, e.g. ["f2", "f3"]
+    args: the parsed command line arguments
+"""
+def run_stages(stages, args):
+    for stage in stages:
+        module = load_stage(stage, args)
+        print(f"Running {stage} ({STAGE_DESCRIPTIONS[stage]})...")
+        start = time.perf_counter()
+        module.main()
+        print(f"\n{stage} finished in {time.perf_counter() - start:.1f}s")
+
+"""
+work on the queues of the given stages (set up as they would be by this cli),
+until there are no queues left to work on
+
+    stages: the stage names, e.g. ["f2", "f3"]
+    args: the parsed command line arguments
+"""
+def run_worker(stages, args):
+    queue_names = []
+    for stage in stages:
+        module = load_stage(stage, args)
+        queue_names.append(getattr(module, "MANIFEST_NAME", stage))
+    qh.run_worker(queue_names)
+
+"""
+import the given stage and set its options from the command line
+
+    returns: the stage module
+"""
+def load_stage(stage, args):
+    module = importlib.import_module(STAGE_MODULES[stage])
+    for option in GRAPH_OPTIONS:
+        if hasattr(module, option):
+            setattr(module, option, args.graphs)
+    # a resumed stage was already cleaned out by the killed run,
+    # only the files it was part way through writing are removed
+    resuming = args.resume and jh.has_journal(getattr(module, "MANIFEST_NAME", stage))
+    if resuming and hasattr(module, "DEST_FOLDER"):
+        wh.remove_temp_files(module.DEST_FOLDER)
+    if args.clean and hasattr(module, "CLEAN_DEST") and not resuming:
+        module.CLEAN_DEST = True
+    return module
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
@@ -1,180 +1,391 @@
-# Internal helpers and definitions
-import h_folder_nav_helpers as fh
-import h_FOLDER_DEFINITIONS as fdef
-# folder navigation modules
-import shutil
-import os
-
-
-
-#---------------------------------------#
-# CONSTANT DEFINITIONS
-#---------------------------------------#
-# Path to the raw data
-SOURCE_FOLDER = fdef.RAW_DATA_FOLDER
-# Path to the final data
-DEST_FOLDER = fdef.FINAL_DATA_FOLDER
-# Location of the clean data folder
-CLEAN_DATA_LOCATION = fdef.CLEAN_DATA_LOCATION
-#---------------------------------------#
-
-#---------------------------------------#
-# GOBAL VARIABLE TRACKERS
-#---------------------------------------#
-# keep track of the number of files transfered
-pos_file_num = 1 # for positive files
-neg_file_num = 1 # for negative files
-file_num_counts = {} # fo the number of files in each category
-#---------------------------------------#
-
-
-
-# main function
-def main():
-    fh.clean_folder(DEST_FOLDER)
-    move_files_from_all_sources(SOURCE_FOLDER)
-
-
-
-"""
-Move files from the given folder to the final data folder.
-This function assumes that the files are in the correct format and have been cleaned. 
-
-    souce_folder: the data source we are looking at  e.g. "1_Kaggle"
-"""
-def move_files_from_folder(source_folder: str) -> None:
-    # go into the clean data folder
-    data_folder = os.path.join(SOURCE_FOLDER, source_folder)
-    clean_folder = os.path.join(data_folder, CLEAN_DATA_LOCATION)
-    try:
-        # for each catgory # i.e. postive or negative
-        for category in sorted(os.listdir(clean_folder)):
-            category_folder = os.path.join(clean_folder, category)
-            if not os.listdir(category_folder): 
-                continue
-
-            if category == "Positive":
-                # for each sub catagory, e.g. Meow Scratch
-                for sub_category in os.listdir(category_folder):
-                    sub_category_folder = os.path.join(category_folder, sub_category)
-
-                    # for each file
-                    for file in sorted(os.listdir(sub_category_folder)):
-                        file_path = os.path.join(sub_category_folder, file)
-                        # generate file name
-                        new_file_name = generate_audio_file_name(source_folder, sub_category)
-                        
-                        # find the final location
-                        final_location = os.path.join(DEST_FOLDER, f"{category}/{sub_category}/{new_file_name}")
-                        move_file_and_rename(file_path, final_location)
-
-            elif category == "Negative":
-                files = sorted(fh.make_path_list(category_folder))
-                # for every wav file in file tree of category_folder
-                for file_path in files:
-                    # if the file is not a wav, or is a 48kHz sample, skip it
-                    if not file_path.endswith('.wav') or is_48khz(file_path):
-                        continue
-                        
-                    # generate file name
-                    new_file_name = generate_audio_file_name(source_folder, category)
-
-                    # find the final location
-                    final_location = os.path.join(DEST_FOLDER, f"{category}/{category}/{new_file_name}")
-                    move_file_and_rename(file_path, final_location) # copy the file to the new location
-
-            else:
-                print(f"Category not found, skipping! Expected value in [\"Positive\", \"Negative\"], got {category}")
-
-    except Exception as e:
-        print(f'Folder cannot be scraped {clean_folder}: {e}')
-
-"""
-Generate a name for the current audio file.
-Format: "{num}.wav"
-
-Where num is equal to the number file in the given category
-i.e Audio file "7.wav" would be the 7th audio chunk collected form 
-the source in that specific subcategory.
-
-    source_folder: the data source we are looking at  e.g. "1_Kaggle"
-    category: the category of the file, e.g. "Annoyance_Meow"
-
-    returns: the new file name
-"""
-def generate_audio_file_name(source_folder: str, category: str) -> str:
-    # retrive the current running total of files processed
-    global pos_file_num
-    global neg_file_num
-    global file_num_counts
-
-    # convert to the standard format
-    category = category.lower().replace("_", "-")
-    # increment the respective count
-    if category == "negative":
-        neg_file_num += 1
-    else:
-        pos_file_num += 1
-    # grab the count for the current category
-    curr_file_num = file_num_counts.get(category, 1)
-
-    # = catagory_filenum_iteration__source
-    new_file_name = f"{category}_{curr_file_num:06}_{int((source_folder.split('_')[0])):03}.wav"
-    # increment the respective count
-    file_num_counts[category] = curr_file_num + 1
-    return new_file_name
-
-
-"""
-Filters for the 48kHz samples in the negative CHiME dataset (key num 3).
-It will return true if the file is a 48kHz sample (as defined by the 
-CHiME dataset documentation), false otherwise.
-
-    filepath: the path to the file we are checking
-
-    retuns: true if the file is a 48kHz sample, false otherwise
-"""
-def is_48khz(filepath: str) -> bool:
-    filename = os.path.basename(filepath)
-    name_without_extension = os.path.splitext(filename)[0]
-    return name_without_extension.split('.')[-1] == "48kHz"
-
-"""
-Move the file to the given location and inform the user of the move
-
-    source: the path to the file we are moving
-    destination: the path to the new location of the file
-"""
-def move_file_and_rename(source, destination) -> None:
-    global pos_file_num
-    global neg_file_num
-
-    # If the location doesnt exist, create it
-    dest_folder = os.path.dirname(destination)
-    if not os.path.exists(dest_folder):
-        os.makedirs(dest_folder)
-        print(f"Directory '{dest_folder}' created.")
-    # Copy the file
-    shutil.copy(source, destination)
-    # inform the user of the new file
-    print(f'Number of files tranfered: Positive: {pos_file_num}, Negative: {neg_file_num}', end='\r')
-
-"""
-Move files from all the sources in the given parent folder
-
-    source_containing_folder: the folder containing all the sources
-"""
-def move_files_from_all_sources(source_containing_folder) -> None:
-    print(f"Transfering...")
-    # for each source folder:
-    for source in sorted(os.listdir(source_containing_folder)):
-        move_files_from_folder(source)
-    print(f"Transfering finished")
-
-
-
-
-#---------------------------------------#
-main()
-#---------------------------------------#
-
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_catalog_helpers as ch
+import h_fingerprint_helpers as fp
+import h_journal_helpers as jh
+import h_manifest_helpers as mh
+# folder navigation modules
+import os
+import json
+# modules used for materialising the files in parallel
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# Path to the raw data
+SOURCE_FOLDER = fdef.RAW_DATA_FOLDER
+# Path to the final data
+DEST_FOLDER = fdef.FINAL_DATA_FOLDER
+# Location of the clean data folder
+CLEAN_DATA_LOCATION = fdef.CLEAN_DATA_LOCATION
+# the number of threads used to materialise the files
+NUM_INGEST_THREADS = 8
+# how the files are materialised in the final data folder
+# "hardlink": hardlink (or reflink) if on the same filesystem, otherwise copy
+# "reflink": copy-on-write clone if the filesystem supports it, otherwise copy
+# "copy": always make a full copy
+LINK_MODE = "hardlink"
+# whether to fingerprint the files to find the recordings that appear more
+# than once (across or within the sources), see h_fingerprint_helpers
+DETECT_DUPLICATES = True
+# whether to leave the duplicates out of the final data folder
+# (otherwise they are only reported, check the report before turning this on)
+SKIP_DUPLICATES = False
+# path to the report of the duplicate clusters
+DUPLICATES_REPORT_PATH = fdef.DUPLICATES_REPORT_PATH
+# the name of the run journal of this stage
+MANIFEST_NAME = "f1_final_data"
+#---------------------------------------#
+
+#---------------------------------------#
+# GOBAL VARIABLE TRACKERS
+#---------------------------------------#
+# keep track of the number of files transfered
+pos_file_num = 1 # for positive files
+neg_file_num = 1 # for negative files
+file_num_counts = {} # fo the number of files in each category
+#---------------------------------------#
+
+
+
+# main function
+def main():
+    journal, planned_moves = start_ingest()
+    move_planned_files(planned_moves, journal)
+    # the journal is kept (rather than finished), so resuming a run that was
+    # killed in a later stage does not redo the whole ingest
+    journal.commit()
+
+"""
+Open the run journal of this stage and get the plan of the moves. The plan of
+an earlier run is carried on with while the source files (and the duplicate
+options) are the same, when resuming or on an incremental run, so the files
+it already moved are not moved again. Otherwise (e.g. after a new data drop,
+or on a full run) the final data folder is cleaned and the files are planned
+again. Used by f1_to_f5_pipelined too.
+
+    returns: (the run journal, a list of (source path, final location) pairs)
+"""
+def start_ingest():
+    journal = jh.RunJournal(MANIFEST_NAME, resume=fdef.RESUME_RUNS or fdef.INCREMENTAL_RUNS)
+    found_files = find_files_in_all_sources(SOURCE_FOLDER)
+    sources_hash = mh.hash_params([hash_source_listing(found_files), DETECT_DUPLICATES, SKIP_DUPLICATES])
+    plan = journal.get_state("plan")
+    if plan is not None and plan.get("sources") != sources_hash:
+        print(f"The source files have changed since the journalled run, starting the ingest again")
+        plan = None
+
+    if plan is None:
+        journal = jh.RunJournal(MANIFEST_NAME, resume=False)
+        fh.clean_folder(DEST_FOLDER)
+        ch.remove_folder(DEST_FOLDER)
+        planned_moves = plan_found_files(found_files)
+        journal.record_state("plan", {"moves": planned_moves, "counters": get_name_counters(),
+                                      "sources": sources_hash})
+    else:
+        planned_moves = [tuple(move) for move in plan["moves"]]
+        set_name_counters(plan["counters"])
+        num_done = sum(is_move_done(move, journal) for move in planned_moves)
+        print(f"Carrying on with the journalled plan, {num_done}/{len(planned_moves)} files already moved")
+    return journal, planned_moves
+
+"""
+check if the given planned move was made by an earlier run (and its file is still there)
+
+    move: the (source path, final location) pair
+    journal: the run journal of this stage
+"""
+def is_move_done(move, journal) -> bool:
+    return journal.get_completed(move[0]) is not None and os.path.exists(move[1])
+
+
+
+"""
+Find the files to move from the given folder to the final data folder,
+in a deterministic order. The files are not named yet.
+This function assumes that the files are in the correct format and have been cleaned. 
+
+    souce_folder: the data source we are looking at  e.g. "1_Kaggle"
+
+    returns: a list of (source path, source folder, category, sub category) of each file,
+             the file will be moved to "{category}/{sub category}/" in the final data folder
+"""
+def find_files_in_folder(source_folder: str) -> list:
+    found_files = []
+    # go into the clean data folder
+    data_folder = os.path.join(SOURCE_FOLDER, source_folder)
+    clean_folder = os.path.join(data_folder, CLEAN_DATA_LOCATION)
+    try:
+        # for each catgory # i.e. postive or negative
+        for category in sorted(os.listdir(clean_folder)):
+            category_folder = os.path.join(clean_folder, category)
+            if not os.listdir(category_folder): 
+                continue
+
+            if category == "Positive":
+                # for each sub catagory, e.g. Meow Scratch
+                for sub_category in sorted(os.listdir(category_folder)):
+                    sub_category_folder = os.path.join(category_folder, sub_category)
+
+                    # for each file
+                    for file in sorted(os.listdir(sub_category_folder)):
+                        file_path = os.path.join(sub_category_folder, file)
+                        found_files.append((file_path, source_folder, category, sub_category))
+
+            elif category == "Negative":
+                files = sorted(fh.make_path_list(category_folder))
+                # for every wav file in file tree of category_folder
+                for file_path in files:
+                    # if the file is not a wav, or is a 48kHz sample, skip it
+                    if not file_path.endswith('.wav') or is_48khz(file_path):
+                        continue
+                    found_files.append((file_path, source_folder, category, category))
+
+            else:
+                print(f"Category not found, skipping! Expected value in [\"Positive\", \"Negative\"], got {category}")
+
+    except Exception as e:
+        print(f'Folder cannot be scraped {clean_folder}: {e}')
+
+    return found_files
+
+"""
+Generate a name for the current audio file.
+Format: "{num}.wav"
+
+Where num is equal to the number file in the given category
+i.e Audio file "7.wav" would be the 7th audio chunk collected form 
+the source in that specific subcategory.
+
+    source_folder: the data source we are looking at  e.g. "1_Kaggle"
+    category: the category of the file, e.g. "Annoyance_Meow"
+
+    returns: the new file name
+"""
+def generate_audio_file_name(source_folder: str, category: str) -> str:
+    # retrive the current running total of files processed
+    global pos_file_num
+    global neg_file_num
+    global file_num_counts
+
+    # convert to the standard format
+    category = category.lower().replace("_", "-")
+    # increment the respective count
+    if category == "negative":
+        neg_file_num += 1
+    else:
+        pos_file_num += 1
+    # grab the count for the current category
+    curr_file_num = file_num_counts.get(category, 1)
+
+    # = catagory_filenum_iteration__source
+    new_file_name = f"{category}_{curr_file_num:06}_{int((source_folder.split('_')[0])):03}.wav"
+    # increment the respective count
+    file_num_counts[category] = curr_file_num + 1
+    return new_file_name
+
+"""
+get the running totals used to name the files (to store in the run journal)
+"""
+def get_name_counters() -> dict:
+    return {"pos_file_num": pos_file_num, "neg_file_num": neg_file_num,
+            "file_num_counts": dict(file_num_counts)}
+
+"""
+restore the running totals used to name the files (from the run journal)
+"""
+def set_name_counters(counters: dict) -> None:
+    global pos_file_num
+    global neg_file_num
+    global file_num_counts
+    pos_file_num = counters["pos_file_num"]
+    neg_file_num = counters["neg_file_num"]
+    file_num_counts = dict(counters["file_num_counts"])
+
+
+"""
+Filters for the 48kHz samples in the negative CHiME dataset (key num 3).
+It will return true if the file is a 48kHz sample (as defined by the 
+CHiME dataset documentation), false otherwise.
+
+    filepath: the path to the file we are checking
+
+    retuns: true if the file is a 48kHz sample, false otherwise
+"""
+def is_48khz(filepath: str) -> bool:
+    filename = os.path.basename(filepath)
+    name_without_extension = os.path.splitext(filename)[0]
+    return name_without_extension.split('.')[-1] == "48kHz"
+
+"""
+Find the files to move from all the sources in the given parent folder,
+in a deterministic order (see find_files_in_folder)
+
+    source_containing_folder: the folder containing all the sources
+
+    returns: a list of (source path, source folder, category, sub category) of each file
+"""
+def find_files_in_all_sources(source_containing_folder) -> list:
+    found_files = []
+    # for each source folder:
+    for source in sorted(os.listdir(source_containing_folder)):
+        found_files.extend(find_files_in_folder(source))
+    return found_files
+
+"""
+find the hash of the listing of the found files (their paths, sizes and
+modification times), which changes when a source file is added, removed or changed
+
+    returns: the hex digest of the listing
+"""
+def hash_source_listing(found_files: list) -> str:
+    listing = []
+    for found_file in found_files:
+        stat = os.stat(found_file[0])
+        listing.append([found_file[0], stat.st_size, stat.st_mtime_ns])
+    return mh.hash_params(listing)
+
+"""
+Plan the moves of the files from all the sources in the given parent folder,
+leaving out the duplicate recordings and then naming each file in a
+deterministic order. Nothing is copied yet.
+
+    source_containing_folder: the folder containing all the sources
+
+    returns: a list of (source path, final location) pairs
+"""
+def plan_files_from_all_sources(source_containing_folder) -> list:
+    return plan_found_files(find_files_in_all_sources(source_containing_folder))
+
+"""
+Plan the moves of the given found files, see plan_files_from_all_sources
+
+    found_files: a list of (source path, source folder, category, sub category)
+
+    returns: a list of (source path, final location) pairs
+"""
+def plan_found_files(found_files: list) -> list:
+    # duplicates are removed before naming, so the names stay contiguous
+    if DETECT_DUPLICATES:
+        found_files = remove_duplicate_files(found_files)
+
+    planned_moves = []
+    for file_path, source_folder, category, sub_category in found_files:
+        # generate file name
+        new_file_name = generate_audio_file_name(source_folder, sub_category)
+        # find the final location
+        final_location = os.path.join(DEST_FOLDER, f"{category}/{sub_category}/{new_file_name}")
+        planned_moves.append((file_path, final_location))
+    return planned_moves
+
+"""
+Fingerprint the found files and find the clusters of duplicate recordings,
+the first file of each cluster (in source order) is kept. The files of each
+category are clustered on their own, so a positive file is never left out
+as a duplicate of a negative one (or the other way round). The clusters are
+written to DUPLICATES_REPORT_PATH.
+
+    found_files: a list of (source path, source folder, category, sub category)
+
+    returns: the found files without the duplicates (all of them if SKIP_DUPLICATES is off)
+"""
+def remove_duplicate_files(found_files: list) -> list:
+    print(f"Fingerprinting {len(found_files)} files...")
+    fingerprints = fp.get_fingerprints([found_file[0] for found_file in found_files], NUM_INGEST_THREADS)
+    fingerprints_by_category = {}
+    for found_file, fingerprint in zip(found_files, fingerprints):
+        if fingerprint is not None:
+            fingerprints_by_category.setdefault(found_file[2], []).append(fingerprint)
+    clusters = [cluster for category_fingerprints in fingerprints_by_category.values()
+                for cluster in fp.find_duplicate_clusters(category_fingerprints)]
+    duplicates = {duplicate["path"] for cluster in clusters for duplicate in cluster["duplicates"]}
+
+    num_exact = sum(duplicate["exact"] for cluster in clusters for duplicate in cluster["duplicates"])
+    print(f"Found {len(duplicates)} duplicate files ({num_exact} exact) in {len(clusters)} clusters")
+    os.makedirs(os.path.dirname(DUPLICATES_REPORT_PATH), exist_ok=True)
+    with open(DUPLICATES_REPORT_PATH, 'w') as f:
+        json.dump({"num_files": len(found_files), "num_duplicates": len(duplicates),
+                   "skipped": SKIP_DUPLICATES, "clusters": clusters}, f, indent=1)
+    print(f"Duplicate clusters written to {DUPLICATES_REPORT_PATH}")
+
+    if not SKIP_DUPLICATES:
+        return found_files
+    return [found_file for found_file in found_files if found_file[0] not in duplicates]
+
+"""
+Materialise the planned files in the final data folder, spread over
+the ingest threads, and inform the user of the progress.
+Each file is recorded in the run journal and added to the file catalog
+as it is materialised, the files already materialised by a killed run are skipped.
+
+    planned_moves: a list of (source path, final location) pairs
+    journal: the run journal of this stage
+"""
+def materialise_files(planned_moves, journal) -> None:
+    # create all the needed directories up front
+    for dest_folder in sorted({os.path.dirname(destination) for _, destination in planned_moves}):
+        if not os.path.exists(dest_folder):
+            os.makedirs(dest_folder)
+            print(f"Directory '{dest_folder}' created.")
+
+    moves_to_make = [move for move in planned_moves if not is_move_done(move, journal)]
+    files_transfered = len(planned_moves) - len(moves_to_make)
+    catalog_entries = []
+    if fdef.USE_FILE_CATALOG:
+        to_make = set(moves_to_make)
+        catalog_entries = [ch.make_file_entry(destination, parent=source)
+                           for source, destination in planned_moves if (source, destination) not in to_make]
+    with ThreadPoolExecutor(max_workers=NUM_INGEST_THREADS) as executor:
+        for move, catalog_entry in zip(moves_to_make, executor.map(materialise_file, moves_to_make)):
+            journal.record_file(move[0], {"outputs": [move[1]]})
+            catalog_entries.append(catalog_entry)
+            files_transfered += 1
+            # inform the user of the new file
+            print(f'Number of files tranfered: {files_transfered}/{len(planned_moves)}', end='\r')
+
+    if fdef.USE_FILE_CATALOG:
+        ch.add_entries(catalog_entries)
+
+"""
+Materialise a single planned file and make its catalog entry
+(the header is read here, once, so no later stage has to walk for it)
+
+    move: the (source path, final location) pair
+
+    returns: the catalog entry of the new file
+"""
+def materialise_file(move):
+    source, destination = move
+    fh.link_or_copy_file(source, destination, LINK_MODE)
+    if fdef.USE_FILE_CATALOG:
+        return ch.make_file_entry(destination, parent=source)
+    return None
+
+"""
+Move the planned files from all the sources (see start_ingest).
+All the files have already been named (in a fixed order), they are materialised
+in parallel. The plan and the naming counters are kept in the run journal (along
+with the hash of the source listing it was made from), so a later run moves the
+rest of the files under the same names.
+
+    planned_moves: a list of (source path, final location) pairs
+    journal: the run journal of this stage
+"""
+def move_planned_files(planned_moves, journal) -> None:
+    print(f"Transfering...")
+    print(f'Files to transfer: Positive: {pos_file_num - 1}, Negative: {neg_file_num - 1}')
+    materialise_files(planned_moves, journal)
+    print(f"Transfering finished")
+
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
+
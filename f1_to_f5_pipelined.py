@@ -0,0 +1,189 @@
+"""
+Run f1 -> f2 -> f3 -> {f4_0, f4_1} -> f5 as a pipeline of per-file tasks.
+
+Rather than each stage finishing the whole corpus before the next one starts,
+each file moves on to its next stage as soon as its output is written, so the
+cpu heavy stages (e.g. f2) overlap with the i/o heavy ones (e.g. f1 and f5).
+Each stage has its own number of worker processes (STAGE_WORKERS), and the
+normalised files are routed to f4_0 or f4_1 by their category (as the f4_0
+IGNORE_CATEGORIES and f4_1 CATEGORIES_TO_PROCESS split them).
+
+The outputs, manifests and catalog entries are the same as running each
+stage one after the other, see h_pipeline_helpers for the scheduler.
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+import h_writer_helpers as wh
+import h_pipeline_helpers as hp
+# the individual stages
+import f1_move_all_data_to_clean_folder as f1
+import f2_convert_to_mono_16kHz as f2
+import f3_normalise_amp as f3
+import f4_0_extract_1_2s_target_sound as f4_0
+import f4_1_extract_scratches as f4_1
+import f5_perturb_amp as f5
+# folder navigation modules
+import os
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS                  #
+#---------------------------------------#
+# whether to start with the ingest (f1) of the raw data,
+# otherwise the files already in the final data folder are the inputs
+INCLUDE_INGEST = True
+# the number of worker processes of each stage
+STAGE_WORKERS = {"f1": 2, "f2": 2, "f3": 1, "f4_0": 1, "f4_1": 1, "f5": 2}
+# the max number of files waiting for each stage
+STAGE_QUEUE_SIZE = hp.STAGE_QUEUE_SIZE
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    manifests = {stage: StageManifest(module) for stage, module
+                 in [("f2", f2), ("f3", f3), ("f4_0", f4_0), ("f4_1", f4_1), ("f5", f5)]}
+    catalog_entries = []
+    # a killed run leaves behind the files it was part way through writing
+    # (the files it finished are kept, and are skipped by the manifests)
+    for dest_folder in sorted({module.DEST_FOLDER for module in [f1, f2, f3, f4_0, f4_1, f5]}):
+        wh.remove_temp_files(dest_folder)
+
+    ingest_journal = None
+    if INCLUDE_INGEST:
+        # f1 names every file up front (in a fixed order), or carries on with the
+        # plan of its run journal, then each file still to move is moved as a task
+        ingest_journal, planned_moves = f1.start_ingest()
+        inputs = [("f1", move) for move in planned_moves]
+    else:
+        inputs = [("f2", file) for file in ch.list_files(f2.SOURCE_FOLDER)]
+
+    # the files of f1 are catalogued as they are moved (or found already moved)
+    def add_catalog_entry(move, destination):
+        if fdef.USE_FILE_CATALOG:
+            catalog_entries.append(ch.make_file_entry(destination, parent=move[0]))
+
+    # the files moved by an earlier run are passed straight on to f2
+    def skip_ingested_file(move):
+        if not f1.is_move_done(move, ingest_journal):
+            return None
+        add_catalog_entry(move, move[1])
+        return [move[1]]
+
+    def record_ingested_file(move, destination):
+        ingest_journal.record_file(move[0], {"outputs": [destination]})
+        add_catalog_entry(move, destination)
+
+    stages = [hp.PipelineStage("f1", ingest_file, STAGE_WORKERS["f1"], ["f2"],
+                               skip=skip_ingested_file, on_result=record_ingested_file)]
+    for stage, job, next_stages, route in [
+            ("f2", f2.convert_audio_file_mono_16khz, ["f3"], None),
+            ("f3", f3.normalise_amp_of_file, ["f4_0", "f4_1"], route_normalised_file),
+            ("f4_0", f4_0.locate_export_target_section, ["f5"], route_targeted_file),
+            ("f4_1", f4_1.extract_target_file, ["f5"], route_targeted_file),
+            ("f5", f5.perturb_amp_of_file, [], None)]:
+        stages.append(hp.PipelineStage(stage, job, STAGE_WORKERS[stage], next_stages, route,
+                                       skip=manifests[stage].skip, on_result=manifests[stage].record))
+
+    hp.run_pipeline(stages, inputs, STAGE_QUEUE_SIZE)
+
+    # the journal of f1 is kept, as by f1 itself (see f1.main)
+    if ingest_journal is not None:
+        ingest_journal.commit()
+    if catalog_entries:
+        ch.add_entries(catalog_entries)
+    for manifest in manifests.values():
+        manifest.save()
+
+
+
+"""
+move a single planned file of f1 into the final data folder
+
+    move: the (source path, final location) pair
+
+    returns: the final location
+"""
+def ingest_file(move):
+    wh.make_folder(os.path.dirname(move[1]))
+    fh.link_or_copy_file(move[0], move[1], f1.LINK_MODE)
+    return move[1]
+
+"""
+find the stage(s) a normalised file goes to, by its category
+"""
+def route_normalised_file(file):
+    category = fh.get_category(file)
+    next_stages = []
+    if category not in f4_0.IGNORE_CATEGORIES:
+        next_stages.append("f4_0")
+    if category in f4_1.CATEGORIES_TO_PROCESS:
+        next_stages.append("f4_1")
+    return next_stages
+
+"""
+find the stage(s) a targeted file goes to, by its category
+"""
+def route_targeted_file(file):
+    if f5.CATEGORIES_TO_PROCESS and fh.get_category(file) not in f5.CATEGORIES_TO_PROCESS:
+        return []
+    return ["f5"]
+
+"""
+The manifest of a stage within the pipeline. Each input is checked as it
+arrives, and is skipped (its recorded outputs are passed on) if it has not
+changed since it was last processed.
+
+    module: the stage module (with its MANIFEST_NAME and STAGE_PARAMS)
+"""
+class StageManifest:
+    def __init__(self, module):
+        self.stage_name = module.MANIFEST_NAME
+        self.params_hash = mh.hash_params(module.STAGE_PARAMS)
+        self.manifest = mh.load_manifest(self.stage_name) if fdef.INCREMENTAL_RUNS else {}
+        self.file_infos = {}
+        self.results = {}
+
+    """
+    check the given input, returns its outputs if it can be skipped (otherwise None)
+    """
+    def skip(self, file):
+        if not fdef.INCREMENTAL_RUNS:
+            self.file_infos[file] = None
+            return None
+        self.file_infos[file] = mh.get_file_info(file, self.manifest.get(file))
+        if mh.check_unchanged(self.manifest, file, self.file_infos[file], self.params_hash):
+            return self.manifest[file]["outputs"]
+        return None
+
+    """
+    record what the given input produced
+    """
+    def record(self, file, result):
+        self.results[file] = mh.to_output_list(result)
+        if fdef.INCREMENTAL_RUNS:
+            self.manifest[file] = dict(self.file_infos[file], params=self.params_hash,
+                                       outputs=self.results[file])
+
+    """
+    save the manifest (without the inputs that were not seen in this run)
+    and add the new outputs to the file catalog
+    """
+    def save(self):
+        if fdef.INCREMENTAL_RUNS:
+            mh.remove_missing_inputs(self.manifest, self.file_infos)
+            mh.save_manifest(self.stage_name, self.manifest)
+        ch.add_stage_outputs(self.results)
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
@@ -1,90 +1,277 @@
-# Internal helpers and definitions
-import h_folder_nav_helpers as fh
-import h_FOLDER_DEFINITIONS as fdef
-# folder navigation modules
-import os
-# audio processing modules
-import wave
-from pydub import AudioSegment
-
-
-
-#---------------------------------------#
-# CONSTANT DEFINITIONS
-#---------------------------------------#
-# path to the final data
-SOURCE_FOLDER = fdef.FINAL_DATA_FOLDER
-# path to the mono, 16kHz transformed data folder
-DEST_FOLDER = fdef.MONO_16KHZ_DATA_FOLDER
-#---------------------------------------#
-
-#---------------------------------------#
-# GOBAL VARIABLE TRACKERS
-#---------------------------------------#
-files_transformed = 0
-#---------------------------------------#
-
-
-
-"""
-main function
-"""
-def main():
-    fh.clean_folder(DEST_FOLDER)
-    convert_all_audio_files_mono_16khz(SOURCE_FOLDER)   
-
-"""
-Convert the given audio file to mono & 16kHz and export the
-converted file to the destination folder. The orginal file 
-will remain unchanged
-
-    file: the file to convert
-"""
-def convert_audio_file_mono_16khz(file: str) -> None:
-    # convert all the audio snippits to channel type "Mono" 
-    # and convert all the audio snippits to sampling frequency "16kHz"
-    # Load the WAV file
-    audio = AudioSegment.from_wav(file)  
-    # Convert to mono
-    audio_mono = audio.set_channels(1)
-    # Convert to 16kHz sampling frequency
-    audio_mono_16khz = audio_mono.set_frame_rate(16000)
-
-    # Save the transformed audio file
-    fh.save_new_wav(file, audio_mono_16khz, DEST_FOLDER, generate_output_file_name)
-    # update the file count
-    global files_transformed
-    files_transformed += 1
-    print(f"Number of files transformed: {files_transformed}", end='\r')
-
-
-"""
-Convert all the audio files in the given folder to mono & 16kHz 
-and export the converted files to the destination folder. 
-The orginal files will remain unchanged.
-
-    folder: the folder to convert
-"""
-def convert_all_audio_files_mono_16khz(folder: str) -> None:
-    # get all the files in the folder 
-    # including within subfolders
-    all_files = fh.make_path_list(folder)
-    # for each of the files, convert it in place
-    for file in all_files:
-            convert_audio_file_mono_16khz(file)
-
-"""
-generate the output file path for the mono 16kHz file
-Format: "{file_name}_mono_16khz.wav"
-
-    file_name: the name of the original file to be converted
-"""
-def generate_output_file_name(file_name: str) -> None: 
-    return f"{file_name}_mono_16khz.wav"
-
-
-
-
-#---------------------------------------#
-main()
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+import h_instrumentation_helpers as ih
+import h_writer_helpers as wh
+# folder navigation modules
+import os
+# audio processing modules
+# (scipy.signal is only imported when a file is actually resampled)
+import numpy as np
+from functools import lru_cache
+from math import gcd
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# path to the final data
+SOURCE_FOLDER = fdef.FINAL_DATA_FOLDER
+# path to the mono, 16kHz transformed data folder
+DEST_FOLDER = fdef.MONO_16KHZ_DATA_FOLDER
+# if we wish to first clean out the destionation folder
+# (otherwise only the changed files are re-processed)
+CLEAN_DEST = False
+# the name of the manifest of this stage
+MANIFEST_NAME = "f2_mono_16khz"
+#---------------------------------------#
+
+#---------------------------------------#
+# RESAMPLING OPTIONS
+#---------------------------------------#
+# the sampling frequency we convert to
+TARGET_FRAME_RATE = 16000
+# the source sampling frequencies we normally see, their
+# anti-alias filters are designed once up front
+COMMON_SOURCE_RATES = [44100, 48000, 22050, 8000]
+# the half length of the anti-alias filter, in taps per polyphase branch
+FILTER_HALF_LENGTH = 10
+# the kaiser window beta of the anti-alias filter
+FILTER_KAISER_BETA = 5.0
+# the parameters that affect the output files
+STAGE_PARAMS = {"channels": 1, "frame_rate": TARGET_FRAME_RATE,
+                "resampler": "polyphase", "filter_half_length": FILTER_HALF_LENGTH,
+                "filter_kaiser_beta": FILTER_KAISER_BETA}
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    if CLEAN_DEST:
+        fh.clean_folder(DEST_FOLDER)
+    convert_all_audio_files_mono_16khz(SOURCE_FOLDER)   
+
+"""
+Convert the given audio file to mono & 16kHz and export the
+converted file to the destination folder. The orginal file 
+will remain unchanged
+
+    file: the file to convert
+
+    returns: the path to the converted file
+"""
+def convert_audio_file_mono_16khz(file: str) -> str:
+    header = fh.read_wav_header(file)
+    if not needs_conversion(header):
+        # the file is already mono & 16kHz, so we do not touch the audio
+        output_path = fh.make_new_wav_path(file, DEST_FOLDER, generate_output_file_name)
+        wh.make_folder(os.path.dirname(output_path))
+        with ih.span("write"):
+            fh.link_or_copy_file(file, output_path)
+    elif fh.is_pcm16(header) and header["frames"] > fdef.STREAMING_MIN_FRAMES:
+        # a long recording, convert it a block at a time
+        output_path = fh.make_new_wav_path(file, DEST_FOLDER, generate_output_file_name)
+        wh.make_folder(os.path.dirname(output_path))
+        blocks = stream_samples_mono_16khz(fh.iter_wav_pcm16_blocks(file),
+                                           header["sample_rate"], header["frames"])
+        fh.write_wav_pcm16_blocks(output_path, blocks, 1, TARGET_FRAME_RATE)
+    else:
+        # Load the WAV file
+        samples, sample_rate = fh.load_wav_samples(file)
+        # convert to mono & 16kHz
+        with ih.span("transform"):
+            samples_mono_16khz = convert_samples_mono_16khz(samples, sample_rate)
+
+        # Save the transformed audio file
+        output_path = fh.save_new_wav_samples(file, samples_mono_16khz, TARGET_FRAME_RATE,
+                                              DEST_FOLDER, generate_output_file_name)
+    return output_path
+
+"""
+check if the file with the given wav header needs converting, rather than
+being linked as it is (as it is already 16 bit mono & 16kHz). Only the files
+that need converting are read ahead (see h_reader_helpers).
+
+    header: the wav header of the file (see fh.read_wav_header)
+
+    returns: True if the file needs converting
+"""
+def needs_conversion(header):
+    return not (fh.is_pcm16(header) and header["channels"] == 1
+                and header["sample_rate"] == TARGET_FRAME_RATE)
+
+"""
+Convert the given samples to mono & 16kHz. The channels are averaged and
+then polyphase resampled in a single vectorised pass over the whole array.
+Audio that is already at 16kHz is only downmixed.
+
+    samples: int16 array of shape (frames, channels)
+    sample_rate: the sampling frequency of the samples
+
+    returns: the mono, 16kHz int16 samples
+"""
+def convert_samples_mono_16khz(samples, sample_rate):
+    # Convert to mono
+    if samples.ndim > 1 and samples.shape[1] > 1:
+        mono = samples.mean(axis=1, dtype=np.float32)
+    else:
+        mono = samples.reshape(-1)
+
+    if sample_rate == TARGET_FRAME_RATE:
+        # round the same way as pydub's set_channels
+        return np.floor(mono).astype(np.int16)
+
+    # Convert to 16kHz sampling frequency
+    from scipy.signal import resample_poly
+    up, down, taps = get_resample_filter(sample_rate)
+    resampled = resample_poly(mono.astype(np.float32), up, down, window=taps)
+    return np.clip(np.rint(resampled), -fdef.MAX_16BIT_AMP, fdef.MAX_16BIT_AMP - 1).astype(np.int16)
+
+"""
+Convert blocks of samples to mono & 16kHz as they are read, giving the same
+samples as convert_samples_mono_16khz would for the whole file. The input
+needed by the filter across each block edge is carried over to the next block,
+so only a block (plus the filter length) is ever held in memory.
+
+    blocks: an iterable of int16 arrays of shape (frames, channels)
+    sample_rate: the sampling frequency of the samples
+    total_frames: the total number of frames over all the blocks
+
+    returns: a generator of mono, 16kHz int16 blocks
+"""
+def stream_samples_mono_16khz(blocks, sample_rate, total_frames):
+    if sample_rate == TARGET_FRAME_RATE:
+        for block in blocks:
+            with ih.span("transform"):
+                block = convert_samples_mono_16khz(block, sample_rate)
+            yield block
+        return
+
+    from scipy.signal import upfirdn
+    up, down, taps = get_resample_filter(sample_rate)
+    filter_taps, pre_remove = get_stream_filter(sample_rate)
+    # the outputs are numbered as in the full (un-trimmed) filter output
+    next_out = pre_remove
+    end_out = pre_remove + -(-total_frames * up // down)
+
+    # the mono input still needed by the filter, starting at input frame history_start
+    history = np.zeros(0, dtype=np.float32)
+    history_start = 0
+    frames_read = 0
+    for block in blocks:
+        with ih.span("transform"):
+            if block.shape[1] > 1:
+                mono = block.mean(axis=1, dtype=np.float32)
+            else:
+                mono = block[:, 0].astype(np.float32)
+            history = np.concatenate((history, mono))
+            frames_read += len(block)
+
+            # the outputs that only depend on the input read so far
+            # (all of the remaining outputs once the whole file has been read)
+            if frames_read >= total_frames:
+                stop_out = end_out
+            else:
+                stop_out = min(end_out, -(-frames_read * up // down))
+            resampled = None
+            if stop_out > next_out:
+                filtered = upfirdn(filter_taps, history, up, down)
+                offset = history_start * up // down
+                resampled = filtered[next_out - offset : stop_out - offset]
+                # the outputs past the end of the filtered history are all zero
+                resampled = np.pad(resampled, (0, stop_out - next_out - len(resampled)))
+                resampled = np.clip(np.rint(resampled), -fdef.MAX_16BIT_AMP,
+                                    fdef.MAX_16BIT_AMP - 1).astype(np.int16)
+                next_out = stop_out
+
+            # drop the input that no later output depends on (keeping the
+            # history start a multiple of down, so the outputs stay aligned)
+            keep_start = max(0, (next_out * down - len(filter_taps)) // up + 1)
+            keep_start -= keep_start % down
+            history = history[keep_start - history_start:]
+            history_start = keep_start
+
+        if resampled is not None:
+            yield resampled
+
+"""
+Get the filter resample_poly applies for the given sampling frequency:
+the anti-alias filter scaled by the up factor and zero padded at the front
+so that the output samples are centred.
+
+    sample_rate: the sampling frequency being converted from
+
+    returns: (float32 filter taps, number of leading outputs to remove)
+"""
+@lru_cache(maxsize=None)
+def get_stream_filter(sample_rate):
+    up, down, taps = get_resample_filter(sample_rate)
+    half_len = (len(taps) - 1) // 2
+    pre_pad = down - half_len % down
+    pre_remove = (half_len + pre_pad) // down
+    filter_taps = np.concatenate((np.zeros(pre_pad, dtype=np.float32), taps * np.float32(up)))
+    return filter_taps, pre_remove
+
+"""
+Design the anti-alias filter for resampling from the given sampling frequency
+to 16kHz. The filter is the same as the one resample_poly would design itself,
+but is only designed once per sampling frequency.
+
+    sample_rate: the sampling frequency being converted from
+
+    returns: (up factor, down factor, float32 filter taps)
+"""
+@lru_cache(maxsize=None)
+def get_resample_filter(sample_rate):
+    from scipy.signal import firwin
+    divisor = gcd(TARGET_FRAME_RATE, sample_rate)
+    up = TARGET_FRAME_RATE // divisor
+    down = sample_rate // divisor
+
+    # low pass at the lower of the two nyquist frequencies
+    max_rate = max(up, down)
+    taps = firwin(2 * FILTER_HALF_LENGTH * max_rate + 1, 1.0 / max_rate,
+                  window=('kaiser', FILTER_KAISER_BETA))
+    return up, down, taps.astype(np.float32)
+
+"""
+Convert all the audio files in the given folder to mono & 16kHz 
+and export the converted files to the destination folder. 
+The orginal files will remain unchanged.
+
+    folder: the folder to convert
+"""
+def convert_all_audio_files_mono_16khz(folder: str) -> None:
+    # get all the files in the folder 
+    # including within subfolders (from the file catalog)
+    all_files = ch.list_files(folder)
+    # design the filters for the common sampling frequencies up front
+    # (so the worker processes inherit them)
+    for sample_rate in COMMON_SOURCE_RATES:
+        get_resample_filter(sample_rate)
+    # convert each of the changed files, spread over the worker processes
+    mh.run_incremental(MANIFEST_NAME, convert_audio_file_mono_16khz, all_files, STAGE_PARAMS,
+                       read_ahead_filter=needs_conversion)
+
+"""
+generate the output file path for the mono 16kHz file
+Format: "{file_name}_mono_16khz.wav"
+
+    file_name: the name of the original file to be converted
+"""
+def generate_output_file_name(file_name: str) -> None: 
+    return f"{file_name}_mono_16khz.wav"
+
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
 #---------------------------------------#
\ No newline at end of file
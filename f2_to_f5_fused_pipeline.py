@@ -0,0 +1,179 @@
+"""
+Run f2 -> f3 -> f4 -> f5 on each file in a single pass.
+
+Each file in the final data folder is decoded once, converted to mono & 16kHz,
+normalised, has its target section(s) extracted and is perturbed in memory.
+Only the final perturbed clips are written, the intermediate files are only
+saved (to their usual folders) when SAVE_INTERMEDIATE_FILES is set. The saved
+intermediate files are outputs of the pass as well (in the manifest and the
+file catalog, with the final data file as their parent).
+
+The output names are identical to running each stage one after the other.
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+import h_instrumentation_helpers as ih
+# the individual stages
+import f2_convert_to_mono_16kHz as f2
+import f3_normalise_amp as f3
+import f4_0_extract_1_2s_target_sound as f4_0
+import f4_1_extract_scratches as f4_1
+import f5_perturb_amp as f5
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS                  #
+#---------------------------------------#
+# path to the final data
+SOURCE_FOLDER = fdef.FINAL_DATA_FOLDER
+# path to the perturbed amps data folder
+DEST_FOLDER = fdef.PERTURBED_AMP_DATA_FOLDER
+# if we wish to first clean out the destionation folder
+CLEAN_DEST = False
+# the name of the manifest of this pipeline
+MANIFEST_NAME = "f2_to_f5_fused"
+# the parameters that affect the output files (those of every stage)
+STAGE_PARAMS = {"f2": f2.STAGE_PARAMS, "f3": f3.STAGE_PARAMS, "f4_0": f4_0.STAGE_PARAMS,
+                "f4_0_ignore": f4_0.IGNORE_CATEGORIES, "f4_1": f4_1.STAGE_PARAMS,
+                "f4_1_categories": f4_1.CATEGORIES_TO_PROCESS,
+                "f5": f5.STAGE_PARAMS, "f5_categories": f5.CATEGORIES_TO_PROCESS}
+# whether to also write the intermediate files of each stage
+# (mono 16kHz, normalised, targeted) to their usual folders for debugging
+SAVE_INTERMEDIATE_FILES = False
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    if CLEAN_DEST:
+        fh.clean_folder(DEST_FOLDER)
+    process_all_files(SOURCE_FOLDER)
+
+
+
+"""
+run all the stages on the given file and export the perturbed clips
+to the destination folder. The orginal file will remain unchanged.
+
+    file: the path to the wav file in the final data folder
+
+    returns: the paths of the exported perturbed clips
+             (and of the intermediate files, when they are saved)
+"""
+def process_file(file):
+    # the paths of the intermediate files that are saved
+    saved_paths = []
+    # decode the file only once
+    samples, sample_rate = fh.load_wav_samples(file)
+
+    # f2: mono & 16kHz
+    with ih.span("transform"):
+        samples = f2.convert_samples_mono_16khz(samples, sample_rate)
+    mono_path = save_stage_output(file, samples, f2.TARGET_FRAME_RATE,
+                                  f2.DEST_FOLDER, f2.generate_output_file_name, saved_paths)
+
+    # f3: normalise the amplitude
+    with ih.span("transform"):
+        samples = f3.normalise_samples(samples)
+    norm_path = save_stage_output(mono_path, samples, f2.TARGET_FRAME_RATE,
+                                  f3.DEST_FOLDER, f3.generate_output_file_name, saved_paths)
+
+    # f4: extract the target section(s)
+    with ih.span("transform"):
+        targets = extract_targets(norm_path, samples, f2.TARGET_FRAME_RATE, saved_paths)
+    if f5.CATEGORIES_TO_PROCESS:
+        targets = [(target_path, target_samples) for target_path, target_samples in targets
+                   if fh.get_category(target_path) in f5.CATEGORIES_TO_PROCESS]
+    if not targets:
+        return saved_paths
+
+    # f5: perturb the amplitude of all the target sections at once
+    output_paths = saved_paths
+    with ih.span("transform"):
+        perturbed_targets = f5.perturb_samples_batch([target_samples for _, target_samples in targets])
+    for (target_path, _), perturbed in zip(targets, perturbed_targets):
+        for amp_pert_tag, perturbed_samples in perturbed:
+            output_paths.append(fh.save_new_wav_samples(target_path, perturbed_samples, f2.TARGET_FRAME_RATE,
+                                                        DEST_FOLDER, f5.generate_output_file_name, amp_pert_tag))
+
+    return output_paths
+
+"""
+extract the target sections of the given normalised samples, routing the
+scratch categories through the f4_1 multi pass extraction and everything
+else through f4_0
+
+    norm_path: the path the normalised file has (or would have) in the f3 folder
+    samples: the normalised mono int16 samples
+    sample_rate: the sampling frequency of the samples
+    saved_paths: the list the paths of the saved intermediate files are added to
+
+    returns: a list of (path of the targeted file, target int16 samples)
+"""
+def extract_targets(norm_path, samples, sample_rate, saved_paths):
+    category = fh.get_category(norm_path)
+
+    # the usual single target section
+    if category not in f4_0.IGNORE_CATEGORIES:
+        target_section = f4_0.locate_target_section(samples, sample_rate)
+        if target_section is None:
+            print(f"File {norm_path} has no {f4_0.get_target_description()}")
+            return []
+        target_samples = f4_0.fit_target_samples(samples, *target_section[:2], sample_rate)
+        target_path = save_stage_output(norm_path, target_samples, sample_rate,
+                                        f4_0.DEST_FOLDER, f4_0.generate_output_file_name, saved_paths)
+        return [(target_path, target_samples)]
+
+    if category not in f4_1.CATEGORIES_TO_PROCESS:
+        return []
+
+    # the scratches, up to f4_1.MAX_PASSES target sections
+    targets = []
+    for pass_tag, target_samples, _ in f4_1.extract_target_samples(samples, sample_rate):
+        target_path = save_stage_output(norm_path, target_samples, sample_rate,
+                                        f4_1.DEST_FOLDER, f4_1.generate_output_file_name, saved_paths, pass_tag)
+        targets.append((target_path, target_samples))
+    if not targets:
+        print(f"File {norm_path} has no audio exceeding {f4_0.TARGET_AMP_THRESHOLD} amplitude")
+    return targets
+
+"""
+save the output of an intermediate stage if SAVE_INTERMEDIATE_FILES is set
+
+    saved_paths: the list the path is added to if the file is saved
+
+    returns: the path of the intermediate file, whether or not it was written
+"""
+def save_stage_output(file_path, samples, sample_rate, dest_partent_folder, generate_output_file_name,
+                      saved_paths, end_tag=None):
+    if SAVE_INTERMEDIATE_FILES:
+        saved_paths.append(fh.save_new_wav_samples(file_path, samples, sample_rate, dest_partent_folder,
+                                                   generate_output_file_name, end_tag))
+        return saved_paths[-1]
+    return fh.make_new_wav_path(file_path, dest_partent_folder,
+                                generate_output_file_name, end_tag)
+
+"""
+run all the stages on all the files in the given folder (including subfolders)
+
+    folder: the path to the folder containing the wav files
+"""
+def process_all_files(folder):
+    # get all the files in the folder
+    # including within subfolders (from the file catalog)
+    all_files = ch.list_files(folder)
+    # process each of the changed files, spread over the worker processes
+    mh.run_incremental(MANIFEST_NAME, process_file, all_files, STAGE_PARAMS)
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
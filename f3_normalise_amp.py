@@ -1,99 +1,252 @@
-# Internal helpers and definitions
-import h_folder_nav_helpers as fh
-import h_FOLDER_DEFINITIONS as fdef
-# folder navigation modules
-import os
-# audio processing modules
-from pydub import AudioSegment
-from pydub.effects import normalize
-# displaying wav file modules
-import matplotlib.pyplot as plt
-import numpy as np
-from scipy.io import wavfile
-
-
-#---------------------------------------#
-# CONSTANT DEFINITIONS
-#---------------------------------------#
-# path to the mono, 16kHz transformed data folder
-SOURCE_FOLDER = fdef.MONO_16KHZ_DATA_FOLDER
-# path to the normalised data folder
-DEST_FOLDER = fdef.AMP_NORM_DATA_FOLDER
-#---------------------------------------#
-
-#---------------------------------------#
-# GRAPH DISPLAY OPTIONS
-#---------------------------------------#
-# the files that are to be graphed
-WAVS_TO_SHOW = [1, 2, 3, 4, 5]
-# whether to show the graphs of the audio files being normaised
-SHOW_NORMALISED_GRAPHS = True
-#---------------------------------------#
-
-#---------------------------------------#
-# GOBAL VARIABLE TRACKERS
-#---------------------------------------#
-# a counter to keep track of the number of files transformed
-files_transformed = 0
-#---------------------------------------#
-
-
-"""
-main function
-"""
-def main() -> None:
-    fh.clean_folder(DEST_FOLDER)
-    normalise_amp_of_all_files(SOURCE_FOLDER)
-
-
-"""
-convert the given wav file to have a normalised amplitude ranging from -1 to 1.
-And export the converted file to the destination folder. The orginal file 
-will remain unchanged.
-
-    file: the path to the wav file
-"""
-def normalise_amp_of_file(file: str) -> None: 
-    # normalise the amplitude of the audio file
-    audio = AudioSegment.from_file(file)
-    normalized_audio = normalize(audio, headroom=1.0)
-    output_path = fh.save_new_wav(file, normalized_audio, 
-                                  DEST_FOLDER, generate_output_file_name)
-
-    # update the file count
-    global files_transformed
-    files_transformed += 1
-    print(f"Number of files transformed: {files_transformed}", end='\r')
-
-    # we will display a subset of the converted wav files
-    if SHOW_NORMALISED_GRAPHS and files_transformed in WAVS_TO_SHOW:
-        fh.display_amp_graph(file, output_path)
-
-"""
-Generate the output file path of the normalised output file
-Format: "{file_name}_normalised.wav"
-
-    file_name: the name of the original file to be converted
-"""
-def generate_output_file_name(file_name: str) -> str: 
-    return f"{file_name}_normalised.wav"
-
-"""
-Convert all the wav files in the given folder (including subfolders)
-to have a normalised amplitude ranging from -1 to 1. and export the 
-converted files to the destination folder. 
-The orginal files will remain unchanged.
-
-    folder: the path to the folder containing the wav files
-"""
-def normalise_amp_of_all_files(folder: str) -> None:
-    # get all the files in the folder 
-    # including within subfolders
-    all_files = fh.make_path_list(folder)
-    # for each of the files, convert it in place
-    for file in all_files:
-        normalise_amp_of_file(file)
-
-#---------------------------------------#
-main()
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_parallel_helpers as ph
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+import h_instrumentation_helpers as ih
+import h_writer_helpers as wh
+# folder navigation modules
+import os
+# audio processing modules
+import math
+import numpy as np
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# path to the mono, 16kHz transformed data folder
+SOURCE_FOLDER = fdef.MONO_16KHZ_DATA_FOLDER
+# path to the normalised data folder
+DEST_FOLDER = fdef.AMP_NORM_DATA_FOLDER
+# if we wish to first clean out the destionation folder
+# (otherwise only the changed files are re-processed)
+CLEAN_DEST = False
+# the name of the manifest of this stage
+MANIFEST_NAME = "f3_amp_normalised"
+# how far below full scale the peak of each file is normalised to, in dB
+NORMALISE_HEADROOM = 1.0
+# how the files are normalised
+# "peak": the peak of each file is set to NORMALISE_HEADROOM below full scale
+# "rms": the rms of each file is set to RMS_TARGET_DBFS, but never so loud that
+#        the peak goes above NORMALISE_HEADROOM below full scale
+NORMALISE_MODE = "peak"
+# the rms level the files are normalised to in "rms" mode, in dB below full scale
+RMS_TARGET_DBFS = -20.0
+# the max number of files normalised together in one batch,
+# and the max bytes of samples held in a batch
+NORMALISE_BATCH_FILES = 64
+NORMALISE_BATCH_BYTES = 64 * 1024 * 1024
+# the parameters that affect the output files
+STAGE_PARAMS = {"headroom": NORMALISE_HEADROOM, "mode": NORMALISE_MODE, "rms_target": RMS_TARGET_DBFS}
+#---------------------------------------#
+
+#---------------------------------------#
+# GRAPH DISPLAY OPTIONS
+#---------------------------------------#
+# the files that are to be graphed
+WAVS_TO_SHOW = [1, 2, 3, 4, 5]
+# whether to show the graphs of the audio files being normaised
+SHOW_NORMALISED_GRAPHS = True
+#---------------------------------------#
+
+
+"""
+main function
+"""
+def main() -> None:
+    if CLEAN_DEST:
+        fh.clean_folder(DEST_FOLDER)
+    normalise_amp_of_all_files(SOURCE_FOLDER)
+
+
+"""
+convert the given wav file to have a normalised amplitude ranging from -1 to 1.
+And export the converted file to the destination folder. The orginal file 
+will remain unchanged.
+
+    file: the path to the wav file
+
+    returns: the path to the normalised file
+"""
+def normalise_amp_of_file(file: str) -> str: 
+    return normalise_amp_of_files([file])[0]
+
+"""
+normalise a batch of wav files together and export them to the destination
+folder. The clips are normalised in one go (see normalise_samples_batch),
+long recordings are normalised on their own a block at a time.
+
+    files: the paths to the wav files
+
+    returns: the path to the normalised file of each file
+"""
+def normalise_amp_of_files(files: list) -> list:
+    output_paths = [None] * len(files)
+    # the clips waiting to be normalised, (index of the file, samples, sample rate)
+    batch = []
+    batch_bytes = 0
+    for i, file in enumerate(files):
+        with ih.batch_file(file):
+            header = fh.read_wav_header(file)
+            if fh.is_pcm16(header) and header["frames"] > fdef.STREAMING_MIN_FRAMES:
+                # a long recording, normalise it a block at a time
+                output_paths[i] = fh.make_new_wav_path(file, DEST_FOLDER, generate_output_file_name)
+                wh.make_folder(os.path.dirname(output_paths[i]))
+                normalise_wav_streaming(file, output_paths[i], header["channels"], header["sample_rate"])
+                continue
+
+            # (anything other than 16 bit PCM is decoded to 16 bit)
+            samples, sample_rate = fh.load_wav_samples(file)
+        batch.append((i, samples, sample_rate))
+        batch_bytes += samples.nbytes
+        if batch_bytes >= NORMALISE_BATCH_BYTES:
+            export_normalised_batch(files, batch, output_paths)
+            batch, batch_bytes = [], 0
+    export_normalised_batch(files, batch, output_paths)
+
+    # we will display a subset of the converted wav files
+    # (the number of the first file of the batch)
+    first_file_num = ih.get_file_num() - len(files) + 1
+    for i, file in enumerate(files):
+        if SHOW_NORMALISED_GRAPHS and first_file_num + i in WAVS_TO_SHOW and not ph.IS_WORKER_PROCESS:
+            # the new file(s) may still be being written in the background
+            wh.wait_for_writes()
+            fh.display_amp_graph(file, output_paths[i])
+
+    return output_paths
+
+"""
+normalise the clips of the batch together and export each of them
+
+    files: the paths to all the files of the batch
+    batch: a list of (index of the file, samples, sample rate)
+    output_paths: the output path of each file, filled in for the batch
+"""
+def export_normalised_batch(files, batch, output_paths):
+    with ih.span("transform"):
+        normalised = normalise_samples_batch([samples for _, samples, _ in batch])
+    for (i, _, sample_rate), samples in zip(batch, normalised):
+        with ih.batch_file(files[i]):
+            output_paths[i] = fh.save_new_wav_samples(files[i], samples, sample_rate,
+                                                      DEST_FOLDER, generate_output_file_name)
+
+"""
+normalise the amplitude of the given samples so that its peak
+sits NORMALISE_HEADROOM below full scale (or its rms at RMS_TARGET_DBFS)
+
+    samples: the int16 samples to normalise
+
+    returns: the normalised int16 samples
+"""
+def normalise_samples(samples):
+    return normalise_samples_batch([samples])[0]
+
+"""
+normalise a batch of clips of different lengths. The clips are packed into
+one buffer, the peak (and rms) of every clip is found with segmented
+reductions and the gains are applied in one sweep. In "peak" mode this gives
+exactly the same samples as pydub's normalize(audio, headroom=NORMALISE_HEADROOM).
+
+    clips: a list of int16 sample arrays
+
+    returns: the list of normalised int16 sample arrays
+"""
+def normalise_samples_batch(clips):
+    if not clips:
+        return []
+    buffer, offsets = fh.pack_clips(clips)
+    peaks = fh.peaks_of_clips(buffer, offsets)
+    rms = fh.rms_of_clips(buffer, offsets) if NORMALISE_MODE == "rms" else [None] * len(clips)
+    gains_db = [get_normalise_gain_db(int(peak), clip_rms) for peak, clip_rms in zip(peaks, rms)]
+    return fh.unpack_clips(fh.apply_clip_gains(buffer, offsets, gains_db), offsets, clips)
+
+"""
+find the gain that normalises a clip with the given peak (and rms)
+
+    peak: the peak of the clip
+    rms: the rms of the clip (only needed in "rms" mode)
+
+    returns: the gain in dB
+"""
+def get_normalise_gain_db(peak, rms=None):
+    peak_gain_db = fh.peak_normalise_gain_db(peak, NORMALISE_HEADROOM)
+    if NORMALISE_MODE == "peak":
+        return peak_gain_db
+    if NORMALISE_MODE != "rms":
+        raise ValueError(f"Unknown NORMALISE_MODE {NORMALISE_MODE}")
+    # silent audio is left as is
+    if not rms:
+        return 0.0
+    rms_gain_db = RMS_TARGET_DBFS - 20 * math.log10(rms / fdef.MAX_16BIT_AMP)
+    return min(rms_gain_db, peak_gain_db)
+
+"""
+normalise the given 16 bit wav file the same way as normalise_samples, in two
+passes over the file a block at a time: first to find the peak (and rms), then
+to apply the gain. Only a single block is ever held in memory.
+
+    file: the path to the wav file
+    output_path: the path to write the normalised file to
+    channels: the number of channels of the file
+    sample_rate: the sample rate of the file
+"""
+def normalise_wav_streaming(file, output_path, channels, sample_rate):
+    peak = 0
+    sum_squares = 0.0
+    num_samples = 0
+    for block in fh.iter_wav_pcm16_blocks(file):
+        with ih.span("transform"):
+            peak = max(peak, fh.peak_of_samples(block))
+            if NORMALISE_MODE == "rms":
+                sum_squares += float(np.square(block, dtype=np.float64).sum())
+                num_samples += block.size
+    rms = math.sqrt(sum_squares / num_samples) if num_samples else 0.0
+    gain_db = get_normalise_gain_db(peak, rms)
+
+    fh.write_wav_pcm16_blocks(output_path, gain_blocks(fh.iter_wav_pcm16_blocks(file), gain_db),
+                              channels, sample_rate)
+
+"""
+apply the gain to each of the blocks as they are read
+
+    returns: a generator of the int16 blocks
+"""
+def gain_blocks(blocks, gain_db):
+    for block in blocks:
+        # silent audio is left as is
+        if gain_db != 0.0:
+            with ih.span("transform"):
+                block = fh.apply_gain_samples(block, gain_db)
+        yield block
+
+"""
+Generate the output file path of the normalised output file
+Format: "{file_name}_normalised.wav"
+
+    file_name: the name of the original file to be converted
+"""
+def generate_output_file_name(file_name: str) -> str: 
+    return f"{file_name}_normalised.wav"
+
+"""
+Convert all the wav files in the given folder (including subfolders)
+to have a normalised amplitude ranging from -1 to 1. and export the 
+converted files to the destination folder. 
+The orginal files will remain unchanged.
+
+    folder: the path to the folder containing the wav files
+"""
+def normalise_amp_of_all_files(folder: str) -> None:
+    # get all the files in the folder 
+    # including within subfolders (from the file catalog)
+    all_files = ch.list_files(folder)
+    # normalise each of the changed files in batches, spread over the worker processes
+    mh.run_incremental(MANIFEST_NAME, normalise_amp_of_files, all_files, STAGE_PARAMS,
+                       batch_files=NORMALISE_BATCH_FILES)
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
 #---------------------------------------#
\ No newline at end of file
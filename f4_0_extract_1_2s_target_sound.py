@@ -1,195 +1,311 @@
-# Internal helpers and definitions
-import h_folder_nav_helpers as fh
-import h_FOLDER_DEFINITIONS as fdef
-# folder navigation modules
-import os
-# audio processing modules
-from pydub import AudioSegment
-import librosa
-# displaying wav file modules
-import matplotlib.pyplot as plt
-import numpy as np
-import math
-from scipy.io import wavfile
-
-#---------------------------------------#
-# CONSTANT DEFINITIONS
-#---------------------------------------#
-# path to the amp normalised data folder (source)
-SOURCE_FOLDER = fdef.AMP_NORM_DATA_FOLDER
-# path to the cetered and trimed data folder (destination)
-DEST_FOLDER = fdef.TARGETED_1_2S_DATA_FOLDER
-# the categories that we want to ignore when preforming this process
-# we normaly wish to ignore the "scratch" sounds as we can process them later
-# in f4_1 as they normally require a second pass (see documentation)
-IGNORE_CATEGORIES = ["soft-scratch", "hard-scratch", "board-scratch", "pole-scratch"]
-# if we wish to first clean out the destionation folder
-CLEAN_DEST = False
-#---------------------------------------#
-
-#---------------------------------------#
-# GRAPH DISPLAY OPTIONS
-#---------------------------------------#
-# the files that are to be graphed
-WAVS_TO_SHOW = [1, 2, 3, 4, 5, 6, 7, 8]
-# whether to show the graphs of the audio files being normaised
-SHOW_SHIFTED_GRAPHS = True
-#---------------------------------------#
-
-#---------------------------------------#
-# GOBAL VARIABLE TRACKERS
-#---------------------------------------#
-files_transformed = 0
-#---------------------------------------#
-
-
-
-"""
-main function
-"""
-def main() -> None:
-    if CLEAN_DEST:
-        fh.clean_folder(DEST_FOLDER)
-    locate_export_all_target_sections(SOURCE_FOLDER)
-
-"""
-locate the target section of the given file
-i.e. the audio of interest (e.g. meow)
-And then export this section within a 1-2s audio clip
-
-    file: the path to the wav file
-"""
-def locate_export_target_section(file: str) -> None:
-    # Load the WAV file using PyDub
-    audio_file = AudioSegment.from_wav(file)
-
-    # Convert the audio into a NumPy array
-    audio_array = np.array(audio_file.get_array_of_samples()) / fdef.MAX_16BIT_AMP
-    # Find the indices where the audio exceeds 0.5 amplitude
-    exceeding_indices = np.where(np.abs(audio_array) > 0.5)[0]
-    # if there is no audio of interest then we skip this file
-    if len(exceeding_indices) == 0:
-        print(f"File {file} has no audio exceeding 0.5 amplitude")
-        return
-
-    # Calculate the time at which the audio first exceeds 0.5 amplitude
-    first_exceeding_time = exceeding_indices[0] / audio_file.frame_rate
-    # Calculate the time at which the audio last exceeds 0.5 amplitude
-    last_exceeding_time = exceeding_indices[-1] / audio_file.frame_rate
-
-    # find the time at which the target section starts and ends accounting for lead in
-    target_start = max(0, first_exceeding_time - fdef.LEAD_IN_TIME)
-    target_end = min(last_exceeding_time + fdef.LEAD_IN_TIME, audio_file.duration_seconds)
-
-    # extract and export only the target section
-    target_audio = audio_file[target_start * 1000 : target_end * 1000]  
-    output_path = extract_export_target_audio(target_audio, file)
-
-    # update the file count
-    global files_transformed
-    files_transformed += 1
-    print(f"Number of files transformed: {files_transformed}", end='\r')
-
-    # we will display a subset of the converted wav files
-    if SHOW_SHIFTED_GRAPHS and files_transformed in WAVS_TO_SHOW:
-        # plot the target section, compare the old and new file
-        fh.compare_extracted_target_graph(file, output_path, first_exceeding_time, last_exceeding_time)
-
-"""
-extract and export the target section of the given audio file and add padding / trim
-if needed to ensure that it lies within the 1-2s range.
-If the target section is too long we cut the ends.
-If the target section is too short we add padding.
-
-    target_audio: the target section of the audio file
-    file: the path to the original wav file
-
-    returns: the path to the exported wav file
-"""
-def extract_export_target_audio(target_audio, file):
-    current_duration = target_audio.duration_seconds
-
-    # if the target secion is too long we cut the ends   
-    if current_duration > fdef.MAX_LENGTH_S:
-        cut_start = int((current_duration - fdef.MAX_LENGTH_S) * 500)
-        cut_end = int((current_duration - fdef.MAX_LENGTH_S) * 500)
-        target_audio = target_audio[cut_start:-cut_end]
-
-    # if the target secion is too short we add padding
-    elif current_duration < fdef.MIN_LENGTH_S:
-        padding_duration = fdef.MIN_LENGTH_S - current_duration
-        padding_start = int(padding_duration * 500)  # Half of the padding duration in milliseconds
-        padding_end = int(padding_duration * 500)
-        # add the padding 
-        padded_audio = AudioSegment.silent(padding_start) + target_audio + AudioSegment.silent(padding_end)
-        target_audio = padded_audio[:fdef.MIN_LENGTH_S * 1000]  # Truncate to the exact target duration
-
-    # export the file
-    output_path = fh.save_new_wav(file, target_audio, 
-                            DEST_FOLDER, generate_output_file_name)
-    return output_path
-    
-"""
-Generate the output file path
-Format: "{file_name}_centered_1-2s.wav"
-
-    file_name: the name of the original file
-"""
-def generate_output_file_name(file_name): 
-    return f"{file_name}_centered_1-2s.wav"
-
-"""
-Plot audio file highlighting the target section of the given audio file
-and the lead in time.
-
-    audio_array: the audio array of the orginal audio file
-    first_exceeding_time: the time at which the audio first exceeds 0.5 amplitude
-    last_exceeding_time: the time at which the audio last exceeds 0.5 amplitude
-    audio_file: the orginal audio file
-    file: the path to the original wav file
-"""
-def plot_target_section(audio_array, first_exceeding_time, last_exceeding_time, audio_file, file):
-    time = np.arange(len(audio_array)) / audio_file.frame_rate
-    plt.plot(time, audio_array, color='lightskyblue')
-
-    # Highlight the exceeding section
-    # Find the indices within the specified range
-    target_indices = np.where((time >= first_exceeding_time) & (time <= last_exceeding_time))[0]
-    target_leadin_indices = np.where((time >= first_exceeding_time - fdef.LEAD_IN_TIME) 
-                                     & (time <= last_exceeding_time + fdef.LEAD_IN_TIME))[0]
-
-    # Highlight the lead in time
-    plt.plot(time[target_leadin_indices], audio_array[target_leadin_indices], color='pink')
-
-    # Highlight the points within the specified range in red
-    plt.plot(time[target_indices], audio_array[target_indices], color='lightcoral')
-    # Set labels and title for the graph
-    plt.xlabel('Time (seconds)')
-    plt.ylabel('Amplitude')
-    file_name = "_".join(os.path.basename(file).split("_")[:3])
-    plt.title(file_name)
-    plt.grid(True)
-    # Show the graph
-    plt.show()
-
-"""
-locate the target section of the files within the given folder
-i.e. the audio of interest (e.g. meow)
-And then export this section within a 1-2s audio clip
-
-    folder: the path to the folder containing the wav files
-"""
-def locate_export_all_target_sections(folder: str) -> None:
-    # get all the files in the folder 
-    # including within subfolders
-    all_files = fh.make_path_list(folder)
-    # for each of the files
-    for file in all_files:
-        if fh.get_category(file) not in IGNORE_CATEGORIES:
-            locate_export_target_section(file)
-
-
-
-#---------------------------------------#
-main()
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_parallel_helpers as ph
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+import h_instrumentation_helpers as ih
+import h_writer_helpers as wh
+# folder navigation modules
+import os
+# audio processing modules
+import numpy as np
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# path to the amp normalised data folder (source)
+SOURCE_FOLDER = fdef.AMP_NORM_DATA_FOLDER
+# path to the cetered and trimed data folder (destination)
+DEST_FOLDER = fdef.TARGETED_1_2S_DATA_FOLDER
+# the categories that we want to ignore when preforming this process
+# we normaly wish to ignore the "scratch" sounds as we can process them later
+# in f4_1 as they normally require a second pass (see documentation)
+IGNORE_CATEGORIES = ["soft-scratch", "hard-scratch", "board-scratch", "pole-scratch"]
+# if we wish to first clean out the destionation folder
+CLEAN_DEST = False
+# the name of the manifest of this stage
+MANIFEST_NAME = "f4_0_targeted_1-2s"
+# the amplitude (from 0 to 1) the target sound has to exceed
+# (for the "sample_index" detector, and the scratches of f4_1)
+TARGET_AMP_THRESHOLD = 0.5
+#---------------------------------------#
+
+#---------------------------------------#
+# TARGET DETECTOR OPTIONS
+#---------------------------------------#
+# how the target sound is located
+# "energy": the dominant event of the frame energy envelope (see locate_dominant_event)
+# "sample_index": from the first to the last sample exceeding TARGET_AMP_THRESHOLD
+TARGET_DETECTOR = "energy"
+# the frame size and step of the energy envelope (in seconds)
+ENERGY_FRAME_S = 0.02
+ENERGY_HOP_S = 0.01
+# an event starts once the frame rms rises above the onset threshold and lasts
+# until it falls below the offset threshold (in dB relative to full scale)
+ONSET_THRESHOLD_DB = -20.0
+OFFSET_THRESHOLD_DB = -30.0
+# events with a shorter gap between them than this are joined into one (in seconds)
+MAX_EVENT_GAP_S = 0.1
+# the parameters that affect the output files
+STAGE_PARAMS = {"LEAD_IN_TIME": fdef.LEAD_IN_TIME, "MAX_LENGTH_S": fdef.MAX_LENGTH_S,
+                "MIN_LENGTH_S": fdef.MIN_LENGTH_S, "threshold": TARGET_AMP_THRESHOLD,
+                "locator": TARGET_DETECTOR,
+                "energy": [ENERGY_FRAME_S, ENERGY_HOP_S, ONSET_THRESHOLD_DB,
+                           OFFSET_THRESHOLD_DB, MAX_EVENT_GAP_S]}
+#---------------------------------------#
+
+#---------------------------------------#
+# GRAPH DISPLAY OPTIONS
+#---------------------------------------#
+# the files that are to be graphed
+WAVS_TO_SHOW = [1, 2, 3, 4, 5, 6, 7, 8]
+# whether to show the graphs of the audio files being normaised
+SHOW_SHIFTED_GRAPHS = True
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main() -> None:
+    if CLEAN_DEST:
+        fh.clean_folder(DEST_FOLDER)
+    locate_export_all_target_sections(SOURCE_FOLDER)
+
+"""
+locate the target section of the given file
+i.e. the audio of interest (e.g. meow)
+And then export this section within a 1-2s audio clip
+
+    file: the path to the wav file
+
+    returns: the path to the exported file, or None if there was no target section
+"""
+def locate_export_target_section(file: str) -> str:
+    # Load the WAV file (memory mapped)
+    samples, sample_rate = fh.load_wav_samples(file)
+
+    # locate the target section
+    with ih.span("transform"):
+        samples = fh.to_mono_samples(samples)
+        target_section = locate_target_section(samples, sample_rate)
+    # if there is no audio of interest then we skip this file
+    if target_section is None:
+        print(f"File {file} has no {get_target_description()}")
+        return None
+    target_start, target_end, first_exceeding_time, last_exceeding_time = target_section
+
+    # extract and export only the target section
+    output_path = extract_export_target_audio(samples, target_start, target_end, sample_rate, file)
+
+    # we will display a subset of the converted wav files
+    if SHOW_SHIFTED_GRAPHS and ih.get_file_num() in WAVS_TO_SHOW and not ph.IS_WORKER_PROCESS:
+        # plot the target section, compare the old and new file
+        # the new file(s) may still be being written in the background
+        wh.wait_for_writes()
+        fh.compare_extracted_target_graph(file, output_path, first_exceeding_time, last_exceeding_time)
+
+    return output_path
+
+"""
+locate the target section of the given samples
+i.e. the audio of interest (e.g. meow) including the lead in and lead out
+
+    samples: the mono int16 samples
+    sample_rate: the sampling frequency of the samples
+
+    returns: (target_start, target_end, first_exceeding_time, last_exceeding_time)
+             or None if no target sound was found (see TARGET_DETECTOR).
+             The start and end are sample indices, the end is exclusive.
+"""
+def locate_target_section(samples, sample_rate):
+    # Find the first and last samples of the target sound
+    if TARGET_DETECTOR == "energy":
+        exceeding = locate_dominant_event(samples, sample_rate)
+    else:
+        exceeding = fh.find_first_last_exceeding(samples, fh.amp_to_int_threshold(TARGET_AMP_THRESHOLD))
+    if exceeding is None:
+        return None
+    first_exceeding, last_exceeding = exceeding
+
+    # find the samples at which the target section starts and ends accounting for lead in
+    lead_in = int(fdef.LEAD_IN_TIME * sample_rate)
+    target_start = max(0, first_exceeding - lead_in)
+    target_end = min(last_exceeding + 1 + lead_in, len(samples))
+
+    return (target_start, target_end, 
+            first_exceeding / sample_rate, last_exceeding / sample_rate)
+
+"""
+locate the dominant event of the given samples in their frame energy envelope.
+The events are found with hysteresis: each is a run of frames above the offset
+threshold that reaches the onset threshold somewhere (runs with short gaps
+between them are joined). The event with the most energy is the target, so a
+lone click at either end of the file no longer stretches the target section.
+Every step is a single numpy operation over all the frames.
+
+    samples: the mono int16 samples
+    sample_rate: the sampling frequency of the samples
+
+    returns: (first sample, last sample) of the event, or None if there is no event
+"""
+def locate_dominant_event(samples, sample_rate):
+    frame_length = min(int(ENERGY_FRAME_S * sample_rate), len(samples))
+    hop_length = max(1, int(ENERGY_HOP_S * sample_rate))
+    energies = fh.frame_energies(samples, frame_length, hop_length)
+    if len(energies) == 0:
+        return None
+
+    # the runs of frames above the offset threshold, as [start, end) frame indices
+    above_offset = energies >= fh.db_to_frame_energy(OFFSET_THRESHOLD_DB, frame_length)
+    edges = np.diff(above_offset.astype(np.int8), prepend=0, append=0)
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return None
+
+    # join the runs with a short gap between them
+    max_gap_frames = int(MAX_EVENT_GAP_S * sample_rate) // hop_length
+    new_event = np.concatenate([[True], starts[1:] - ends[:-1] > max_gap_frames])
+    starts, ends = starts[new_event], ends[np.append(new_event[1:], True)]
+
+    # an event has to reach the onset threshold, the loudest (in total) is the target
+    onsets = np.concatenate([[0], np.cumsum(energies >= fh.db_to_frame_energy(ONSET_THRESHOLD_DB, frame_length))])
+    total_energy = np.concatenate([[0], np.cumsum(energies, dtype=np.float64)])
+    event_energy = np.where(onsets[ends] > onsets[starts], total_energy[ends] - total_energy[starts], -1)
+    event_num = np.argmax(event_energy)
+    if event_energy[event_num] < 0:
+        return None
+
+    first_sample = starts[event_num] * hop_length
+    last_sample = min((ends[event_num] - 1) * hop_length + frame_length, len(samples)) - 1
+    return int(first_sample), int(last_sample)
+
+"""
+describe what the TARGET_DETECTOR looks for (for the message when a file has none)
+"""
+def get_target_description():
+    if TARGET_DETECTOR == "energy":
+        return f"event reaching {ONSET_THRESHOLD_DB}dB"
+    return f"audio exceeding {TARGET_AMP_THRESHOLD} amplitude"
+
+"""
+extract and export the target section of the given audio file and add padding / trim
+if needed to ensure that it lies within the 1-2s range.
+If the target section is too long we cut the ends.
+If the target section is too short we add padding.
+
+    samples: the mono int16 samples of the audio file
+    target_start, target_end: the sample indices of the target section
+    sample_rate: the sampling frequency of the samples
+    file: the path to the original wav file
+
+    returns: the path to the exported wav file
+"""
+def extract_export_target_audio(samples, target_start, target_end, sample_rate, file):
+    with ih.span("transform"):
+        target_samples = fit_target_samples(samples, target_start, target_end, sample_rate)
+
+    # export the file
+    output_path = fh.save_new_wav_samples(file, target_samples, sample_rate,
+                                          DEST_FOLDER, generate_output_file_name)
+    return output_path
+
+"""
+copy the target section into a new 1-2s clip, trimming or padding it as needed.
+If the target section is too long we cut both ends equally.
+If the target section is too short we pad both ends equally with silence.
+
+    samples: the mono int16 samples of the audio file
+    target_start, target_end: the sample indices of the target section
+    sample_rate: the sampling frequency of the samples
+
+    returns: the int16 samples of the 1-2s clip
+"""
+def fit_target_samples(samples, target_start, target_end, sample_rate):
+    target_length = target_end - target_start
+    max_length = int(fdef.MAX_LENGTH_S * sample_rate)
+    min_length = int(fdef.MIN_LENGTH_S * sample_rate)
+
+    # if the target secion is too long we cut the ends
+    if target_length > max_length:
+        target_start += (target_length - max_length) // 2
+        target_length = max_length
+        clip_length, clip_offset = max_length, 0
+    # if the target secion is too short we add padding
+    elif target_length < min_length:
+        clip_length, clip_offset = min_length, (min_length - target_length) // 2
+    else:
+        clip_length, clip_offset = target_length, 0
+
+    # copy the target section into the (silent) clip
+    clip = np.zeros(clip_length, dtype=np.int16)
+    clip[clip_offset : clip_offset + target_length] = samples[target_start : target_start + target_length]
+    return clip
+
+"""
+Generate the output file path
+Format: "{file_name}_centered_1-2s.wav"
+
+    file_name: the name of the original file
+"""
+def generate_output_file_name(file_name): 
+    return f"{file_name}_centered_1-2s.wav"
+
+"""
+Plot audio file highlighting the target section of the given audio file
+and the lead in time.
+
+    audio_array: the audio array of the orginal audio file
+    first_exceeding_time: the time at which the audio first exceeds 0.5 amplitude
+    last_exceeding_time: the time at which the audio last exceeds 0.5 amplitude
+    audio_file: the orginal audio file
+    file: the path to the original wav file
+"""
+def plot_target_section(audio_array, first_exceeding_time, last_exceeding_time, audio_file, file):
+    import matplotlib.pyplot as plt
+    time = np.arange(len(audio_array)) / audio_file.frame_rate
+    plt.plot(time, audio_array, color='lightskyblue')
+
+    # Highlight the exceeding section
+    # Find the indices within the specified range
+    target_indices = np.where((time >= first_exceeding_time) & (time <= last_exceeding_time))[0]
+    target_leadin_indices = np.where((time >= first_exceeding_time - fdef.LEAD_IN_TIME) 
+                                     & (time <= last_exceeding_time + fdef.LEAD_IN_TIME))[0]
+
+    # Highlight the lead in time
+    plt.plot(time[target_leadin_indices], audio_array[target_leadin_indices], color='pink')
+
+    # Highlight the points within the specified range in red
+    plt.plot(time[target_indices], audio_array[target_indices], color='lightcoral')
+    # Set labels and title for the graph
+    plt.xlabel('Time (seconds)')
+    plt.ylabel('Amplitude')
+    file_name = "_".join(os.path.basename(file).split("_")[:3])
+    plt.title(file_name)
+    plt.grid(True)
+    # Show the graph
+    plt.show()
+
+"""
+locate the target section of the files within the given folder
+i.e. the audio of interest (e.g. meow)
+And then export this section within a 1-2s audio clip
+
+    folder: the path to the folder containing the wav files
+"""
+def locate_export_all_target_sections(folder: str) -> None:
+    # get all the files in the folder 
+    # including within subfolders (from the file catalog),
+    # only the files that are not in the ignored categories
+    all_files = ch.list_files(folder, exclude_categories=IGNORE_CATEGORIES)
+    # locate and export the target section of each changed file, spread over the worker processes
+    mh.run_incremental(MANIFEST_NAME, locate_export_target_section, all_files, STAGE_PARAMS)
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
 #---------------------------------------#
\ No newline at end of file
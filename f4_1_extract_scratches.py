@@ -1,213 +1,281 @@
-"""
-Extract the first round of target sounds as normal
-Remove those sounds from the files, and re-run the process with the altered files
-   - normalise the files
-   - extract the target sounds
-
-name as: board-scratch-2ndpass_1_0.wav
-"""
-# Internal helpers and definitions
-import h_folder_nav_helpers as fh
-import h_FOLDER_DEFINITIONS as fdef
-# folder navigation modules
-import os
-# audio processing modules
-from pydub import AudioSegment
-import librosa
-from pydub.effects import normalize
-# display the wav files amp
-import matplotlib.pyplot as plt
-import numpy as np
-import math
-from scipy.io import wavfile
-
-#---------------------------------------#
-# CONSTANT DEFINITIONS                  #
-#---------------------------------------#
-# path to the amp normalised data folder (source)
-SOURCE_FOLDER = fdef.AMP_NORM_DATA_FOLDER
-# path to the cetered and trimed data folder (destination)
-DEST_FOLDER = fdef.TARGETED_1_2S_DATA_FOLDER
-# the categories that we want to process
-# we normaly wish to target the "scratch" sounds as 
-# those are the sounds with multiple useful snippets
-CATEGORIES_TO_PROCESS = ["soft-scratch", "hard-scratch", "board-scratch", "pole-scratch"]
-#---------------------------------------#
-
-#---------------------------------------#
-# GRAPH DISPLAY OPTIONS                 #
-#---------------------------------------#
-# the files that are to be graphed
-WAVS_TO_SHOW = [1, 2, 3, 4, 5, 6, 7, 8]
-# whether to show the graphs of the audio files being normaised
-SHOW_SHIFTED_GRAPHS = True
-#---------------------------------------#
-
-#---------------------------------------#
-# SECOND PASS OPTIONS                   #
-#---------------------------------------#
-# addtional tag to add to the end of the file name to signify that it is the 2nd pass
-ADDITIONAL_2ND_PASS_TAG = "2ndpass"
-# the min file length inorder to preform a second pass
-MIN_SECONDS_TO_DO_SECOND_PASS = 1.0
-#---------------------------------------#
-
-#---------------------------------------#
-# GOBAL VARIABLE TRACKERS               #
-#---------------------------------------#
-files_transformed = 0
-#---------------------------------------#
-
-
-
-"""
-main function
-"""
-def main():
-    #fh.clean_folder(DEST_FOLDER)
-    fh.clean_folder(fdef.TEMP_FOLDER)
-    extract_target_all(SOURCE_FOLDER)
-    normalise_amp_of_temp_files(fdef.EMP_LEFTOVER_FOLDER, fdef.TEMP_NORMALISED_FOLDER)
-    extract_target_all(fdef.TEMP_NORMALISED_FOLDER, ADDITIONAL_2ND_PASS_TAG)
-
-
-
-"""
-convert all the audio files in the folder to have normalised amplitude
-And export the converted files to the temp normalised folder.
-"""
-def normalise_amp_of_temp_files(left_over_folder, normalised_folder):
-    # get all the files in the folder 
-    # including within subfolders
-    all_files = fh.make_path_list(left_over_folder)
-    
-    # for each of the files, convert it in place
-    for file in all_files:
-        normalise_amp_of_file(file, normalised_folder)
-
-"""
-convert the given wav file to have a normalised amplitude
-ranging from -1 to 1
-"""
-def normalise_amp_of_file(file, normalised_folder): 
-    # normalise the amplitude of the audio file
-    audio = AudioSegment.from_file(file)
-    normalized_audio = normalize(audio, headroom=1.0)
-    output_path = fh.save_new_wav(file, normalized_audio, 
-                                  normalised_folder, generate_output_file_name, "do_nothing")
-
-"""
-extract the target section of the given file to a new file
-"""
-def extract_target_file(file, tag=None):
-    # Load the WAV file using PyDub
-    audio_file = AudioSegment.from_wav(file)
-
-    # Convert the audio into a NumPy array
-    audio_array = np.array(audio_file.get_array_of_samples()) / fdef.MAX_16BIT_AMP
-    # Find the indices where the audio exceeds 0.5 amplitude
-    exceeding_indices = np.where(np.abs(audio_array) > 0.5)[0]
-
-    if len(exceeding_indices) == 0:
-        print(f"File {file} has no audio exceeding 0.5 amplitude")
-        return
-
-    # Calculate the time at which the audio first exceeds 0.5 amplitude
-    first_exceeding_time = exceeding_indices[0] / audio_file.frame_rate
-    # Calculate the time at which the audio last exceeds 0.5 amplitude
-    last_exceeding_time = exceeding_indices[-1] / audio_file.frame_rate
-
-    target_start = max(0, first_exceeding_time - fdef.LEAD_IN_TIME)
-    target_end = min(last_exceeding_time + fdef.LEAD_IN_TIME, audio_file.duration_seconds)
-
-    # extract and export only the target section
-    target_audio = audio_file[target_start * 1000 : target_end * 1000]  
-    output_path = extract_export_target_audio(target_audio, file, tag)
-
-    # update the file count
-    global files_transformed
-    files_transformed += 1
-    print(f"Number of files transformed: {files_transformed}", end='\r')
-
-    # export the audio with the target section removed
-    export_leftover_audio(file, audio_file, target_start, target_end, tag)
-
-    # we will display a subset of the converted wav files
-    if SHOW_SHIFTED_GRAPHS and files_transformed in WAVS_TO_SHOW:
-        # plot the target section
-        # compare the old and new file
-        fh.compare_waves_graph(file, output_path, first_exceeding_time, last_exceeding_time)
-    
-"""
-export the left over audio (where the target audio has been removed)
-to a new file
-"""
-def export_leftover_audio(file, audio_file, target_start, target_end, tag):
-    # get the leftover sections
-    left_audio = audio_file[: target_start* 1000]
-    right_audio = audio_file[target_end* 1000 :]
-    left_over_audio = left_audio + right_audio
-
-    # export the leftover sections
-    if left_over_audio.duration_seconds > MIN_SECONDS_TO_DO_SECOND_PASS:
-        output_path = fh.save_new_wav(file, left_over_audio, 
-                            fdef.TEMP_LEFTOVER_FOLDER, generate_output_file_name, tag)
-
-"""
-export the target audio to a new file
-"""
-def extract_export_target_audio(target_audio, file, tag=None):
-    current_duration = target_audio.duration_seconds
-
-    # if the target secion is too long we cut the ends   
-    if current_duration > fdef.MAX_LENGTH_S:
-        cut_start = int((current_duration - fdef.MAX_LENGTH_S) * 500)
-        cut_end = int((current_duration - fdef.MAX_LENGTH_S) * 500)
-
-        target_audio = target_audio[cut_start:-cut_end]
-
-    # if the target secion is too short we add padding
-    elif current_duration < fdef.MIN_LENGTH_S:
-        padding_duration = fdef.MIN_LENGTH_S - current_duration
-        padding_start = int(padding_duration * 500)  # Half of the padding duration in milliseconds
-        padding_end = int(padding_duration * 500)
-        
-        padded_audio = AudioSegment.silent(padding_start) + target_audio + AudioSegment.silent(padding_end)
-        target_audio = padded_audio[:fdef.MIN_LENGTH_S * 1000]  # Truncate to the exact target duration
-
-
-    # export the file
-    output_path = fh.save_new_wav(file, target_audio, 
-                            DEST_FOLDER, generate_output_file_name, tag)
-    return output_path
-
-"""
-generate the output file path
-"""
-def generate_output_file_name(file_name, tag=None): 
-    if not tag: # board-scratch_1_0_centered_1-2s.wav
-        return f"{file_name}_centered_1-2s.wav"
-    elif tag == ADDITIONAL_2ND_PASS_TAG: # board-scratch_1_0_centered_1-2s_2ndpass.wav
-        return f"{file_name}_{tag}.wav"
-    else: # if we do not want to change the file name
-        return file_name
-
-"""
-center all the files around the "sound of interest"
-and trim the files to be 2 seconds long
-"""
-def extract_target_all(folder, tag=None):
-    # get all the files in the folder 
-    # including within subfolders
-    all_files = fh.make_path_list(folder)
-    
-    # for each of the files, convert it in place
-    for file in all_files:
-        if fh.get_category(file) in CATEGORIES_TO_PROCESS:
-            extract_target_file(file, tag)
-
-
-
-#---------------------------------------#
-main()
-#---------------------------------------#
\ No newline at end of file
+"""
+Extract up to MAX_PASSES target sounds from each file, all from a single decode.
+
+The first pass extracts the target sound as normal. Each following pass looks
+for the next target sound in the audio that has not been extracted yet (the
+unclaimed regions), as if that left over audio had been joined together and
+re-normalised. The normalisation is only applied to the threshold and to the
+extracted clips, the left over audio is never rewritten.
+
+name as: board-scratch_000001_001_mono_16khz_normalised_centered_1-2s_2ndpass.wav
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_parallel_helpers as ph
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+import h_instrumentation_helpers as ih
+import h_writer_helpers as wh
+# the target locating of f4_0
+import f4_0_extract_1_2s_target_sound as f4_0
+# folder navigation modules
+import os
+# audio processing modules
+import numpy as np
+import math
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS                  #
+#---------------------------------------#
+# path to the amp normalised data folder (source)
+SOURCE_FOLDER = fdef.AMP_NORM_DATA_FOLDER
+# path to the cetered and trimed data folder (destination)
+DEST_FOLDER = fdef.TARGETED_1_2S_DATA_FOLDER
+# the categories that we want to process
+# we normaly wish to target the "scratch" sounds as
+# those are the sounds with multiple useful snippets
+CATEGORIES_TO_PROCESS = ["soft-scratch", "hard-scratch", "board-scratch", "pole-scratch"]
+#---------------------------------------#
+
+#---------------------------------------#
+# GRAPH DISPLAY OPTIONS                 #
+#---------------------------------------#
+# the files that are to be graphed
+WAVS_TO_SHOW = [1, 2, 3, 4, 5, 6, 7, 8]
+# whether to show the graphs of the audio files being normaised
+SHOW_SHIFTED_GRAPHS = True
+#---------------------------------------#
+
+#---------------------------------------#
+# MULTI PASS OPTIONS                    #
+#---------------------------------------#
+# the max number of target sounds to extract from each file
+MAX_PASSES = 2
+# the min length of the unclaimed audio inorder to preform another pass
+MIN_SECONDS_TO_DO_NEXT_PASS = 1.0
+# the headroom the left over audio is (virtually) normalised to before each pass
+NEXT_PASS_HEADROOM = 1.0
+# the name of the manifest of this stage
+MANIFEST_NAME = "f4_1_targeted_1-2s"
+# the parameters that affect the output files
+STAGE_PARAMS = {"LEAD_IN_TIME": fdef.LEAD_IN_TIME, "MAX_LENGTH_S": fdef.MAX_LENGTH_S,
+                "MIN_LENGTH_S": fdef.MIN_LENGTH_S, "threshold": f4_0.TARGET_AMP_THRESHOLD,
+                "MAX_PASSES": MAX_PASSES, "MIN_SECONDS_TO_DO_NEXT_PASS": MIN_SECONDS_TO_DO_NEXT_PASS,
+                "NEXT_PASS_HEADROOM": NEXT_PASS_HEADROOM}
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    extract_target_all(SOURCE_FOLDER)
+
+
+
+"""
+extract the target sections of the given file to new files
+
+    file: the path to the wav file
+
+    returns: the paths to the exported files
+"""
+def extract_target_file(file):
+    # Load the WAV file (memory mapped)
+    samples, sample_rate = fh.load_wav_samples(file)
+
+    with ih.span("transform"):
+        samples = fh.to_mono_samples(samples)
+        targets = extract_target_samples(samples, sample_rate)
+    if not targets:
+        print(f"File {file} has no audio exceeding {f4_0.TARGET_AMP_THRESHOLD} amplitude")
+        return []
+
+    # export all the target sections
+    output_paths = [fh.save_new_wav_samples(file, target_samples, sample_rate,
+                                            DEST_FOLDER, generate_output_file_name, pass_tag)
+                    for pass_tag, target_samples, _ in targets]
+
+    # we will display a subset of the converted wav files
+    if SHOW_SHIFTED_GRAPHS and ih.get_file_num() in WAVS_TO_SHOW and not ph.IS_WORKER_PROCESS:
+        # plot the first target section
+        # compare the old and new file
+        first_exceeding_time, last_exceeding_time = targets[0][2]
+        # the new file(s) may still be being written in the background
+        wh.wait_for_writes()
+        fh.compare_extracted_target_graph(file, output_paths[0], first_exceeding_time, last_exceeding_time)
+
+    return output_paths
+
+"""
+extract up to MAX_PASSES target sections from the given samples.
+After each pass the extracted section is removed from the unclaimed regions,
+the next pass searches the unclaimed regions as if they were joined together
+and normalised (so the lead in / out can run across a removed section).
+
+    samples: the mono int16 samples
+    sample_rate: the sampling frequency of the samples
+
+    returns: a list of (pass tag, 1-2s int16 target samples,
+             (first_exceeding_time, last_exceeding_time)), the times are
+             only meaningful for the first pass
+"""
+def extract_target_samples(samples, sample_rate):
+    # the (start, end) sample indices of the audio not yet extracted
+    unclaimed = [(0, len(samples))]
+    lead_in = int(fdef.LEAD_IN_TIME * sample_rate)
+    amp_threshold = fh.amp_to_int_threshold(f4_0.TARGET_AMP_THRESHOLD)
+
+    targets = []
+    for pass_num in range(1, MAX_PASSES + 1):
+        unclaimed_length = get_unclaimed_length(unclaimed)
+        if pass_num > 1 and unclaimed_length / sample_rate <= MIN_SECONDS_TO_DO_NEXT_PASS:
+            break
+
+        # the first pass is on the (already normalised) audio as is,
+        # the later passes on the left over audio normalised again
+        gain_db = 0.0
+        if pass_num > 1:
+            peak = max(fh.peak_of_samples(samples[start:end]) for start, end in unclaimed)
+            gain_db = fh.peak_normalise_gain_db(peak, NEXT_PASS_HEADROOM)
+        # the samples whose gained value exceeds the threshold, without gaining them
+        thresholds = fh.gained_thresholds(amp_threshold, gain_db)
+
+        exceeding = find_unclaimed_first_last_exceeding(samples, unclaimed, thresholds)
+        if exceeding is None:
+            break
+        first_exceeding, last_exceeding = exceeding
+
+        # the target section within the joined unclaimed audio, accounting for lead in
+        target_start = max(0, first_exceeding - lead_in)
+        target_end = min(last_exceeding + 1 + lead_in, unclaimed_length)
+        target_samples = gather_unclaimed(samples, unclaimed, target_start, target_end)
+        if gain_db != 0.0:
+            target_samples = fh.apply_gain_samples(target_samples, gain_db)
+        target_samples = f4_0.fit_target_samples(target_samples, 0, len(target_samples), sample_rate)
+
+        targets.append((generate_pass_tag(pass_num), target_samples,
+                        (first_exceeding / sample_rate, last_exceeding / sample_rate)))
+        unclaimed = claim_unclaimed(unclaimed, target_start, target_end)
+
+    return targets
+
+"""
+find the total length of the unclaimed regions
+
+    unclaimed: the list of (start, end) sample indices
+
+    returns: the number of samples
+"""
+def get_unclaimed_length(unclaimed):
+    return sum(end - start for start, end in unclaimed)
+
+"""
+find the first and last sample exceeding the threshold within the unclaimed
+regions. Only the regions before the first and after the last hit are scanned.
+
+    samples: the mono int16 samples
+    unclaimed: the list of (start, end) sample indices
+    thresholds: the (upper, lower) int sample thresholds (see fh.gained_thresholds)
+
+    returns: (first index, last index) within the joined unclaimed audio,
+             or None if no sample exceeds the threshold
+"""
+def find_unclaimed_first_last_exceeding(samples, unclaimed, thresholds):
+    upper, lower = thresholds
+    # the position of each region within the joined unclaimed audio
+    offsets = np.cumsum([0] + [end - start for start, end in unclaimed])
+
+    first = None
+    for (start, end), offset in zip(unclaimed, offsets):
+        index = fh.find_exceeding(samples[start:end], upper, lower_threshold=lower)
+        if index is not None:
+            first = offset + index
+            break
+    if first is None:
+        return None
+
+    for (start, end), offset in zip(reversed(unclaimed), reversed(offsets[:-1])):
+        index = fh.find_exceeding(samples[start:end], upper, from_back=True, lower_threshold=lower)
+        if index is not None:
+            return int(first), int(offset + index)
+
+"""
+join together the section [target_start, target_end) of the joined unclaimed audio
+
+    returns: the int16 samples of the section
+"""
+def gather_unclaimed(samples, unclaimed, target_start, target_end):
+    sections = []
+    offset = 0
+    for start, end in unclaimed:
+        # the overlap of this region with the section
+        section_start = max(target_start - offset, 0)
+        section_end = min(target_end - offset, end - start)
+        if section_start < section_end:
+            sections.append(samples[start + section_start : start + section_end])
+        offset += end - start
+    return np.concatenate(sections)
+
+"""
+remove the section [target_start, target_end) of the joined unclaimed audio
+from the unclaimed regions
+
+    returns: the new list of (start, end) sample indices
+"""
+def claim_unclaimed(unclaimed, target_start, target_end):
+    new_unclaimed = []
+    offset = 0
+    for start, end in unclaimed:
+        length = end - start
+        # keep the parts of this region before and after the section
+        if target_start - offset > 0:
+            new_unclaimed.append((start, start + min(target_start - offset, length)))
+        if target_end - offset < length:
+            new_unclaimed.append((start + max(target_end - offset, 0), end))
+        offset += length
+    return new_unclaimed
+
+"""
+generate the tag of the given pass, e.g. "2ndpass"
+(the first pass has no tag)
+"""
+def generate_pass_tag(pass_num):
+    if pass_num == 1:
+        return None
+    if pass_num % 100 in (11, 12, 13):
+        suffix = "th"
+    else:
+        suffix = {1: "st", 2: "nd", 3: "rd"}.get(pass_num % 10, "th")
+    return f"{pass_num}{suffix}pass"
+
+"""
+generate the output file path
+"""
+def generate_output_file_name(file_name, tag=None):
+    if not tag: # board-scratch_1_0_centered_1-2s.wav
+        return f"{file_name}_centered_1-2s.wav"
+    else: # board-scratch_1_0_centered_1-2s_2ndpass.wav
+        return f"{file_name}_centered_1-2s_{tag}.wav"
+
+"""
+center all the files around the "sound of interest"
+and trim the files to be 2 seconds long
+"""
+def extract_target_all(folder):
+    # get all the files in the folder
+    # including within subfolders (from the file catalog),
+    # only the categories that we want to process
+    all_files = ch.list_files(folder, categories=CATEGORIES_TO_PROCESS)
+
+    # extract the target sections of each changed file, spread over the worker processes
+    mh.run_incremental(MANIFEST_NAME, extract_target_file, all_files, STAGE_PARAMS)
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
@@ -1,173 +1,259 @@
-# Internal helpers and definitions
-import h_folder_nav_helpers as fh
-import h_FOLDER_DEFINITIONS as fdef
-# folder navigation modules
-import os
-# audio processing modules
-from pydub import AudioSegment
-# display the wav files amp
-import matplotlib.pyplot as plt
-import numpy as np
-import math
-from scipy.io import wavfile
-
-
-
-#---------------------------------------#
-# AMPLLITUDE MODULATION OPTIONS         #
-#---------------------------------------#
-# the amps which we wish to perturb the audio files by
-# largest to smallest
-AMPS_TO_PERTURB_DB = [15, 5, 0, -5, -15]
-#---------------------------------------#
-
-#---------------------------------------#
-# CONSTANT DEFINITIONS                  #
-#---------------------------------------#
-# path to the targeted and trimed data folder 
-SOURCE_FOLDER = fdef.TARGETED_1_2S_DATA_FOLDER
-# path to the perturbed amps data folder 
-DEST_FOLDER = fdef.PERTURBED_AMP_DATA_FOLDER
-# the categories that we want to process
-# if none, then all categories will be processed
-CATEGORIES_TO_PROCESS = None
-# if we wish to first clean out the destionation folder
-CLEAN_DEST = False
-#---------------------------------------#
-
-#---------------------------------------#
-# GRAPH DISPLAY OPTIONS                 #
-#---------------------------------------#
-# the files that are to be graphed
-WAVS_TO_SHOW = [1, 2, 3, 4, 5]
-# whether to show the graphs of the audio files being normaised
-SHOW_DIFF_AMP_GRAPHS = True
-# the colours for the diff amp graphs
-DIFF_AMP_COLOURS = ['lightcoral', 'orange', 'darkseagreen', 
-                    'lightskyblue', 'plum']
-#---------------------------------------#
-
-#---------------------------------------#
-# GOBAL VARIABLE TRACKERS               #
-#---------------------------------------#
-files_transformed = 0
-#---------------------------------------#
-
-
-
-"""
-main function
-"""
-def main():
-    if CLEAN_DEST: 
-        fh.clean_folder(DEST_FOLDER)
-    perturb_amp_of_all_files(SOURCE_FOLDER)
-
-
-
-"""
-generate 5 new wav files at differnt amplitudes
-"""
-def perturb_amp_of_file(file): 
-    new_files = []
-    # create the 5 new audio files
-    for amp in AMPS_TO_PERTURB_DB:
-        # perturb the amplitude of the audio file
-        audio = AudioSegment.from_file(file)
-
-        # apply db change to the audio file
-        perturbed_audio = audio.apply_gain(amp)  
-        # generate a tag for that amp perturbation
-        amp_pert_tag = generate_amp_pert_tag(amp)
-
-        # save the new audio file
-        output_path = fh.save_new_wav(file, perturbed_audio, DEST_FOLDER, 
-                                      generate_output_file_name, amp_pert_tag) 
-        # add the new file to the list of files generated from that snippit
-        new_files.append(output_path) 
-
-    # update the file count
-    global files_transformed
-    files_transformed += 1
-    print(f"Number of files transformed: {files_transformed}", end='\r')
-
-    # we will display a subset of the converted wav files
-    if SHOW_DIFF_AMP_GRAPHS and files_transformed in WAVS_TO_SHOW:
-        display_diff_amps_graph(new_files)
-        
-
-"""
-generate the amp perturbation tag
-that will go onto the file name
-"""
-def generate_amp_pert_tag(amp):
-    if amp < 0: # if the amp is a decrease
-        tag = f"-{abs(amp):02}dB"
-    else: # if the amp is a increase
-        tag = f"+{abs(amp):02}dB"
-    return tag
-
-
-"""
-generate the output file path
-"""
-def generate_output_file_name(file_name, end_tag=""): 
-    name_sections = file_name.split("_")
-    source_info = "_".join(name_sections[:3])
-    property_info = "_".join(name_sections[3:])
-    return f"{source_info}_{end_tag}_{property_info}.wav"
-
-
-
-"""
-convert all the audio files in the folder to have normalised amplitude
-"""
-def perturb_amp_of_all_files(folder):
-    # get all the files in the folder 
-    # including within subfolders
-    all_files = fh.make_path_list(folder)
-    
-    # for each of the files, convert it in place
-    for file in all_files:
-        if not CATEGORIES_TO_PROCESS or fh.get_category(file) in CATEGORIES_TO_PROCESS:
-            perturb_amp_of_file(file)
-
-"""
-display the amp graphs of the given files
-all the perturbations (files in list) will be overlayed on top of eachother
-"""
-def display_diff_amps_graph(files):
-    # for each of the generated audio files
-    for i, file in enumerate(files):
-        # Load the audio file
-        sample_rate, audio_data = wavfile.read(file)
-        # Extract the amplitude values
-        amplitude = audio_data / fdef.MAX_16BIT_AMP
-        # Create the time axis
-        time = np.arange(0, len(amplitude)) / sample_rate
-
-        # we want to overlay the amps on top of eachother
-        # the label will be the associated amp perterbation
-        plt.plot(time, amplitude, color=DIFF_AMP_COLOURS[i], 
-                 label=f"{AMPS_TO_PERTURB_DB[i]}dB")
-
-    plt.xlabel('Time (s)')
-    plt.ylabel('Amplitude')
-    plt.grid(True)
-
-    # Display the legend
-    plt.legend(loc='upper right', title='Legend', fontsize='medium')
-    # put the title as the file source part of the file name
-    file_name = "_".join(os.path.basename(files[0]).split("_")[:3])
-    plt.suptitle(file_name)
-    # Adjust the spacing between subplots
-    plt.tight_layout()
-
-    # Display the plot
-    plt.show()
-
-
-
-#---------------------------------------#
-main()
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_parallel_helpers as ph
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+import h_instrumentation_helpers as ih
+import h_writer_helpers as wh
+import h_shard_helpers as sh
+# folder navigation modules
+import os
+# audio processing modules
+import numpy as np
+
+
+
+#---------------------------------------#
+# AMPLLITUDE MODULATION OPTIONS         #
+#---------------------------------------#
+# the amps which we wish to perturb the audio files by
+# largest to smallest
+AMPS_TO_PERTURB_DB = [15, 5, 0, -5, -15]
+#---------------------------------------#
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS                  #
+#---------------------------------------#
+# path to the targeted and trimed data folder 
+SOURCE_FOLDER = fdef.TARGETED_1_2S_DATA_FOLDER
+# path to the perturbed amps data folder 
+DEST_FOLDER = fdef.PERTURBED_AMP_DATA_FOLDER
+# how the perturbed clips are written
+# "wav": one wav file per clip in DEST_FOLDER
+# "shards": packed into memory mappable shards in PACKED_DEST_FOLDER
+OUTPUT_FORMAT = "wav"
+# path to the packed shards folder (for the "shards" output format)
+PACKED_DEST_FOLDER = fdef.PACKED_AMP_DATA_FOLDER
+# the sample rate of the clips (for the "shards" output format)
+SAMPLE_RATE = 16000
+# the categories that we want to process
+# if none, then all categories will be processed
+CATEGORIES_TO_PROCESS = None
+# if we wish to first clean out the destionation folder
+CLEAN_DEST = False
+# the name of the manifest of this stage
+MANIFEST_NAME = "f5_amp_perturbed"
+# the parameters that affect the output files
+STAGE_PARAMS = {"AMPS_TO_PERTURB_DB": AMPS_TO_PERTURB_DB}
+#---------------------------------------#
+
+#---------------------------------------#
+# GRAPH DISPLAY OPTIONS                 #
+#---------------------------------------#
+# the files that are to be graphed
+WAVS_TO_SHOW = [1, 2, 3, 4, 5]
+# whether to show the graphs of the audio files being normaised
+SHOW_DIFF_AMP_GRAPHS = True
+# the colours for the diff amp graphs
+DIFF_AMP_COLOURS = ['lightcoral', 'orange', 'darkseagreen', 
+                    'lightskyblue', 'plum']
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    if OUTPUT_FORMAT == "shards":
+        pack_perturbed_amp_of_all_files(SOURCE_FOLDER)
+        return
+    if CLEAN_DEST: 
+        fh.clean_folder(DEST_FOLDER)
+    perturb_amp_of_all_files(SOURCE_FOLDER)
+
+
+
+"""
+generate 5 new wav files at differnt amplitudes
+
+    file: the path to the wav file
+
+    returns: the paths to the perturbed files
+"""
+def perturb_amp_of_file(file): 
+    new_files = []
+    samples, sample_rate = fh.load_wav_samples(file)
+    with ih.span("transform"):
+        perturbed = perturb_samples(samples)
+    # create the 5 new audio files
+    for amp_pert_tag, perturbed_samples in perturbed:
+        # save the new audio file
+        output_path = fh.save_new_wav_samples(file, perturbed_samples, sample_rate, DEST_FOLDER, 
+                                              generate_output_file_name, amp_pert_tag) 
+        # add the new file to the list of files generated from that snippit
+        new_files.append(output_path) 
+
+    # we will display a subset of the converted wav files
+    if SHOW_DIFF_AMP_GRAPHS and ih.get_file_num() in WAVS_TO_SHOW and not ph.IS_WORKER_PROCESS:
+        # the new file(s) may still be being written in the background
+        wh.wait_for_writes()
+        display_diff_amps_graph(new_files)
+
+    return new_files
+        
+
+"""
+perturb the amplitude of the given samples by each of the AMPS_TO_PERTURB_DB
+
+    samples: the int16 samples to perturb
+
+    returns: a list of (amp perturbation tag, perturbed int16 samples)
+"""
+def perturb_samples(samples):
+    return perturb_samples_batch([samples])[0]
+
+"""
+perturb the amplitude of a batch of clips by each of the AMPS_TO_PERTURB_DB.
+The clips are joined into one buffer and all the gains are applied to it
+in a single broadcast operation.
+
+    clips: a list of int16 sample arrays (with the same number of channels)
+
+    returns: for each clip, a list of (amp perturbation tag, perturbed int16 samples)
+"""
+def perturb_samples_batch(clips):
+    if not clips:
+        return []
+    amp_pert_tags = [generate_amp_pert_tag(amp) for amp in AMPS_TO_PERTURB_DB]
+
+    # apply all the db changes to all the clips at once
+    perturbed = fh.apply_gains_samples(np.concatenate(clips), AMPS_TO_PERTURB_DB)
+
+    # split the perturbed buffer back into the clips
+    offsets = np.cumsum([len(clip) for clip in clips])[:-1]
+    return [list(zip(amp_pert_tags, clip_perturbed))
+            for clip_perturbed in np.split(perturbed, offsets, axis=1)]
+
+"""
+generate the amp perturbation tag
+that will go onto the file name
+"""
+def generate_amp_pert_tag(amp):
+    if amp < 0: # if the amp is a decrease
+        tag = f"-{abs(amp):02}dB"
+    else: # if the amp is a increase
+        tag = f"+{abs(amp):02}dB"
+    return tag
+
+
+"""
+generate the output file path
+"""
+def generate_output_file_name(file_name, end_tag=""): 
+    name_sections = file_name.split("_")
+    source_info = "_".join(name_sections[:3])
+    property_info = "_".join(name_sections[3:])
+    return f"{source_info}_{end_tag}_{property_info}.wav"
+
+
+
+"""
+convert all the audio files in the folder to have normalised amplitude
+"""
+def perturb_amp_of_all_files(folder):
+    # get all the files in the folder 
+    # including within subfolders (from the file catalog),
+    # only the categories that we want to process
+    all_files = ch.list_files(folder, categories=CATEGORIES_TO_PROCESS)
+
+    # perturb each of the changed files, spread over the worker processes
+    mh.run_incremental(MANIFEST_NAME, perturb_amp_of_file, all_files, STAGE_PARAMS)
+
+"""
+generate the perturbed clips of the given file without writing them
+
+    file: the path to the wav file
+
+    returns: a list of (output file name, amp perturbation tag, perturbed int16 samples)
+"""
+def perturb_clips_of_file(file):
+    samples, sample_rate = fh.load_wav_samples(file)
+    if sample_rate != SAMPLE_RATE:
+        raise ValueError(f"File {file} has a sample rate of {sample_rate}, expected {SAMPLE_RATE}")
+
+    with ih.span("transform"):
+        perturbed = perturb_samples(samples)
+    clips = []
+    for amp_pert_tag, perturbed_samples in perturbed:
+        output_path = fh.make_new_wav_path(file, DEST_FOLDER, generate_output_file_name, amp_pert_tag)
+        clips.append((os.path.basename(output_path), amp_pert_tag, perturbed_samples))
+    return clips
+
+"""
+perturb all the audio files in the folder and pack the perturbed clips
+into shards, rather than writing a wav file for each clip.
+The shards are always rebuilt from scratch.
+"""
+def pack_perturbed_amp_of_all_files(folder):
+    # get all the files in the folder 
+    # including within subfolders (from the file catalog),
+    # only the categories that we want to process
+    all_files = ch.list_files(folder, categories=CATEGORIES_TO_PROCESS)
+
+    writer = sh.ShardWriter(PACKED_DEST_FOLDER, int(fdef.MAX_LENGTH_S * SAMPLE_RATE), SAMPLE_RATE)
+
+    # write the clips of each file into the shards as the workers finish them
+    def add_clips_to_shards(file, clips):
+        for file_name, amp_pert_tag, perturbed_samples in clips:
+            writer.add_clip(perturbed_samples, file_name, amp_pert_tag)
+        return len(clips)
+
+    ph.run_file_jobs(perturb_clips_of_file, all_files, on_result=add_clips_to_shards,
+                     stage_name=f"{MANIFEST_NAME}_packed")
+    writer.close()
+    print(f"Packed {writer.num_clips} clips into {writer.shard_num} shards")
+
+"""
+display the amp graphs of the given files
+all the perturbations (files in list) will be overlayed on top of eachother
+"""
+def display_diff_amps_graph(files):
+    import matplotlib.pyplot as plt
+    from scipy.io import wavfile
+    # for each of the generated audio files
+    for i, file in enumerate(files):
+        # Load the audio file
+        sample_rate, audio_data = wavfile.read(file)
+        # Extract the amplitude values
+        amplitude = audio_data / fdef.MAX_16BIT_AMP
+        # Create the time axis
+        time = np.arange(0, len(amplitude)) / sample_rate
+
+        # we want to overlay the amps on top of eachother
+        # the label will be the associated amp perterbation
+        plt.plot(time, amplitude, color=DIFF_AMP_COLOURS[i], 
+                 label=f"{AMPS_TO_PERTURB_DB[i]}dB")
+
+    plt.xlabel('Time (s)')
+    plt.ylabel('Amplitude')
+    plt.grid(True)
+
+    # Display the legend
+    plt.legend(loc='upper right', title='Legend', fontsize='medium')
+    # put the title as the file source part of the file name
+    file_name = "_".join(os.path.basename(files[0]).split("_")[:3])
+    plt.suptitle(file_name)
+    # Adjust the spacing between subplots
+    plt.tight_layout()
+
+    # Display the plot
+    plt.show()
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
 #---------------------------------------#
\ No newline at end of file
@@ -0,0 +1,131 @@
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_parallel_helpers as ph
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+import h_instrumentation_helpers as ih
+import h_feature_helpers as fe
+# folder navigation modules
+import os
+
+
+
+#---------------------------------------#
+# FEATURE OPTIONS                       #
+#---------------------------------------#
+# the sample rate of the clips
+SAMPLE_RATE = 16000
+# the stft window (25ms) and hop (10ms), in samples
+N_FFT = 400
+HOP_LENGTH = 160
+# the mel bands of the log-mel spectrograms
+N_MELS = 64
+FMIN = 20.0
+FMAX = 8000.0
+# the number of MFCCs to also compute from the log-mel spectrograms
+# 0 for only the log-mel spectrograms
+N_MFCC = 0
+# the parameters that affect the features, the features of each set of
+# parameters are kept in their own folder (named by the parameters hash)
+FEATURE_PARAMS = {"sample_rate": SAMPLE_RATE, "n_fft": N_FFT, "hop_length": HOP_LENGTH,
+                  "n_mels": N_MELS, "fmin": FMIN, "fmax": FMAX, "n_mfcc": N_MFCC}
+#---------------------------------------#
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS                  #
+#---------------------------------------#
+# path to the perturbed amps data folder (the final clips)
+SOURCE_FOLDER = fdef.PERTURBED_AMP_DATA_FOLDER
+# path to the features folder
+DEST_FOLDER = fdef.FEATURES_DATA_FOLDER
+# the categories that we want to process
+# if none, then all categories will be processed
+CATEGORIES_TO_PROCESS = None
+# the max clips whose features are computed together
+FEATURE_BATCH_FILES = 256
+# the name of the manifest of this stage
+# (only used to keep the content hash of each clip between runs)
+MANIFEST_NAME = "f6_log_mel_features"
+#---------------------------------------#
+
+
+
+"""
+main function
+"""
+def main():
+    extract_features_of_all_files(SOURCE_FOLDER)
+
+
+
+"""
+compute the features of a batch of clips (a batch job, see ph.run_file_jobs)
+
+    files: the paths to the wav files
+
+    returns: a list of (log-mel, mfcc or None) of each file
+"""
+def extract_features_of_files(files):
+    clips = []
+    for file in files:
+        with ih.batch_file(file):
+            samples, sample_rate = fh.load_wav_samples(file)
+        if sample_rate != SAMPLE_RATE:
+            raise ValueError(f"File {file} has a sample rate of {sample_rate}, expected {SAMPLE_RATE}")
+        if samples.shape[1] != 1:
+            raise ValueError(f"File {file} has {samples.shape[1]} channels, expected mono")
+        clips.append(samples[:, 0])
+
+    with ih.span("transform"):
+        return fe.compute_features_batch(clips, FEATURE_PARAMS)
+
+"""
+find the folder the features of the current FEATURE_PARAMS are kept in
+"""
+def get_store_folder():
+    return os.path.join(DEST_FOLDER, mh.hash_params(FEATURE_PARAMS)[:16])
+
+"""
+compute the features of all the clips in the folder that are not in the
+feature store yet (by content hash), then write the dataset index of all the clips
+"""
+def extract_features_of_all_files(folder):
+    # get all the files in the folder
+    # including within subfolders (from the file catalog),
+    # only the categories that we want to process
+    all_files = sorted(ch.list_files(folder, categories=CATEGORIES_TO_PROCESS))
+
+    # the content hash of each clip, only rehashed if the file has changed
+    manifest = mh.load_manifest(MANIFEST_NAME)
+    file_infos = {file: mh.get_file_info(file, manifest.get(file)) for file in all_files}
+
+    store = fe.FeatureStore(get_store_folder(), FEATURE_PARAMS)
+    # only one clip of each content is computed
+    files_to_process = list({file_infos[file]["hash"]: file for file in reversed(all_files)
+                             if not store.has_clip(file_infos[file]["hash"])}.values())[::-1]
+    print(f"Skipping {len(all_files) - len(files_to_process)} clips with cached features, "
+          f"processing {len(files_to_process)} clips")
+
+    # add the features of each clip to the store as the workers finish them
+    max_frames = fe.get_max_frames(FEATURE_PARAMS, fdef.MAX_LENGTH_S)
+    def add_features_to_store(file, features):
+        log_mel, mfcc = features
+        store.add_clip(file_infos[file]["hash"], log_mel, mfcc, max_frames)
+
+    ph.run_file_jobs(extract_features_of_files, files_to_process, on_result=add_features_to_store,
+                     stage_name=MANIFEST_NAME, batch_files=FEATURE_BATCH_FILES)
+    store.close()
+
+    store.write_dataset_index([{"file_name": os.path.basename(file),
+                                "category": os.path.relpath(os.path.dirname(file), folder),
+                                "content_hash": file_infos[file]["hash"]} for file in all_files])
+    mh.save_manifest(MANIFEST_NAME, file_infos)
+    print(f"Features of {len(all_files)} clips in {store.store_folder} ({store.num_shards} shards)")
+
+
+
+#---------------------------------------#
+if __name__ == "__main__":
+    main()
+#---------------------------------------#
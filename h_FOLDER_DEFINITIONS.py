@@ -1,75 +1,198 @@
-"""
-NOTE that all paths are relative to the catscat_datacollection folder
-found at "DD-Data/non-final-data/catscat_datacollection"
-"""
-
-
-
-
-#---------------------------------------#
-# CONSTANT DEFINITIONS
-#---------------------------------------#
-# the max amplitude of a 16 bit wav file
-MAX_16BIT_AMP = 32768.0
-
-# the time in seconds to lead in and out of the sound of interest
-LEAD_IN_TIME = 0.2
-# max length that we want our audio files
-MAX_LENGTH_S = 2.0
-# min length that we want our audio files
-MIN_LENGTH_S = 1.0
-
-
-
-#---------------------------------------#
-# DATA COLLECTION FOLDER PATHS
-#---------------------------------------#
-# Path to the raw data
-RAW_DATA_FOLDER = "../raw-data"
-
-# Location of the clean data folder within raw data folder structure
-CLEAN_DATA_LOCATION = "clean"
-
-# Path to the final data
-FINAL_DATA_FOLDER = '../../data'
-
-
-
-#---------------------------------------#
-# DATA PROCESSING FOLDER PATHS
-#---------------------------------------#
-# path to the mono, 16kHz transformed data folder
-MONO_16KHZ_DATA_FOLDER = '../../transformed-data/mono_16khz'
-
-# path to the normalised amplitude data folder
-AMP_NORM_DATA_FOLDER = '../../transformed-data/amp_normalised'
-
-# path to the targeted and trimed data folder
-TARGETED_1_2S_DATA_FOLDER = '../../transformed-data/targeted_1-2s'
-
-# path to the perturbed amplitudes data folder
-PERTURBED_AMP_DATA_FOLDER = '../../transformed-data/amp_perturbed'
-
-
-
-#---------------------------------------#
-# TEMPORARY DATA STORAGE FOLDER PATHS        
-#---------------------------------------#
-# folder to store the temp intermediate files
-# these are used to store the leftover audio after the 
-# target section has been extracted
-TEMP_LEFTOVER_FOLDER = "../temp/temp_leftover"
-TEMP_NORMALISED_FOLDER = "../temp/temp_norm"
-TEMP_FOLDER = "../temp"
-#---------------------------------------#
-
-
-
-#---------------------------------------#
-# TESTING
-#---------------------------------------#
-# path to the testing folder with small subset of data
-TEST_DATA_FOLDER = '../test-data'
-TEST_DEST_FOLDER = '../test-dest'
-
-
+"""
+NOTE that all paths are relative to the catscat_datacollection folder
+found at "DD-Data/non-final-data/catscat_datacollection"
+"""
+
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the max amplitude of a 16 bit wav file
+MAX_16BIT_AMP = 32768.0
+
+# the time in seconds to lead in and out of the sound of interest
+LEAD_IN_TIME = 0.2
+# max length that we want our audio files
+MAX_LENGTH_S = 2.0
+# min length that we want our audio files
+MIN_LENGTH_S = 1.0
+
+
+
+#---------------------------------------#
+# PARALLEL PROCESSING OPTIONS
+#---------------------------------------#
+# number of processes used to run the per-file stage loops
+# 1 runs the files serially, None uses all the cores
+NUM_WORKERS = 1
+# small files are batched together into chunks of roughly this many bytes
+# so that the workers are not dominated by the scheduling overhead
+CHUNK_TARGET_BYTES = 8 * 1024 * 1024
+# the max number of files to put into a single chunk
+MAX_FILES_PER_CHUNK = 64
+# whether the stages hand their files out through a work queue on the shared
+# WORK_QUEUE_FOLDER, so workers on other hosts can take part (see h_work_queue_helpers)
+DISTRIBUTED_RUNS = False
+
+
+
+#---------------------------------------#
+# INCREMENTAL RUN OPTIONS
+#---------------------------------------#
+# whether the stages should only process the inputs that have changed
+# since the last run (tracked in the per-stage manifests)
+INCREMENTAL_RUNS = True
+# whether the stages carry on from where a killed run stopped (tracked in
+# the per-stage run journals), rather than starting over
+RESUME_RUNS = False
+
+
+
+#---------------------------------------#
+# FILE CATALOG OPTIONS
+#---------------------------------------#
+# whether the stages find their input files through the file catalog
+# (see h_catalog_helpers) rather than walking the whole folder tree
+USE_FILE_CATALOG = True
+
+
+
+#---------------------------------------#
+# INSTRUMENTATION OPTIONS
+#---------------------------------------#
+# whether to record the time spent in each sub-step (decode, transform,
+# encode, write) of every file, see h_instrumentation_helpers
+INSTRUMENT_STAGES = True
+
+
+
+#---------------------------------------#
+# STREAMING OPTIONS
+#---------------------------------------#
+# files with more frames than this are processed block by block
+# (so long recordings never have to be held in memory all at once)
+STREAMING_MIN_FRAMES = 10 * 60 * 48000
+# the number of frames read and processed at a time when streaming
+STREAM_BLOCK_FRAMES = 1024 * 1024
+
+
+
+#---------------------------------------#
+# WRITE-BEHIND OPTIONS
+#---------------------------------------#
+# whether the stages hand their output files to background i/o threads
+# and keep processing, rather than waiting for each write (see h_writer_helpers)
+WRITE_BEHIND = True
+# the number of i/o threads writing the output files (in each process)
+WRITER_THREADS = 4
+# the max bytes of output files waiting to be written, the stages wait
+# for the writes to catch up when this is reached (it is also kept below
+# a quarter of the free memory at the start of the run)
+WRITE_QUEUE_MAX_BYTES = 256 * 1024 * 1024
+# the max number of output files waiting to be written
+WRITE_QUEUE_MAX_FILES = 256
+
+
+
+#---------------------------------------#
+# READ-AHEAD OPTIONS
+#---------------------------------------#
+# whether the stages have their next input files read by background i/o threads
+# while they process the current one, rather than waiting for each read (see h_reader_helpers)
+READ_AHEAD = True
+# the number of i/o threads reading the input files (in each process)
+READ_AHEAD_THREADS = 4
+# the max number of input files read ahead of the stage
+READ_AHEAD_FILES = 16
+# the max bytes of input files read ahead but not yet used by the stage, the
+# i/o threads wait for the stage to catch up when this is reached (it is also
+# kept below a quarter of the free memory at the start of the run)
+READ_AHEAD_MAX_BYTES = 64 * 1024 * 1024
+
+
+
+#---------------------------------------#
+# DATA COLLECTION FOLDER PATHS
+#---------------------------------------#
+# Path to the raw data
+RAW_DATA_FOLDER = "../raw-data"
+
+# Location of the clean data folder within raw data folder structure
+CLEAN_DATA_LOCATION = "clean"
+
+# Path to the final data
+FINAL_DATA_FOLDER = '../../data'
+
+
+
+#---------------------------------------#
+# DATA PROCESSING FOLDER PATHS
+#---------------------------------------#
+# path to the mono, 16kHz transformed data folder
+MONO_16KHZ_DATA_FOLDER = '../../transformed-data/mono_16khz'
+
+# path to the normalised amplitude data folder
+AMP_NORM_DATA_FOLDER = '../../transformed-data/amp_normalised'
+
+# path to the targeted and trimed data folder
+TARGETED_1_2S_DATA_FOLDER = '../../transformed-data/targeted_1-2s'
+
+# path to the perturbed amplitudes data folder
+PERTURBED_AMP_DATA_FOLDER = '../../transformed-data/amp_perturbed'
+
+# path to the perturbed amplitudes packed into memory mappable shards
+# (instead of one wav file per clip)
+PACKED_AMP_DATA_FOLDER = '../../transformed-data/amp_perturbed_packed'
+
+# path to the log-mel features of the final clips (memory mappable shards,
+# in a folder for each set of feature parameters)
+FEATURES_DATA_FOLDER = '../../transformed-data/log_mel_features'
+
+# path to the folder holding the manifest of each stage
+# (which inputs produced which outputs, used for incremental runs)
+MANIFEST_FOLDER = '../../transformed-data/manifests'
+
+# path to the folder holding the journal of each unfinished stage run
+# (which inputs the run has completed, used to resume a killed run)
+JOURNAL_FOLDER = '../../transformed-data/journals'
+
+# path to the folder holding the work queue of each distributed stage run
+# (must be on a filesystem shared by all the hosts taking part)
+WORK_QUEUE_FOLDER = '../../transformed-data/work_queues'
+
+# path to the catalog of every file in the data folders (sqlite)
+CATALOG_PATH = '../../transformed-data/catalog.sqlite'
+
+# path to the folder holding the per-file instrumentation records of each run
+INSTRUMENTATION_FOLDER = '../../transformed-data/instrumentation'
+
+# path to the report of the duplicate recordings found by f1
+DUPLICATES_REPORT_PATH = '../../transformed-data/duplicates.json'
+
+
+
+#---------------------------------------#
+# TESTING
+#---------------------------------------#
+# path to the testing folder with small subset of data
+TEST_DATA_FOLDER = '../test-data'
+TEST_DEST_FOLDER = '../test-dest'
+
+
+
+#---------------------------------------#
+# BENCHMARKING
+#---------------------------------------#
+# path to the benchmark folder, holding a synthetic corpus (in the same
+# layout as the raw data folder) and the outputs of every stage run on it
+BENCH_FOLDER = '../bench'
+
+# path to the synthetic raw data (see bench_make_synthetic_corpus)
+BENCH_RAW_DATA_FOLDER = '../bench/raw-data'
+
+# path to the machine readable results of each benchmark run
+BENCH_RESULTS_FOLDER = '../bench/results'
+
+
@@ -0,0 +1,326 @@
+"""
+A persistent catalog of every audio file in the data folders, kept in SQLite.
+
+The catalog is filled once at ingest (f1) and updated by each stage as it
+writes (and removes) its outputs, so the stages can find their input files
+with a query rather than walking the whole folder tree. For each file it
+records:
+    path, category, source id, recording number, sample rate, channels,
+    frames, duration, size and lineage (the parent file it was made from)
+Only the header of each file is read. The peak is only filled in when it is
+asked for (make_file_entry with_peak), as that reads the whole file.
+
+The catalog is checked against the disk each time a folder is listed. The
+modification time of each folder is kept, and only the folders that have
+changed since they were last listed (adding, removing or renaming a file
+changes the time of its folder) are listed again, the rest only need a stat.
+Files added by hand are catalogued and files removed by hand are dropped.
+
+A folder that has nothing in the catalog (e.g. it was filled before the
+catalog existed) is walked as before, rebuild_catalog adds such a folder.
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_writer_helpers as wh
+# folder navigation modules
+import os
+import time
+# modules used for storing the catalog
+import sqlite3
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the columns of the files table, in order
+FILE_COLUMNS = ["path", "category", "source_id", "recording_num", "sample_rate", "channels",
+                "frames", "duration_s", "peak", "size", "parent"]
+# the schema of the catalog
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    category TEXT,
+    source_id INTEGER,
+    recording_num INTEGER,
+    sample_rate INTEGER,
+    channels INTEGER,
+    frames INTEGER,
+    duration_s REAL,
+    peak INTEGER,
+    size INTEGER,
+    parent TEXT
+);
+CREATE INDEX IF NOT EXISTS files_category ON files (category, path);
+CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+"""
+# folders changed more recently than this (in seconds) may still change within
+# the same modification time (on filesystems with a coarse clock), so their
+# time is not kept and they are listed again the next time
+FOLDER_SETTLE_TIME_S = 2.0
+#---------------------------------------#
+
+#---------------------------------------#
+# GOBAL VARIABLE TRACKERS
+#---------------------------------------#
+# the open connection to the catalog, and the path it was opened for
+connection = None
+connection_path = None
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# QUERYING THE CATALOG
+#---------------------------------------#
+
+"""
+find the files within the given folder (including subfolders), with the
+category filters applied within the query. The catalog of the folder is
+brought up to date with the disk first (see sync_folder). Folders that are
+not in the catalog (or with the catalog turned off) are walked instead.
+
+    folder: the folder to list, e.g. fdef.AMP_NORM_DATA_FOLDER
+    categories: only the files in these categories, None for all
+    exclude_categories: leave out the files in these categories
+
+    returns: the list of file paths
+"""
+def list_files(folder, categories=None, exclude_categories=None):
+    if not fdef.USE_FILE_CATALOG or not is_catalogued(folder):
+        files = fh.make_path_list(folder)
+        if categories:
+            files = [file for file in files if fh.get_category(file) in categories]
+        if exclude_categories:
+            files = [file for file in files if fh.get_category(file) not in exclude_categories]
+        return files
+
+    sync_folder(folder)
+    query, params = make_folder_query("SELECT path FROM files", folder)
+    if categories:
+        query += f" AND category IN ({', '.join('?' * len(categories))})"
+        params += list(categories)
+    if exclude_categories:
+        query += f" AND category NOT IN ({', '.join('?' * len(exclude_categories))})"
+        params += list(exclude_categories)
+    return [row[0] for row in get_connection().execute(query + " ORDER BY path", params)]
+
+"""
+get the catalog entries of the files within the given folder
+
+    returns: a list of dicts of FILE_COLUMNS
+"""
+def get_entries(folder):
+    query, params = make_folder_query(f"SELECT {', '.join(FILE_COLUMNS)} FROM files", folder)
+    rows = get_connection().execute(query + " ORDER BY path", params)
+    return [dict(zip(FILE_COLUMNS, row)) for row in rows]
+
+"""
+check if the catalog has any files within the given folder
+"""
+def is_catalogued(folder):
+    query, params = make_folder_query("SELECT 1 FROM files", folder)
+    return get_connection().execute(query + " LIMIT 1", params).fetchone() is not None
+
+"""
+bring the catalog of the given folder (and its subfolders) up to date with
+what is on disk. The folders that have changed since they were last listed
+are listed again, new files are catalogued (without a parent) and the files
+that are gone are dropped.
+"""
+def sync_folder(folder):
+    folder = os.path.normpath(folder)
+    conn = get_connection()
+    # the catalogued files of each folder
+    folder_files = {}
+    query, params = make_folder_query("SELECT path FROM files", folder)
+    for (path,) in conn.execute(query, params):
+        folder_files.setdefault(os.path.dirname(path), set()).add(path)
+    # the modification time of each folder when it was last listed
+    query, params = make_folder_query("SELECT path, mtime_ns FROM folders", folder)
+    listed_mtimes = dict(conn.execute(query + " OR path = ?", params + [folder]))
+
+    # the known subfolders of each folder
+    subfolders = {}
+    for path in set(folder_files) | set(listed_mtimes):
+        while path != folder and path.startswith(os.path.join(folder, "")):
+            subfolders.setdefault(os.path.dirname(path), set()).add(path)
+            path = os.path.dirname(path)
+
+    new_files, gone_files, folder_mtimes = [], [], {}
+    pending = [folder]
+    while pending:
+        directory = pending.pop()
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        if listed_mtimes.get(directory) == mtime_ns:
+            # unchanged, only its subfolders need checking
+            folder_mtimes[directory] = mtime_ns
+            pending.extend(subfolders.get(directory, ()))
+            continue
+
+        # changed (or never listed), compare what is on disk with the catalog
+        files_on_disk = set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                # (as os.walk, links to folders are not followed)
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        pending.append(entry.path)
+                elif not entry.name.endswith(wh.TEMP_FILE_SUFFIX):
+                    files_on_disk.add(entry.path)
+        catalogued = folder_files.get(directory, set())
+        new_files += sorted(files_on_disk - catalogued)
+        gone_files += catalogued - files_on_disk
+        if time.time() - mtime_ns / 1e9 > FOLDER_SETTLE_TIME_S:
+            folder_mtimes[directory] = mtime_ns
+        else:
+            folder_mtimes[directory] = None
+
+    # the files of the folders that are no longer there
+    for directory, files in folder_files.items():
+        if directory not in folder_mtimes:
+            gone_files += files
+
+    if new_files or gone_files:
+        print(f"Catalog of {folder}: adding {len(new_files)} new files, dropping {len(gone_files)} missing files")
+    remove_files(gone_files)
+    add_entries(make_file_entry(file) for file in new_files)
+    with conn:
+        conn.executemany("DELETE FROM folders WHERE path = ?",
+                         ((path,) for path in listed_mtimes if path not in folder_mtimes))
+        conn.executemany("INSERT OR REPLACE INTO folders (path, mtime_ns) VALUES (?, ?)",
+                         [(path, mtime_ns) for path, mtime_ns in folder_mtimes.items()
+                          if listed_mtimes.get(path) != mtime_ns])
+
+"""
+make a query for the files within the given folder, as a range of the
+(indexed) paths rather than a scan
+
+    returns: (the query, the list of its parameters)
+"""
+def make_folder_query(select, folder):
+    prefix = os.path.join(os.path.normpath(folder), "")
+    # every path starting with the prefix sorts before the prefix with its last character incremented
+    end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return f"{select} WHERE path >= ? AND path < ?", [prefix, end]
+
+
+
+
+#---------------------------------------#
+# UPDATING THE CATALOG
+#---------------------------------------#
+
+"""
+make the catalog entry of the given wav file, the metadata is read from its header
+
+    file: the path to the wav file
+    parent: the path of the file it was made from (its lineage)
+    with_peak: whether to also find the peak, this reads the whole file
+
+    returns: a dict of FILE_COLUMNS
+"""
+def make_file_entry(file, parent=None, with_peak=False):
+    entry = dict.fromkeys(FILE_COLUMNS)
+    entry.update(path=os.path.normpath(file), parent=parent and os.path.normpath(parent),
+                 category=fh.get_category(file), size=os.path.getsize(file))
+
+    # Format: "{category}_{recording num}_{source id}_{properties}.wav"
+    name_sections = os.path.splitext(os.path.basename(file))[0].split("_")
+    if len(name_sections) >= 3 and name_sections[1].isdigit() and name_sections[2].isdigit():
+        entry.update(recording_num=int(name_sections[1]), source_id=int(name_sections[2]))
+
+    try:
+        header = fh.read_wav_header(file)
+    except ValueError:
+        return entry # not a wav file we can read, only the name is catalogued
+    entry.update(sample_rate=header["sample_rate"], channels=header["channels"], frames=header["frames"],
+                 duration_s=header["frames"] / header["sample_rate"] if header["sample_rate"] else None)
+    if with_peak and fh.is_pcm16(header):
+        entry["peak"] = max((fh.peak_of_samples(block) for block in fh.iter_wav_pcm16_blocks(file)), default=0)
+    return entry
+
+"""
+add (or replace) the given entries in the catalog
+
+    entries: an iterable of dicts of FILE_COLUMNS
+"""
+def add_entries(entries):
+    conn = get_connection()
+    with conn:
+        conn.executemany(f"INSERT OR REPLACE INTO files ({', '.join(FILE_COLUMNS)}) "
+                         f"VALUES ({', '.join('?' * len(FILE_COLUMNS))})",
+                         ([entry[column] for column in FILE_COLUMNS] for entry in entries))
+
+"""
+add the outputs of a stage to the catalog, with the inputs as their parents
+
+    results: a dict of input file -> list of output paths
+"""
+def add_stage_outputs(results):
+    if not fdef.USE_FILE_CATALOG:
+        return
+    add_entries(make_file_entry(output, parent=file)
+                for file, outputs in results.items() for output in outputs if os.path.exists(output))
+
+"""
+remove the given files from the catalog
+"""
+def remove_files(files):
+    if not fdef.USE_FILE_CATALOG:
+        return
+    conn = get_connection()
+    with conn:
+        conn.executemany("DELETE FROM files WHERE path = ?", ((os.path.normpath(file),) for file in files))
+
+"""
+remove every file (and folder) within the given folder from the catalog
+"""
+def remove_folder(folder):
+    if not fdef.USE_FILE_CATALOG:
+        return
+    query, params = make_folder_query("DELETE FROM files", folder)
+    conn = get_connection()
+    with conn:
+        conn.execute(query, params)
+        query, params = make_folder_query("DELETE FROM folders", folder)
+        conn.execute(query + " OR path = ?", params + [os.path.normpath(folder)])
+
+"""
+(re-)catalog the given folder from what is on disk, e.g. for a folder filled
+before the catalog existed. The lineage of the files is not known.
+"""
+def rebuild_catalog(folder):
+    remove_folder(folder)
+    add_entries(make_file_entry(file) for file in fh.make_path_list(folder))
+
+
+
+
+#---------------------------------------#
+# CATALOG FILE HELPERS
+#---------------------------------------#
+
+"""
+get the connection to the catalog at CATALOG_PATH, creating it if needed.
+Only the main process writes to the catalog, the worker processes never open it.
+"""
+def get_connection():
+    global connection, connection_path
+    if connection is None or connection_path != fdef.CATALOG_PATH:
+        if connection is not None:
+            connection.close()
+        os.makedirs(os.path.dirname(fdef.CATALOG_PATH) or ".", exist_ok=True)
+        connection = sqlite3.connect(fdef.CATALOG_PATH)
+        connection.executescript(CATALOG_SCHEMA)
+        connection_path = fdef.CATALOG_PATH
+    return connection
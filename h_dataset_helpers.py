@@ -0,0 +1,111 @@
+"""
+A lazy view of the f5 perturbed dataset, computed on read from the targeted clips.
+
+Instead of writing a physical copy of every targeted clip for each gain in
+AMPS_TO_PERTURB_DB, each (clip, gain) item is computed when it is read. The items
+are bit-identical to (and named the same as) the files f5 would have written.
+Random gains can also be drawn for training.
+
+    dataset = LazyPerturbedDataset()
+    samples, file_name = dataset[i]
+    samples, file_name = dataset.get_random_item(rng)
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_catalog_helpers as ch
+# the perturbation options and naming of f5
+import f5_perturb_amp as f5
+# modules used for folder naviation
+import os
+# modules used for caching the decoded clips
+from functools import lru_cache
+import numpy as np
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the number of decoded base clips to keep in memory
+CLIP_CACHE_SIZE = 256
+# the range of the randomised gains, in dB
+RANDOM_GAIN_RANGE_DB = (-15.0, 15.0)
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# LAZY DATASET
+#---------------------------------------#
+
+"""
+A view over the targeted clips exposing every (clip, gain) item of f5,
+computed on read. Item i is gain i % len(gains_db) of clip i // len(gains_db),
+so reading the items in order decodes each clip once.
+
+    folder: the folder of targeted clips (the f5 source folder)
+    gains_db: the gains to expose, by default the f5 AMPS_TO_PERTURB_DB
+    categories: the categories to include, None for all (by default as f5)
+    cache_size: the number of decoded base clips kept in the LRU cache
+"""
+class LazyPerturbedDataset:
+    def __init__(self, folder=fdef.TARGETED_1_2S_DATA_FOLDER, gains_db=None,
+                 categories=f5.CATEGORIES_TO_PROCESS, cache_size=CLIP_CACHE_SIZE):
+        self.gains_db = list(f5.AMPS_TO_PERTURB_DB if gains_db is None else gains_db)
+        self.files = sorted(ch.list_files(folder, categories=categories))
+        # the decoded base clips, least recently used are dropped first
+        self.load_clip = lru_cache(maxsize=cache_size)(self.decode_clip)
+
+    def __len__(self):
+        return len(self.files) * len(self.gains_db)
+
+    """
+    get the perturbed samples and f5 file name of the given item
+
+        returns: (int16 samples, file name)
+    """
+    def __getitem__(self, item_num):
+        if not 0 <= item_num < len(self):
+            raise IndexError(f"Item {item_num} out of range for {len(self)} items")
+        file_num, gain_num = divmod(item_num, len(self.gains_db))
+        return self.get_perturbed(self.files[file_num], self.gains_db[gain_num])
+
+    """
+    get a random clip at a random gain within RANDOM_GAIN_RANGE_DB
+
+        rng: a numpy random Generator (e.g. np.random.default_rng(seed))
+
+        returns: (int16 samples, file name)
+    """
+    def get_random_item(self, rng, gain_range_db=RANDOM_GAIN_RANGE_DB):
+        file = self.files[rng.integers(len(self.files))]
+        gain_db = round(float(rng.uniform(*gain_range_db)), 2)
+        return self.get_perturbed(file, gain_db)
+
+    """
+    apply the gain to the (cached) base clip, as AudioSegment.apply_gain would
+
+        returns: (int16 samples, file name)
+    """
+    def get_perturbed(self, file, gain_db):
+        samples = fh.apply_gain_samples(self.load_clip(file), gain_db)
+        return samples, get_perturbed_file_name(file, gain_db)
+
+    """
+    decode the given base clip into memory
+    """
+    def decode_clip(self, file):
+        samples, _ = fh.load_wav_samples(file)
+        return np.array(samples)
+
+"""
+find the name f5 gives the given clip perturbed by the given gain
+
+    returns: the file name
+"""
+def get_perturbed_file_name(file, gain_db):
+    output_path = fh.make_new_wav_path(file, f5.DEST_FOLDER, f5.generate_output_file_name,
+                                       f5.generate_amp_pert_tag(gain_db))
+    return os.path.basename(output_path)
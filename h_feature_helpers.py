@@ -0,0 +1,335 @@
+"""
+Log-mel spectrogram (and MFCC) features of the clips, and the feature store.
+
+The features of a batch of clips are computed together: the clips are padded
+into one matrix, framed as a strided view and put through a single rfft, so
+there is no per-clip python work beyond packing the batch.
+
+The features are kept in memory mappable shards within a folder per set of
+feature parameters, each clip keyed by its content hash:
+    shard_00000_log_mel.npy: float32 (clips, max frames, mels), zero padded
+    shard_00000_mfcc.npy:    float32 (clips, max frames, mfccs), if computed
+    shard_00000_frames.npy:  int32 array of the number of frames of each clip
+    shard_00000_index.json:  the content hash of each clip
+New clips are added in new shards, the existing shards are never rewritten,
+so the features of a clip are only ever computed once. The clips of the
+current dataset (and where their features are) are listed in dataset.json.
+"""
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+# folder navigation modules
+import os
+# modules used for computing and storing the features
+import json
+import numpy as np
+from functools import lru_cache
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the number of clips in each feature shard
+CLIPS_PER_SHARD = 4096
+# added to the mel power before the log, so silence is not -inf
+LOG_FLOOR = 1e-10
+# the name of the dataset index within the feature store folder
+DATASET_INDEX_NAME = "dataset.json"
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# COMPUTING THE FEATURES
+#---------------------------------------#
+
+"""
+compute the log-mel spectrograms (and MFCCs) of a batch of clips
+
+    clips: a list of 1D int16 sample arrays
+    params: the feature parameters, a dict of
+        sample_rate, n_fft, hop_length, n_mels, fmin, fmax and n_mfcc (0 for no MFCCs)
+
+    returns: a list of (float32 log-mel (frames, n_mels), float32 mfcc (frames, n_mfcc) or None)
+"""
+def compute_features_batch(clips, params):
+    if not clips:
+        return []
+    n_fft, hop_length = params["n_fft"], params["hop_length"]
+
+    # pad the clips into one matrix, with n_fft // 2 of silence either side
+    # so that frame i is centred on sample i * hop_length
+    num_frames = [1 + len(clip) // hop_length for clip in clips]
+    padded = np.zeros((len(clips), (max(num_frames) - 1) * hop_length + n_fft), dtype=np.float32)
+    for row, clip in enumerate(clips):
+        padded[row, n_fft // 2 : n_fft // 2 + len(clip)] = clip
+    padded /= fdef.MAX_16BIT_AMP
+
+    # frame every clip at once, (clips, frames, n_fft)
+    frames = np.lib.stride_tricks.sliding_window_view(padded, n_fft, axis=1)[:, ::hop_length]
+    power = np.abs(np.fft.rfft(frames * get_window(n_fft), axis=2)) ** 2
+    log_mel = np.log10(power.astype(np.float32) @ get_mel_filterbank(params).T + LOG_FLOOR) * 10
+
+    mfcc = None
+    if params["n_mfcc"]:
+        mfcc = log_mel @ get_dct_matrix(params["n_mels"], params["n_mfcc"]).T
+
+    return [(log_mel[row, :num_frames[row]],
+             None if mfcc is None else mfcc[row, :num_frames[row]])
+            for row in range(len(clips))]
+
+"""
+get the (periodic) hann window of the given size
+"""
+@lru_cache(maxsize=None)
+def get_window(n_fft):
+    return np.hanning(n_fft + 1)[:-1].astype(np.float32)
+
+"""
+get the mel filterbank, triangular filters evenly spaced on the (HTK) mel
+scale, each normalised to the same area
+
+    params: the feature parameters (see compute_features_batch)
+
+    returns: float32 matrix of (n_mels, n_fft // 2 + 1)
+"""
+def get_mel_filterbank(params):
+    return make_mel_filterbank(params["sample_rate"], params["n_fft"], params["n_mels"],
+                               params["fmin"], params["fmax"])
+
+@lru_cache(maxsize=None)
+def make_mel_filterbank(sample_rate, n_fft, n_mels, fmin, fmax):
+    fft_freqs = np.linspace(0, sample_rate / 2, n_fft // 2 + 1)
+    # the edges of the filters, evenly spaced in mels
+    mel_edges = np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), n_mels + 2)
+    hz_edges = mel_to_hz(mel_edges)
+
+    lower, centre, upper = hz_edges[:-2, None], hz_edges[1:-1, None], hz_edges[2:, None]
+    rising = (fft_freqs - lower) / (centre - lower)
+    falling = (upper - fft_freqs) / (upper - centre)
+    filterbank = np.maximum(0, np.minimum(rising, falling))
+    # the same area for every filter (as librosa's norm="slaney")
+    filterbank *= 2 / (upper - lower)
+    return filterbank.astype(np.float32)
+
+"""
+convert between hz and the (HTK) mel scale
+"""
+def hz_to_mel(hz):
+    return 2595 * np.log10(1 + np.asarray(hz) / 700)
+
+def mel_to_hz(mel):
+    return 700 * (10 ** (np.asarray(mel) / 2595) - 1)
+
+"""
+get the orthonormal DCT-II matrix taking the log-mel bands to the MFCCs
+
+    returns: float32 matrix of (n_mfcc, n_mels)
+"""
+@lru_cache(maxsize=None)
+def get_dct_matrix(n_mels, n_mfcc):
+    bands = np.arange(n_mels)
+    dct = np.cos(np.pi / n_mels * (bands + 0.5) * np.arange(n_mfcc)[:, None])
+    dct *= np.sqrt(2 / n_mels)
+    dct[0] /= np.sqrt(2)
+    return dct.astype(np.float32)
+
+"""
+find the max number of frames of a clip of the given length (in seconds)
+"""
+def get_max_frames(params, max_length_s):
+    return 1 + int(max_length_s * params["sample_rate"]) // params["hop_length"]
+
+
+
+
+#---------------------------------------#
+# FEATURE STORE
+#---------------------------------------#
+
+"""
+The feature shards of a single set of feature parameters
+
+    store_folder: the folder of the feature shards
+    params: the feature parameters (see compute_features_batch)
+"""
+class FeatureStore:
+    def __init__(self, store_folder, params):
+        self.store_folder = store_folder
+        self.params = params
+        # content hash -> (shard num, row), of every clip in the store
+        self.locations = {}
+        self.num_shards = 0
+        for shard_num, shard_path in enumerate(list_feature_shards(store_folder)):
+            with open(f"{shard_path}_index.json", 'r') as f:
+                for row, content_hash in enumerate(json.load(f)["clips"]):
+                    self.locations[content_hash] = (shard_num, row)
+            self.num_shards = shard_num + 1
+
+        # the shard being written, and its clips
+        self.log_mel = None
+        self.mfcc = None
+        self.frames = None
+        self.index = []
+        self.max_frames = None
+
+    """
+    check if the features of the clip with the given content hash are in the store
+    """
+    def has_clip(self, content_hash):
+        return content_hash in self.locations
+
+    """
+    add the features of a clip to a new shard of the store
+
+        content_hash: the content hash of the clip
+        log_mel, mfcc: the features of the clip (see compute_features_batch)
+        max_frames: the max frames of any clip (the shape of the shards)
+    """
+    def add_clip(self, content_hash, log_mel, mfcc, max_frames):
+        if content_hash in self.locations:
+            return
+        if len(log_mel) > max_frames:
+            raise ValueError(f"Clip {content_hash} has {len(log_mel)} frames, more than {max_frames}")
+        if self.log_mel is None:
+            self.open_shard(max_frames)
+
+        row = len(self.index)
+        self.log_mel[row, :len(log_mel)] = log_mel
+        if self.mfcc is not None:
+            self.mfcc[row, :len(mfcc)] = mfcc
+        self.frames[row] = len(log_mel)
+        self.index.append(content_hash)
+        self.locations[content_hash] = (self.num_shards, row)
+
+        if len(self.index) == CLIPS_PER_SHARD:
+            self.close_shard()
+
+    """
+    start a new, empty shard after the existing ones
+    """
+    def open_shard(self, max_frames):
+        os.makedirs(self.store_folder, exist_ok=True)
+        self.max_frames = max_frames
+        self.log_mel = self.open_shard_array("log_mel", self.params["n_mels"], CLIPS_PER_SHARD)
+        if self.params["n_mfcc"]:
+            self.mfcc = self.open_shard_array("mfcc", self.params["n_mfcc"], CLIPS_PER_SHARD)
+        self.frames = np.zeros(CLIPS_PER_SHARD, dtype=np.int32)
+        self.index = []
+
+    """
+    open a (zeroed) memory mapped feature array of the current shard
+    """
+    def open_shard_array(self, name, num_features, num_clips, suffix=""):
+        return np.lib.format.open_memmap(
+            self.get_shard_path(f"{name}.npy{suffix}"), mode='w+', dtype=np.float32,
+            shape=(num_clips, self.max_frames, num_features))
+
+    """
+    write out the current shard, a partly filled shard is cut down to the
+    clips it holds. The index is written last, so a shard without an index
+    (e.g. after a crash) is never read.
+    """
+    def close_shard(self):
+        num_shard_clips = len(self.index)
+        arrays = [("log_mel", self.log_mel, self.params["n_mels"])]
+        if self.mfcc is not None:
+            arrays.append(("mfcc", self.mfcc, self.params["n_mfcc"]))
+        for name, array, num_features in arrays:
+            if num_shard_clips < CLIPS_PER_SHARD:
+                trimmed = self.open_shard_array(name, num_features, num_shard_clips, ".tmp")
+                trimmed[:] = array[:num_shard_clips]
+                trimmed.flush()
+                del trimmed
+                os.replace(self.get_shard_path(f"{name}.npy.tmp"), self.get_shard_path(f"{name}.npy"))
+            else:
+                array.flush()
+        self.log_mel = None
+        self.mfcc = None
+
+        np.save(self.get_shard_path("frames.npy"), self.frames[:num_shard_clips])
+        with open(self.get_shard_path("index.json"), 'w') as f:
+            json.dump({"params": self.params, "clips": self.index}, f)
+        self.num_shards += 1
+
+    """
+    finish writing the last shard
+    """
+    def close(self):
+        if self.log_mel is not None:
+            self.close_shard()
+
+    """
+    write the list of the clips of the current dataset, and where their features are
+
+        entries: a list of dicts of the file name, category and content hash of each clip
+    """
+    def write_dataset_index(self, entries):
+        os.makedirs(self.store_folder, exist_ok=True)
+        for entry in entries:
+            entry["shard"], entry["row"] = self.locations[entry["content_hash"]]
+        temp_path = os.path.join(self.store_folder, f"{DATASET_INDEX_NAME}.tmp")
+        with open(temp_path, 'w') as f:
+            json.dump({"params": self.params, "clips": entries}, f)
+        os.replace(temp_path, os.path.join(self.store_folder, DATASET_INDEX_NAME))
+
+    """
+    find the path of a file of the current shard
+    """
+    def get_shard_path(self, suffix):
+        return get_shard_prefix(self.store_folder, self.num_shards) + f"_{suffix}"
+
+"""
+find the path prefix of the given shard, e.g. ".../shard_00000"
+"""
+def get_shard_prefix(store_folder, shard_num):
+    return os.path.join(store_folder, f"shard_{shard_num:05}")
+
+"""
+find the complete shards in the given store folder (those with an index)
+
+    returns: the list of shard path prefixes, in order
+"""
+def list_feature_shards(store_folder):
+    shard_paths = []
+    while os.path.exists(f"{get_shard_prefix(store_folder, len(shard_paths))}_index.json"):
+        shard_paths.append(get_shard_prefix(store_folder, len(shard_paths)))
+    return shard_paths
+
+
+
+
+#---------------------------------------#
+# READING THE FEATURES
+#---------------------------------------#
+
+"""
+open the features of the current dataset in the given store folder for
+random access (e.g. by a training job), the shards are memory mapped
+
+    store_folder: the folder of the feature shards
+
+    returns: (the list of clip entries of the dataset, a list of the opened shards)
+"""
+def load_feature_dataset(store_folder):
+    with open(os.path.join(store_folder, DATASET_INDEX_NAME), 'r') as f:
+        dataset = json.load(f)
+    shards = []
+    for shard_path in list_feature_shards(store_folder):
+        mfcc_path = f"{shard_path}_mfcc.npy"
+        shards.append({"log_mel": np.load(f"{shard_path}_log_mel.npy", mmap_mode='r'),
+                       "mfcc": np.load(mfcc_path, mmap_mode='r') if os.path.exists(mfcc_path) else None,
+                       "frames": np.load(f"{shard_path}_frames.npy", mmap_mode='r')})
+    return dataset["clips"], shards
+
+"""
+get the features of a clip of the dataset (without the padding)
+
+    returns: (float32 log-mel (frames, n_mels), float32 mfcc (frames, n_mfcc) or None)
+"""
+def get_clip_features(shards, entry):
+    shard = shards[entry["shard"]]
+    num_frames = shard["frames"][entry["row"]]
+    mfcc = None if shard["mfcc"] is None else shard["mfcc"][entry["row"], :num_frames]
+    return shard["log_mel"][entry["row"], :num_frames], mfcc
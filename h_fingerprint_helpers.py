@@ -0,0 +1,520 @@
+"""
+Audio fingerprints used to find duplicate recordings across the data sources.
+
+Each file is resampled to FINGERPRINT_SAMPLE_RATE (mono) and the peaks of its
+spectrogram are paired up into landmark hashes:
+    (frequency of the peak, frequency of a later peak, frames between them)
+which stay the same when a recording is re-encoded at another sample rate,
+gained or has a little noise added. Each hash is kept with the frame of its
+first peak. The landmarks of the kept files are held in an inverted index
+(hash -> files and frames), so the landmarks each file shares with every
+kept file are found in one pass over its own landmarks.
+
+Files with the same content hash are exact duplicates. Two files are near
+duplicates when at least NEAR_DUPLICATE_SIMILARITY of the landmarks of the
+smaller file are found in the other file at the same time offset (so a
+trimmed copy, e.g. a short excerpt of a long recording, still matches). Only
+counting the landmarks that line up in time keeps a long recording, which
+holds most of the possible hashes somewhere, from matching every short file.
+
+A file is fingerprinted a block at a time (as in the streaming paths of f2
+and f3), with the input the resampler and the peak search need across each
+block edge carried over, so only a block is held in memory however long the
+recording is.
+
+The fingerprints are kept in the file catalog (keyed by the path, size and
+modification time of the file), so unchanged files are not fingerprinted again.
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+import h_FOLDER_DEFINITIONS as fdef
+import h_manifest_helpers as mh
+import h_catalog_helpers as ch
+# folder navigation modules
+import os
+# modules used for fingerprinting the audio
+import numpy as np
+from math import gcd
+from itertools import chain
+# modules used for fingerprinting the files in parallel
+from concurrent.futures import ThreadPoolExecutor
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the sample rate the files are fingerprinted at
+FINGERPRINT_SAMPLE_RATE = 8000
+# the spectrogram frames (64ms, every 8ms at 8kHz), the short hop keeps the
+# peaks at the same frames (near enough) when a recording is trimmed
+FFT_SIZE = 512
+HOP_SIZE = 64
+# the size of the area (frames, frequency bins) a peak must be the max of
+PEAK_NEIGHBOURHOOD = (9, 9)
+# peaks this far (in dB) below the loudest point of the file are ignored
+# (of the block of FINGERPRINT_BLOCK_FRAMES, for a longer file)
+PEAK_RANGE_DB = 50
+# the spectrogram frames searched for peaks at a time (about 33s)
+FINGERPRINT_BLOCK_FRAMES = 4096
+# each peak is paired with up to this many of the peaks after it
+FAN_OUT = 5
+# the frames between the peaks of a pair are hashed in steps of this many
+# frames (so a peak moving by a frame does not change every hash)
+PAIR_FRAMES_STEP = 2
+# the max frames between the peaks of a pair (the steps must fit in 6 bits)
+MAX_PAIR_FRAMES = 126
+# the fraction of the landmarks of the smaller file that must be shared (at
+# the same time offset) for two files to be near duplicates. Unrelated files
+# share about 1% at their best offset, a trimmed or re-encoded copy 30% or more
+NEAR_DUPLICATE_SIMILARITY = 0.15
+# the min number of landmarks that must be shared (at the same time offset)
+# for two files to be near duplicates (so files with only a few landmarks,
+# e.g. near silence, do not match by chance)
+MIN_SHARED_HASHES = 20
+# the time offsets (in frames) within this many frames of each other are
+# counted together, as a peak can move by a frame in a trimmed copy
+OFFSET_TOLERANCE_FRAMES = 1
+# the schema of the fingerprints table (within the file catalog)
+FINGERPRINT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    content_hash TEXT,
+    hashes BLOB,
+    frames BLOB
+);
+"""
+#---------------------------------------#
+
+#---------------------------------------#
+# GOBAL VARIABLE TRACKERS
+#---------------------------------------#
+# the catalog path the fingerprints table has been made in
+fingerprint_table_path = None
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# FINGERPRINTING
+#---------------------------------------#
+
+"""
+Fingerprint of a single file
+
+    path: the path to the file
+    content_hash: the hash of the file contents (for exact duplicates)
+    hashes: uint32 array of the landmark hashes
+    frames: uint32 array of the frame of the first peak of each landmark
+"""
+class Fingerprint:
+    def __init__(self, path, content_hash, hashes, frames):
+        self.path = path
+        self.content_hash = content_hash
+        self.hashes = hashes
+        self.frames = frames
+
+"""
+fingerprint the given files, spread over the given number of threads. The
+fingerprints of the files that have not changed since they were last
+fingerprinted are loaded from the catalog (in this thread, as the
+connection to the catalog cannot be shared between threads).
+
+    files: the paths to the audio files
+    num_threads: the number of threads fingerprinting the files
+
+    returns: a list of the Fingerprint of each file, None for a file that could not be read
+"""
+def get_fingerprints(files, num_threads=1):
+    stats = [os.stat(file) for file in files]
+    fingerprints = [load_fingerprint(file, stat) for file, stat in zip(files, stats)]
+    missing = [i for i, fingerprint in enumerate(fingerprints) if fingerprint is None]
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for i, fingerprint in zip(missing, executor.map(try_make_fingerprint, [files[i] for i in missing])):
+            fingerprints[i] = fingerprint
+            if fingerprint is not None:
+                save_fingerprint(fingerprint, stats[i])
+    return fingerprints
+
+"""
+fingerprint the given file, reporting (rather than raising) any error
+
+    returns: the Fingerprint of the file, or None if it could not be read
+"""
+def try_make_fingerprint(file):
+    try:
+        return make_fingerprint(file)
+    except Exception as e:
+        print(f"File {file} cannot be fingerprinted: {e}")
+        return None
+
+"""
+fingerprint the given file, a block at a time
+
+    returns: the Fingerprint of the file
+"""
+def make_fingerprint(file):
+    blocks, sample_rate = iter_sample_blocks(file)
+    mono_blocks = (fh.to_mono_samples(block) for block in blocks)
+    hashes, frames = find_landmark_hashes(resample_for_fingerprint(mono_blocks, sample_rate))
+    return Fingerprint(file, mh.hash_file(file), hashes, frames)
+
+"""
+read the samples of the given file a block of fdef.STREAM_BLOCK_FRAMES at a
+time. 16 bit PCM wav files are read block by block, anything else is decoded
+whole (with pydub) and then handed over a block at a time.
+
+    returns: (a generator of int16 arrays of shape (frames, channels), sample_rate)
+"""
+def iter_sample_blocks(file):
+    try:
+        header = fh.read_wav_header(file)
+    except ValueError:
+        header = None
+    if header is not None and fh.is_pcm16(header):
+        return fh.iter_wav_pcm16_blocks(file), header["sample_rate"]
+
+    samples, sample_rate = fh.load_wav_samples(file)
+    return (samples[start : start + fdef.STREAM_BLOCK_FRAMES]
+            for start in range(0, len(samples), fdef.STREAM_BLOCK_FRAMES)), sample_rate
+
+"""
+resample blocks of mono samples to FINGERPRINT_SAMPLE_RATE as they are read,
+giving the same samples as resampling the whole file at once. The input the
+filter needs across each block edge is carried over to the next block.
+
+    blocks: an iterable of int16 arrays of the mono samples
+    sample_rate: the sample rate of the samples
+
+    returns: a generator of float32 arrays of the resampled samples
+"""
+def resample_for_fingerprint(blocks, sample_rate):
+    if sample_rate == FINGERPRINT_SAMPLE_RATE:
+        for block in blocks:
+            yield block.astype(np.float32)
+        return
+
+    from scipy.signal import resample_poly
+    divisor = gcd(FINGERPRINT_SAMPLE_RATE, sample_rate)
+    up, down = FINGERPRINT_SAMPLE_RATE // divisor, sample_rate // divisor
+    # the input samples either side of an output that it depends on (the filter
+    # of resample_poly reaches 10 * max(up, down) samples either side at up times
+    # the rate), a multiple of down so the outputs of each block stay aligned
+    context = 10 * max(up, down) // up + 1
+    context += -context % down
+
+    # the input still needed, starting at input sample history_start
+    history = np.zeros(0, dtype=np.float32)
+    history_start = 0
+    next_out = 0
+    for block in chain(blocks, [None]):
+        if block is not None:
+            history = np.concatenate((history, block.astype(np.float32)))
+            # the outputs that only depend on the input read so far
+            stop_out = max(0, (history_start + len(history) - context) * up // down)
+        else:
+            # all of the remaining outputs once the whole file has been read
+            stop_out = -(-(history_start + len(history)) * up // down)
+        if stop_out > next_out:
+            offset = history_start * up // down
+            resampled = resample_poly(history, up, down)
+            yield resampled[next_out - offset : stop_out - offset].astype(np.float32)
+            next_out = stop_out
+
+        # drop the input that no later output depends on
+        keep_start = max(0, next_out * down // up - context)
+        keep_start -= keep_start % down
+        history = history[keep_start - history_start:]
+        history_start = keep_start
+
+"""
+find the landmark hashes of the given samples. The peaks of the log
+spectrogram are found, and each peak is paired with the next FAN_OUT peaks.
+
+    sample_blocks: an iterable of float arrays of the mono samples at FINGERPRINT_SAMPLE_RATE
+
+    returns: (uint32 array of the hashes, uint32 array of the frame of the
+              first peak of each), the unique landmarks sorted by hash
+"""
+def find_landmark_hashes(sample_blocks):
+    peak_frames, peak_bins = find_spectrum_peaks(iter_log_spectrum(sample_blocks))
+    if len(peak_frames) == 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+
+    # pair each peak with the FAN_OUT peaks after it (within MAX_PAIR_FRAMES)
+    landmarks = []
+    for offset in range(1, FAN_OUT + 1):
+        delta = peak_frames[offset:] - peak_frames[:-offset]
+        in_zone = (delta > 0) & (delta <= MAX_PAIR_FRAMES)
+        # hash = first bin (9 bits) | second bin (9 bits) | steps between (6 bits)
+        hashes = ((peak_bins[:-offset][in_zone].astype(np.uint64) << 15)
+                  | (peak_bins[offset:][in_zone].astype(np.uint64) << 6)
+                  | (delta[in_zone] // PAIR_FRAMES_STEP).astype(np.uint64))
+        # landmark = hash (high 32 bits) | frame of the first peak (low 32 bits)
+        landmarks.append((hashes << 32) | peak_frames[:-offset][in_zone].astype(np.uint64))
+    landmarks = np.unique(np.concatenate(landmarks))
+    return (landmarks >> 32).astype(np.uint32), (landmarks & 0xFFFFFFFF).astype(np.uint32)
+
+"""
+make the log magnitude spectrogram of the given samples as they are read,
+the samples of the frames that span a block edge are carried over
+
+    sample_blocks: an iterable of float arrays of the mono samples
+
+    returns: a generator of arrays of the next frames, (frames, frequency bins)
+"""
+def iter_log_spectrum(sample_blocks):
+    window = np.hanning(FFT_SIZE).astype(np.float32)
+    samples = np.zeros(0, dtype=np.float32)
+    for block in sample_blocks:
+        samples = np.concatenate((samples, block))
+        if len(samples) < FFT_SIZE:
+            continue
+        frames = np.lib.stride_tricks.sliding_window_view(samples, FFT_SIZE)[::HOP_SIZE]
+        spectrum = np.abs(np.fft.rfft(frames * window, axis=1))
+        yield 20 * np.log10(spectrum + 1e-6)
+        samples = samples[len(frames) * HOP_SIZE:]
+
+"""
+find the peaks of the log spectrogram, the points that are the max of their
+neighbourhood and not too quiet compared to the loudest point. The spectrogram
+is searched FINGERPRINT_BLOCK_FRAMES frames at a time, with the frames of the
+neighbourhood across each block edge carried over, so the peaks are the same
+as for the whole spectrogram (bar the loudest point, which is that of the block).
+
+    spectrum_blocks: an iterable of arrays of the next frames, (frames, frequency bins)
+
+    returns: (int array of the frame of each peak, int array of its frequency bin),
+             ordered by frame
+"""
+def find_spectrum_peaks(spectrum_blocks):
+    from scipy.ndimage import maximum_filter
+    radius = PEAK_NEIGHBOURHOOD[0] // 2
+    peak_frames, peak_bins = [], []
+    # the frames still needed, starting at frame spectrum_start
+    spectrum = None
+    spectrum_start = 0
+    # the first frame not yet searched
+    next_frame = 0
+    for block in chain(spectrum_blocks, [None]):
+        if block is not None:
+            spectrum = block if spectrum is None else np.concatenate((spectrum, block))
+        if spectrum is None:
+            break
+        end = spectrum_start + len(spectrum)
+        # search the blocks whose neighbourhoods have all been read
+        # (and all of the remaining frames once the whole file has been read)
+        while next_frame < end and (block is None or end - next_frame >= FINGERPRINT_BLOCK_FRAMES + radius):
+            stop = min(next_frame + FINGERPRINT_BLOCK_FRAMES, end)
+            window_start = max(spectrum_start, next_frame - radius)
+            window = spectrum[window_start - spectrum_start : min(end, stop + radius) - spectrum_start]
+            in_block = slice(next_frame - window_start, stop - window_start)
+            log_spectrum = window[in_block]
+            is_peak = ((log_spectrum == maximum_filter(window, size=PEAK_NEIGHBOURHOOD)[in_block])
+                       & (log_spectrum > log_spectrum.max() - PEAK_RANGE_DB))
+            frames, bins = np.nonzero(is_peak)
+            # (np.nonzero already orders the peaks by frame)
+            peak_frames.append(frames + next_frame)
+            peak_bins.append(bins)
+            next_frame = stop
+
+        # drop the frames outside the neighbourhood of the frames still to search
+        drop = max(spectrum_start, next_frame - radius)
+        spectrum = spectrum[drop - spectrum_start:]
+        spectrum_start = drop
+
+    if not peak_frames:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(peak_frames), np.concatenate(peak_bins)
+
+"""
+find the fraction of the landmarks of the smaller of the two files that
+they share at the same time offset
+
+    returns: the similarity from 0 to 1
+"""
+def get_similarity(fingerprint_a, fingerprint_b):
+    index = HashIndex()
+    index.add(fingerprint_a)
+    shared = index.count_aligned(fingerprint_b)
+    smaller = min(len(fingerprint_a.hashes), len(fingerprint_b.hashes))
+    return float(shared[0]) / smaller if smaller else 0.0
+
+
+
+
+#---------------------------------------#
+# FINDING DUPLICATES
+#---------------------------------------#
+
+"""
+An inverted index of the landmarks of the kept files. For each kept file the
+landmarks a file shares with it are counted by their time offset (the frame
+in the kept file minus the frame in this file). A copy shares its landmarks
+at one offset (where it sits within the kept file), whereas the hashes a long
+recording shares with an unrelated file by chance are spread over all the
+offsets, so the count at the best offset finds every copy however different
+the two files are in length (e.g. a short excerpt of a long recording)
+"""
+class HashIndex:
+    def __init__(self):
+        # landmark hash -> list of (number of the kept fingerprint << 32 | frame of the landmark)
+        self.postings = {}
+        self.fingerprints = []
+        self.num_hashes = []
+
+    """
+    find the fingerprints already in the index that share at least
+    NEAR_DUPLICATE_SIMILARITY of the landmarks of the smaller of the two
+    files at the same time offset
+
+        returns: a list of (kept Fingerprint, similarity)
+    """
+    def query(self, fingerprint):
+        shared = self.count_aligned(fingerprint)
+        similarity = shared / np.maximum(np.minimum(np.array(self.num_hashes), len(fingerprint.hashes)), 1)
+        matches = np.nonzero((shared >= MIN_SHARED_HASHES) & (similarity >= NEAR_DUPLICATE_SIMILARITY))[0]
+        return [(self.fingerprints[number], float(similarity[number])) for number in matches]
+
+    """
+    count the landmarks the fingerprint shares with each kept fingerprint at
+    their best time offset (counting the offsets within OFFSET_TOLERANCE_FRAMES
+    of it too)
+
+        returns: int array of the count for each kept fingerprint (by number)
+    """
+    def count_aligned(self, fingerprint):
+        shared = np.zeros(len(self.fingerprints), dtype=np.int64)
+        found = [(self.postings[h], frame) for h, frame
+                 in zip(fingerprint.hashes.tolist(), fingerprint.frames.tolist()) if h in self.postings]
+        if not found:
+            return shared
+        entries = np.fromiter(chain.from_iterable(postings for postings, _ in found), dtype=np.int64)
+        frames = np.repeat(np.array([frame for _, frame in found], dtype=np.int64),
+                           [len(postings) for postings, _ in found])
+        # key = number of the kept fingerprint (high 32 bits) | time offset (low 32 bits, biased)
+        offsets = (entries & 0xFFFFFFFF) - frames + (1 << 31)
+        keys, counts = np.unique(((entries >> 32) << 32) | offsets, return_counts=True)
+
+        # add in the counts of the nearby offsets (of the same kept fingerprint)
+        near_counts = counts.copy()
+        for step in range(1, OFFSET_TOLERANCE_FRAMES + 1):
+            for near_keys in (keys - step, keys + step):
+                positions = np.minimum(np.searchsorted(keys, near_keys), len(keys) - 1)
+                near_counts += np.where(keys[positions] == near_keys, counts[positions], 0)
+        np.maximum.at(shared, keys >> 32, near_counts)
+        return shared
+
+    """
+    add the fingerprint to the index
+    """
+    def add(self, fingerprint):
+        number = len(self.fingerprints)
+        self.fingerprints.append(fingerprint)
+        self.num_hashes.append(len(fingerprint.hashes))
+        for h, frame in zip(fingerprint.hashes.tolist(), fingerprint.frames.tolist()):
+            self.postings.setdefault(h, []).append((number << 32) | frame)
+
+"""
+find the duplicates within the given fingerprints. The first fingerprint of each
+cluster (in the given order) is the one that is kept.
+
+    fingerprints: a list of Fingerprints, in order of preference
+
+    returns: a list of clusters, each a dict of the kept path and a list of its
+             duplicates (path, similarity and whether it is an exact duplicate)
+"""
+def find_duplicate_clusters(fingerprints):
+    index = HashIndex()
+    # the first file with each content hash
+    by_content_hash = {}
+    # kept path -> the cluster of that file
+    clusters = {}
+    for fingerprint in fingerprints:
+        kept, similarity, exact = find_kept_match(fingerprint, index, by_content_hash)
+        if kept is None:
+            # a new file, it is kept
+            by_content_hash[fingerprint.content_hash] = fingerprint
+            index.add(fingerprint)
+            continue
+        cluster = clusters.setdefault(kept.path, {"kept": kept.path, "duplicates": []})
+        cluster["duplicates"].append({"path": fingerprint.path, "similarity": round(similarity, 3),
+                                      "exact": exact})
+    return list(clusters.values())
+
+"""
+find the kept file that the given file duplicates, if any
+
+    returns: (the kept Fingerprint or None, the similarity, whether it is an exact duplicate)
+"""
+def find_kept_match(fingerprint, index, by_content_hash):
+    if fingerprint.content_hash in by_content_hash:
+        return by_content_hash[fingerprint.content_hash], 1.0, True
+
+    best, best_similarity = None, 0.0
+    for candidate, similarity in index.query(fingerprint):
+        if similarity > best_similarity:
+            best, best_similarity = candidate, similarity
+    return best, best_similarity, False
+
+
+
+
+#---------------------------------------#
+# FINGERPRINT STORE HELPERS
+#---------------------------------------#
+
+"""
+load the fingerprint of the given file from the catalog
+
+    stat: the os.stat of the file
+
+    returns: the Fingerprint, or None if it is not there or the file has changed
+"""
+def load_fingerprint(file, stat):
+    if not fdef.USE_FILE_CATALOG:
+        return None
+    row = get_fingerprint_connection().execute(
+        "SELECT content_hash, hashes, frames FROM fingerprints WHERE path = ? AND size = ? AND mtime = ?",
+        (os.path.normpath(file), stat.st_size, stat.st_mtime_ns)).fetchone()
+    # (a fingerprint saved before the frames were kept is made again)
+    if row is None or row[2] is None:
+        return None
+    content_hash, hashes, frames = row
+    return Fingerprint(file, content_hash, np.frombuffer(hashes, dtype=np.uint32),
+                       np.frombuffer(frames, dtype=np.uint32))
+
+"""
+save the fingerprint of the file to the catalog
+
+    stat: the os.stat of the file when it was fingerprinted
+"""
+def save_fingerprint(fingerprint, stat):
+    if not fdef.USE_FILE_CATALOG:
+        return
+    conn = get_fingerprint_connection()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO fingerprints (path, size, mtime, content_hash, hashes, frames) "
+                     "VALUES (?, ?, ?, ?, ?, ?)",
+                     (os.path.normpath(fingerprint.path), stat.st_size, stat.st_mtime_ns,
+                      fingerprint.content_hash, fingerprint.hashes.astype(np.uint32).tobytes(),
+                      fingerprint.frames.astype(np.uint32).tobytes()))
+
+"""
+get the connection to the catalog, with the fingerprints table made
+"""
+def get_fingerprint_connection():
+    global fingerprint_table_path
+    conn = ch.get_connection()
+    if fingerprint_table_path != fdef.CATALOG_PATH:
+        conn.executescript(FINGERPRINT_SCHEMA)
+        # a table made before the frames were kept
+        if "frames" not in [column[1] for column in conn.execute("PRAGMA table_info(fingerprints)")]:
+            with conn:
+                conn.execute("ALTER TABLE fingerprints ADD COLUMN frames BLOB")
+        fingerprint_table_path = fdef.CATALOG_PATH
+    return conn
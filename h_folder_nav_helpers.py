@@ -1,202 +1,812 @@
-# Internal helpers and definitions
-import h_FOLDER_DEFINITIONS as fdef
-# modules used for folder naviation
-import os
-# modules used for audio processing
-from pydub import AudioSegment
-import librosa
-import wave
-# used for graphing the audio files
-import matplotlib.pyplot as plt
-import numpy as np
-import math
-from scipy.io import wavfile
-
-
-
-
-#---------------------------------------#
-# FOLDER HELPERS
-#---------------------------------------#
-
-# find a list of all the paths in the given direcotry
-def make_path_list(directory):
-    path_list = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            path_list.append(file_path)
-    return path_list
-
-# get the category of the file
-def get_category(file):
-    return os.path.basename(file).split("_")[0]
-
-# clean all files from the given directory
-def clean_folder(directory):
-    print(f"Cleaning...")
-    for root, _, files in os.walk(directory):
-        for file in files:
-            file_path = os.path.join(root, file)
-            os.remove(file_path)
-    print(f"Cleaning finished")
-
-
-
-
-#---------------------------------------#
-# AUDIO FILE MODIFCATION HELPERS
-#---------------------------------------#
-
-"""
-save the new wav file to the relevant folder
-    file_path: is the path to the original file
-"""
-def save_new_wav(file_path, new_audio, dest_partent_folder, generate_output_file_name, end_tag=None):
-    # find the path the relevant subfolder within the data folder
-    # e.g. we want /Positive/Annoyance_Meow/
-    # Extract the last two subfolders
-    subfolders = os.path.dirname(file_path).split(os.path.sep)[-2:]
-    # Join the subfolders back into a path
-    subfolder_path = os.path.sep.join(subfolders)
-
-    # define the new data location folder
-    new_file_location = os.path.join(dest_partent_folder, subfolder_path)
-    # make the the needed direcotries if not present
-    os.makedirs(new_file_location, exist_ok=True)
-
-    # define the output filename
-    # Extract the old file name without the extension
-    old_file_name = os.path.splitext(os.path.basename(file_path))[0]
-    # design the new file name
-    if end_tag: # if we have a special end tag
-        new_file_name = generate_output_file_name(old_file_name, end_tag)
-    else:
-        new_file_name = generate_output_file_name(old_file_name)
-
-    # Export the mono audio to the specified folder
-    output_path = os.path.join(new_file_location, new_file_name)
-    new_audio.export(output_path, format='wav')
-
-    return output_path
-
-
-
-#---------------------------------------#
-# AUDIO FILE GRAPHING HELPERS
-#---------------------------------------#
-
-"""
-display the properties of the audio file
-"""
-def display_wav_data(file):
-    # Open the WAV file
-    with wave.open(file, 'rb') as wav_file:
-        # Get the number of channels
-        num_channels = wav_file.getnchannels()
-        print("Number of Channels:", num_channels)
-
-        # Get the sampling frequency
-        sample_rate = wav_file.getframerate()
-        print("Sampling Frequency:", sample_rate)
-
-"""
-compare the two given audio files highlighing the section in the first audio file
-that exceeds the amplitude threshold and was thus extracted to make the second audio file
-    old_file: the original audio file
-    new_file: the extracted audio file
-    first_exceeding_time: the time in seconds at which the audio first exceeds the amplitude threshold
-    last_exceeding_time: the time in seconds at which the audio last exceeds the amplitude threshold
-"""
-def compare_extracted_target_graph(old_file, new_file, first_exceeding_time, last_exceeding_time):
-    # Load the first WAV file using PyDub
-    audio_file_old = AudioSegment.from_wav(old_file)
-    # Convert the audio into a NumPy array
-    audio_array_old = np.array(audio_file_old.get_array_of_samples()) / fdef.MAX_16BIT_AMP
-    # Load the second WAV file using PyDub
-    audio_file2 = AudioSegment.from_wav(new_file)
-    # Convert the audio into a NumPy array
-    audio_array2 = np.array(audio_file2.get_array_of_samples()) / fdef.MAX_16BIT_AMP
-    # Create the time array for the first waveform
-    time1 = np.arange(len(audio_array_old)) / audio_file_old.frame_rate
-    # Create the time array for the second waveform
-    time2 = np.arange(len(audio_array2)) / audio_file2.frame_rate
-
-    # Create subplots with shared y-axis
-    fig, (ax1, ax2) = plt.subplots(1, 2, sharey=True)
-
-    # plot the org audio file
-    time = np.arange(len(audio_array_old)) / audio_file_old.frame_rate
-    ax1.plot(time, audio_array_old, color='lightskyblue')
-
-    # Highlight the exceeding section
-    # Find the indices within the specified range
-    target_indices = np.where((time >= first_exceeding_time) & (time <= last_exceeding_time))[0]
-    target_leadin_indices = np.where((time >= first_exceeding_time - LEAD_IN_TIME) 
-                                     & (time <= last_exceeding_time + LEAD_IN_TIME))[0]
-    # Highlight the lead in time
-    ax1.plot(time[target_leadin_indices], audio_array_old[target_leadin_indices], color='pink')
-    # Highlight the points within the specified range in red
-    ax1.plot(time[target_indices], audio_array_old[target_indices], color='lightcoral')
-    # Set labels and title for the graph
-    ax1.set(xlabel='Time (seconds)', ylabel='Amplitude', title='Original File')
-    ax1.grid(True)
-
-    # Plot trimed target audio file
-    ax2.plot(time2, audio_array2, color='lightcoral')
-    ax2.set(xlabel='Time (seconds)', ylabel='Amplitude', title='Target File')
-    ax2.grid(True)
-
-    file_name = "_".join(os.path.basename(old_file).split("_")[:3])
-    fig.suptitle(file_name)
-    # Adjust the spacing between subplots
-    plt.tight_layout()
-    # Show the graph
-    plt.show()
-
-"""
-display two graphs amplitudes overlayed on top of each other
-"""
-def display_amp_graph(file_old, file_new):
-    # OLD AUDIO FILE
-    # Load the audio file
-    o_sample_rate, o_audio_data = wavfile.read(file_old)
-    # Extract the amplitude values
-    o_amplitude = o_audio_data / fdef.MAX_16BIT_AMP
-    # Create the time axis
-    o_time = np.arange(0, len(o_amplitude)) / o_sample_rate
-
-    # NEW AUDIO FILE
-    # Load the audio file
-    n_sample_rate, n_audio_data = wavfile.read(file_new)
-    # Extract the amplitude values
-    n_amplitude = n_audio_data / fdef.MAX_16BIT_AMP
-    # Create the time axis
-    n_time = np.arange(0, len(n_amplitude)) / n_sample_rate
-
-    # Create the figure and subplots
-    # if the old amp is larger i.e. we are decreasing the amp
-    if max(o_amplitude) > max(n_amplitude):
-        # we want to overlay the new amp on top of the old amp
-        plt.plot(o_time, o_amplitude, color='lightskyblue', label="Original Audio")
-        plt.plot(n_time, n_amplitude, color='lightcoral', label="Normalised Audio")
-    else: # if the new amp is larger i.e. we are increasing the amp
-        # we want to overlay the old amp on top of the new amp
-        plt.plot(n_time, n_amplitude, color='lightcoral', label="Normalised Audio")
-        plt.plot(o_time, o_amplitude, color='lightskyblue', label="Original Audio")
-
-    plt.xlabel('Time (s)')
-    plt.ylabel('Amplitude')
-    #ax1.set_title('Old Audio')
-    plt.grid(True)
-
-    # Display the legend
-    plt.legend(loc='upper right', title='Legend', fontsize='medium')
-
-    # put the title as the file source part of the file name
-    file_name = "_".join(os.path.basename(file_old).split("_")[:3])
-    plt.suptitle(file_name)
-    # Adjust the spacing between subplots
-    plt.tight_layout()
-    # Display the plot
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+import h_instrumentation_helpers as ih
+import h_writer_helpers as wh
+import h_reader_helpers as rh
+# modules used for folder naviation
+import os
+import shutil
+import io
+# modules used for audio processing
+# (pydub, matplotlib and scipy are slow to import, so they are
+# only imported within the functions that need them)
+import numpy as np
+import math
+import struct
+
+
+
+
+#---------------------------------------#
+# FOLDER HELPERS
+#---------------------------------------#
+
+# find a list of all the paths in the given direcotry
+def make_path_list(directory):
+    path_list = []
+    for root, _, files in os.walk(directory):
+        for file in files:
+            # skip the files that are still being written
+            if file.endswith(wh.TEMP_FILE_SUFFIX):
+                continue
+            file_path = os.path.join(root, file)
+            path_list.append(file_path)
+    return path_list
+
+# get the category of the file
+def get_category(file):
+    return os.path.basename(file).split("_")[0]
+
+# clean all files from the given directory
+def clean_folder(directory):
+    print(f"Cleaning...")
+    for root, _, files in os.walk(directory):
+        for file in files:
+            file_path = os.path.join(root, file)
+            os.remove(file_path)
+    print(f"Cleaning finished")
+
+"""
+Put a copy of the source file at the destination, without duplicating the data
+on disk where possible. A hardlink is used when both are on the same filesystem,
+a copy-on-write clone (reflink) when the filesystem supports it, and a plain
+copy otherwise. Any existing file at the destination is replaced.
+
+    source: the path to the file we are copying
+    destination: the path to the new file
+    link_mode: "hardlink", "reflink" or "copy" (see f1 LINK_MODE)
+
+    returns: the method that was used, "hardlink", "reflink" or "copy"
+"""
+def link_or_copy_file(source, destination, link_mode="hardlink"):
+    # made under a temporary name and renamed into place,
+    # so the destination is never left half copied
+    temp_path = wh.get_temp_path(destination)
+    try:
+        method = link_or_copy_to(source, temp_path, link_mode)
+        os.replace(temp_path, destination)
+        # the rename does nothing if the destination is already a hardlink to the source
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+    except BaseException:
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        raise
+    return method
+
+"""
+link, clone or copy the source file to the (new) destination, see link_or_copy_file
+"""
+def link_or_copy_to(source, destination, link_mode):
+    if link_mode == "hardlink":
+        try:
+            os.link(source, destination)
+            return "hardlink"
+        except OSError:
+            pass # e.g. a different filesystem, fall back to a reflink or copy
+
+    if link_mode in ("hardlink", "reflink") and reflink_file(source, destination):
+        return "reflink"
+
+    shutil.copy(source, destination)
+    return "copy"
+
+"""
+Clone the source file to the destination using a copy-on-write reflink
+(e.g. on btrfs or XFS). Nothing is left at the destination if this fails.
+
+    returns: True if the clone was made, False otherwise
+"""
+def reflink_file(source, destination):
+    try:
+        import fcntl
+    except ImportError: # not available on windows
+        return False
+
+    # the FICLONE ioctl request number (linux)
+    FICLONE = 0x40049409
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+
+
+
+#---------------------------------------#
+# AUDIO FILE MODIFCATION HELPERS
+#---------------------------------------#
+
+"""
+save the new wav file to the relevant folder
+    file_path: is the path to the original file
+"""
+def save_new_wav(file_path, new_audio, dest_partent_folder, generate_output_file_name, end_tag=None):
+    output_path = make_new_wav_path(file_path, dest_partent_folder, generate_output_file_name, end_tag)
+
+    # Export the mono audio to the specified folder
+    # (the needed direcotries are made by the writer if not present)
+    with ih.span("encode"):
+        wav_buffer = io.BytesIO()
+        new_audio.export(wav_buffer, format='wav')
+    with ih.span("write"):
+        wh.write_file(output_path, [wav_buffer.getbuffer()])
+    ih.add_counts(bytes_written=wav_buffer.getbuffer().nbytes)
+
+    return output_path
+
+"""
+find the path that save_new_wav would write the new wav file to,
+without writing anything
+    file_path: is the path to the original file
+"""
+def make_new_wav_path(file_path, dest_partent_folder, generate_output_file_name, end_tag=None):
+    # find the path the relevant subfolder within the data folder
+    # e.g. we want /Positive/Annoyance_Meow/
+    # Extract the last two subfolders
+    subfolders = os.path.dirname(file_path).split(os.path.sep)[-2:]
+    # Join the subfolders back into a path
+    subfolder_path = os.path.sep.join(subfolders)
+
+    # define the new data location folder
+    new_file_location = os.path.join(dest_partent_folder, subfolder_path)
+
+    # define the output filename
+    # Extract the old file name without the extension
+    old_file_name = os.path.splitext(os.path.basename(file_path))[0]
+    # design the new file name
+    if end_tag: # if we have a special end tag
+        new_file_name = generate_output_file_name(old_file_name, end_tag)
+    else:
+        new_file_name = generate_output_file_name(old_file_name)
+
+    return os.path.join(new_file_location, new_file_name)
+
+"""
+save the new 16 bit samples as a wav file to the relevant folder
+(the same location and name as save_new_wav)
+    file_path: is the path to the original file
+    samples: int16 array of shape (frames,) or (frames, channels)
+"""
+def save_new_wav_samples(file_path, samples, sample_rate, dest_partent_folder, generate_output_file_name, end_tag=None):
+    output_path = make_new_wav_path(file_path, dest_partent_folder, generate_output_file_name, end_tag)
+    # the needed direcotries are made by the writer if not present
+    write_wav_pcm16(output_path, samples, sample_rate)
+
+    return output_path
+
+
+
+#---------------------------------------#
+# WAV FILE HELPERS
+#---------------------------------------#
+# these read and write 16 bit PCM wav files directly as numpy arrays
+# (without going through pydub), the samples are memory mapped from the
+# file so only the pages that are actually used are read, or taken from
+# the bytes of the file when it has been read ahead (see h_reader_helpers)
+
+# the wav format tags for PCM data
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+"""
+read the header of the given wav file
+    file: the path to the wav file
+
+    returns: a dict of format_tag, channels, sample_rate, bits_per_sample,
+             data_offset (bytes) and frames
+"""
+def read_wav_header(file):
+    buffer = rh.get_file_buffer(file)
+    with open(file, 'rb') if buffer is None else io.BytesIO(buffer) as f:
+        return parse_wav_header(f, file)
+
+"""
+read the header of the wav file open as f (from the start), see read_wav_header
+    f: the binary file object
+    file: the path to the wav file (for the error messages)
+"""
+def parse_wav_header(f, file):
+    riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise ValueError(f"File {file} is not a RIFF/WAVE file")
+    file_size = f.seek(0, os.SEEK_END)
+    f.seek(12)
+
+    header = None
+    # walk the chunks until we find the data chunk
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError(f"File {file} has no data chunk")
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+
+        if chunk_id == b'fmt ':
+            fmt = f.read(chunk_size)
+            format_tag, channels, sample_rate, _, _, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+            # the extensible format holds the real format in the sub format guid
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                format_tag = struct.unpack('<H', fmt[24:26])[0]
+            header = {"format_tag": format_tag, "channels": channels,
+                      "sample_rate": sample_rate, "bits_per_sample": bits_per_sample}
+            # chunks are padded to an even number of bytes
+            f.seek(chunk_size % 2, os.SEEK_CUR)
+
+        elif chunk_id == b'data':
+            if header is None:
+                raise ValueError(f"File {file} has no fmt chunk before the data chunk")
+            data_offset = f.tell()
+            # streamed wav files may not fill in the data size
+            data_size = min(chunk_size, file_size - data_offset)
+            frame_size = header["channels"] * header["bits_per_sample"] // 8
+            header["data_offset"] = data_offset
+            header["frames"] = data_size // frame_size
+            return header
+
+        else:
+            f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+"""
+check if the wav header is for 16 bit PCM data
+"""
+def is_pcm16(header):
+    return header["format_tag"] == WAVE_FORMAT_PCM and header["bits_per_sample"] == 16
+
+"""
+read the samples of a 16 bit PCM wav file as a read-only memory mapped array
+(or a read-only view of its bytes, if it has been read ahead)
+    file: the path to the wav file
+
+    returns: (int16 array of shape (frames, channels), sample_rate)
+"""
+def read_wav_pcm16(file):
+    header = read_wav_header(file)
+    if not is_pcm16(header):
+        raise ValueError(f"File {file} is not a 16 bit PCM wav file")
+
+    shape = (header["frames"], header["channels"])
+    if header["frames"] == 0: # an empty file can not be memory mapped
+        return np.zeros(shape, dtype=np.int16), header["sample_rate"]
+    buffer = rh.get_file_buffer(file)
+    if buffer is not None:
+        samples = np.frombuffer(buffer, dtype='<i2', count=shape[0] * shape[1], offset=header["data_offset"])
+        return samples.reshape(shape), header["sample_rate"]
+    samples = np.memmap(file, dtype='<i2', mode='r', offset=header["data_offset"], shape=shape)
+    # a plain array view, the memory map stays open while the view is in use
+    return samples.view(np.ndarray), header["sample_rate"]
+
+"""
+write the samples to a 16 bit PCM wav file. The header is written followed
+directly by the sample buffer, no copy is made if the samples are already
+contiguous little endian int16, so the samples must not be changed
+afterwards (within wh.background_writes() they are written later).
+    file: the path to the new wav file
+    samples: int16 array of shape (frames,) or (frames, channels)
+    sample_rate: the sample rate of the samples
+"""
+def write_wav_pcm16(file, samples, sample_rate):
+    with ih.span("encode"):
+        samples = np.ascontiguousarray(samples, dtype='<i2')
+        channels = 1 if samples.ndim == 1 else samples.shape[1]
+        header = make_wav_pcm16_header(samples.nbytes, channels, sample_rate)
+    # within wh.background_writes() the file is written by the i/o threads
+    with ih.span("write"):
+        wh.write_file(file, [header, memoryview(samples).cast('B')])
+    ih.add_counts(bytes_written=len(header) + samples.nbytes)
+
+"""
+make the 44 byte header of a 16 bit PCM wav file
+    data_size: the number of bytes of sample data
+    channels: the number of channels
+    sample_rate: the sample rate of the samples
+
+    returns: the header bytes
+"""
+def make_wav_pcm16_header(data_size, channels, sample_rate):
+    block_align = channels * 2
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+                       b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, WAVE_FORMAT_PCM, channels, sample_rate,
+                       sample_rate * block_align, block_align, 16,
+                       b'data', data_size)
+
+"""
+read the samples of a 16 bit PCM wav file a block at a time. Each block is
+read into a new buffer (rather than memory mapped), so only one block is
+held in memory at once however long the file is.
+    file: the path to the wav file
+    block_frames: the number of frames in each block (the last may be shorter),
+                  None uses fdef.STREAM_BLOCK_FRAMES
+
+    returns: a generator of int16 arrays of shape (frames, channels)
+"""
+def iter_wav_pcm16_blocks(file, block_frames=None):
+    block_frames = block_frames or fdef.STREAM_BLOCK_FRAMES
+    header = read_wav_header(file)
+    if not is_pcm16(header):
+        raise ValueError(f"File {file} is not a 16 bit PCM wav file")
+
+    channels = header["channels"]
+    with open(file, 'rb') as f:
+        f.seek(header["data_offset"])
+        for start in range(0, header["frames"], block_frames):
+            count = min(block_frames, header["frames"] - start) * channels
+            with ih.span("decode"):
+                block = np.fromfile(f, dtype='<i2', count=count).reshape(-1, channels)
+            ih.add_counts(bytes_read=block.nbytes, samples=block.size)
+            yield block
+
+"""
+write blocks of samples to a 16 bit PCM wav file as they are produced. The
+sizes in the header are filled in once the last block has been written,
+and the file is then renamed into place (see wh.write_file_now).
+    file: the path to the new wav file
+    blocks: an iterable of int16 arrays of shape (frames,) or (frames, channels)
+    channels: the number of channels of the blocks
+    sample_rate: the sample rate of the samples
+"""
+def write_wav_pcm16_blocks(file, blocks, channels, sample_rate):
+    temp_file = wh.get_temp_path(file)
+    try:
+        with open(temp_file, 'wb') as f:
+            f.write(make_wav_pcm16_header(0, channels, sample_rate))
+            data_size = 0
+            for block in blocks:
+                with ih.span("write"):
+                    block = np.ascontiguousarray(block, dtype='<i2')
+                    f.write(memoryview(block).cast('B'))
+                data_size += block.nbytes
+            f.seek(0)
+            f.write(make_wav_pcm16_header(data_size, channels, sample_rate))
+        os.replace(temp_file, file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    ih.add_counts(bytes_written=44 + data_size)
+
+"""
+load the samples of the given audio file as 16 bit samples. 16 bit PCM wav files
+are memory mapped, anything else is decoded with pydub.
+    file: the path to the audio file
+
+    returns: (int16 array of shape (frames, channels), sample_rate)
+"""
+def load_wav_samples(file):
+    with ih.span("decode"):
+        try:
+            samples, sample_rate = read_wav_pcm16(file)
+        except ValueError:
+            from pydub import AudioSegment
+            samples, sample_rate = audio_segment_to_samples(AudioSegment.from_file(file))
+    ih.add_counts(bytes_read=samples.nbytes, samples=samples.size)
+    return samples, sample_rate
+
+"""
+get the samples of the given AudioSegment as 16 bit samples,
+without a copy when the AudioSegment is already 16 bit
+    audio: the AudioSegment
+
+    returns: (int16 array of shape (frames, channels), sample_rate)
+"""
+def audio_segment_to_samples(audio):
+    if audio.sample_width != 2:
+        audio = audio.set_sample_width(2)
+    samples = np.frombuffer(audio.raw_data, dtype='<i2').reshape(-1, audio.channels)
+    return samples, audio.frame_rate
+
+"""
+make an AudioSegment from the given 16 bit samples
+    samples: int16 array of shape (frames,) or (frames, channels)
+
+    returns: the AudioSegment
+"""
+def samples_to_audio_segment(samples, sample_rate):
+    from pydub import AudioSegment
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    return AudioSegment(data=np.ascontiguousarray(samples, dtype='<i2').tobytes(),
+                        sample_width=2, frame_rate=sample_rate, channels=channels)
+
+
+
+#---------------------------------------#
+# AUDIO SAMPLE HELPERS
+#---------------------------------------#
+# the number of samples checked at a time when scanning for a threshold
+SCAN_CHUNK_SIZE = 4096
+
+"""
+apply a gain to the 16 bit samples, with the same rounding and saturation
+as AudioSegment.apply_gain (i.e. audioop.mul)
+    samples: int16 array
+    gain_db: the gain in dB
+
+    returns: the new int16 array
+"""
+def apply_gain_samples(samples, gain_db):
+    return apply_gains_samples(samples, [gain_db])[0]
+
+"""
+apply several gains to the 16 bit samples in a single broadcast operation,
+with the same rounding and saturation as AudioSegment.apply_gain
+    samples: int16 array
+    gains_db: the list of gains in dB
+
+    returns: int16 array of shape (len(gains_db), *samples.shape)
+"""
+def apply_gains_samples(samples, gains_db):
+    # the factors are found the same way as pydub's db_to_float
+    factors = np.array([10 ** (float(gain_db) / 20) for gain_db in gains_db])
+    factors = factors.reshape((-1,) + (1,) * samples.ndim)
+
+    gained = samples[np.newaxis] * factors
+    # audioop.mul rounds towards minus infinity and saturates
+    np.floor(gained, out=gained)
+    np.clip(gained, -fdef.MAX_16BIT_AMP, fdef.MAX_16BIT_AMP - 1, out=gained)
+    return gained.astype(np.int16)
+
+"""
+get the given samples as a single channel (a view when they are already mono)
+    samples: int16 array of shape (frames,) or (frames, channels)
+
+    returns: int16 array of shape (frames,)
+"""
+def to_mono_samples(samples):
+    if samples.ndim == 1:
+        return samples
+    if samples.shape[1] == 1:
+        return samples[:, 0]
+    return np.floor(samples.mean(axis=1, dtype=np.float32)).astype(np.int16)
+
+"""
+convert an amplitude threshold (e.g. 0.5) to the 16 bit sample threshold,
+such that abs(sample) > int threshold <=> abs(sample) / MAX_16BIT_AMP > amp threshold
+
+    returns: the int threshold
+"""
+def amp_to_int_threshold(amp_threshold):
+    return int(math.floor(amp_threshold * fdef.MAX_16BIT_AMP))
+
+"""
+find the thresholds on the samples that select the same samples as comparing
+the gained samples (see apply_gain_samples) against +/- the int threshold.
+The gain rounds towards minus infinity, so the positive and negative samples
+each have their own threshold. The gain is applied to every int16 value, so
+the thresholds match the gained samples exactly.
+    threshold: the int sample threshold (see amp_to_int_threshold)
+    gain_db: the gain in dB
+
+    returns: (upper, lower) such that apply_gain_samples(s) > threshold <=> s > upper
+             and apply_gain_samples(s) < -threshold <=> s < lower
+"""
+def gained_thresholds(threshold, gain_db):
+    values = np.arange(-fdef.MAX_16BIT_AMP, fdef.MAX_16BIT_AMP, dtype=np.int16)
+    # the gained values rise with the values (the gain is positive)
+    gained = apply_gain_samples(values, gain_db)
+    upper = values[np.searchsorted(gained, threshold, side='right') - 1]
+    lower = values[np.searchsorted(gained, -threshold, side='left')]
+    return int(upper), int(lower)
+
+"""
+find the energy (sum of the squared samples) of each frame of the samples,
+from a single cumulative sum read at the frame edges with strided slices
+    samples: int16 array of shape (frames,)
+    frame_length, hop_length: the frame size and step, in samples
+
+    returns: int64 array of the energy of each frame
+"""
+def frame_energies(samples, frame_length, hop_length):
+    # a file shorter than a frame is a single (short) frame
+    frame_length = min(frame_length, len(samples))
+    if frame_length == 0:
+        return np.zeros(0, dtype=np.int64)
+    num_frames = 1 + (len(samples) - frame_length) // hop_length
+
+    # the squares are summed in place, int64 holds the sum of 2^33 full scale samples
+    cumulative = np.zeros(len(samples) + 1, dtype=np.int64)
+    np.square(samples, out=cumulative[1:], dtype=np.int64)
+    np.cumsum(cumulative[1:], out=cumulative[1:])
+    return (cumulative[frame_length : frame_length + num_frames * hop_length : hop_length]
+            - cumulative[0 : num_frames * hop_length : hop_length])
+
+"""
+convert a level in dB (relative to full scale) to the energy of a frame
+of the given length with that rms level (see frame_energies)
+"""
+def db_to_frame_energy(level_db, frame_length):
+    return 10 ** (level_db / 10) * fdef.MAX_16BIT_AMP ** 2 * frame_length
+
+"""
+find the first and last sample whose absolute value exceeds the threshold.
+The samples are scanned in chunks from the front until the first hit and
+from the back until the last hit, so for long files only the samples
+before the first and after the last hit are touched.
+    samples: int16 array of shape (frames,)
+    threshold: the int sample threshold (see amp_to_int_threshold)
+
+    returns: (first index, last index) or None if no sample exceeds the threshold
+"""
+def find_first_last_exceeding(samples, threshold, chunk_size=SCAN_CHUNK_SIZE):
+    first = find_exceeding(samples, threshold, chunk_size=chunk_size)
+    if first is None:
+        return None
+    # scan from the back, no further than the first hit
+    last = first + find_exceeding(samples[first:], threshold, from_back=True, chunk_size=chunk_size)
+    return first, last
+
+"""
+find the first (or last) sample whose absolute value exceeds the threshold,
+scanning in chunks and stopping at the first chunk with a hit
+    samples: int16 array of shape (frames,)
+    threshold: the int sample threshold (see amp_to_int_threshold)
+    from_back: scan from the back to find the last sample instead
+    lower_threshold: the samples below this exceed it too, None for -threshold
+                     (see gained_thresholds)
+
+    returns: the index of the sample, or None if no sample exceeds the threshold
+"""
+def find_exceeding(samples, threshold, from_back=False, chunk_size=SCAN_CHUNK_SIZE, lower_threshold=None):
+    if lower_threshold is None:
+        lower_threshold = -threshold
+    # the boolean buffers are reused for every chunk
+    exceeding = np.empty(min(chunk_size, len(samples)), dtype=bool)
+    below = np.empty_like(exceeding)
+
+    starts = range(0, len(samples), chunk_size)
+    for start in (reversed(starts) if from_back else starts):
+        chunk = samples[start : start + chunk_size]
+        hits, hits_below = exceeding[:len(chunk)], below[:len(chunk)]
+        # compare as int16 against +/- the threshold (abs(-32768) would overflow)
+        np.greater(chunk, threshold, out=hits)
+        np.less(chunk, lower_threshold, out=hits_below)
+        np.logical_or(hits, hits_below, out=hits)
+        if not hits.any():
+            continue
+        if from_back:
+            return start + len(chunk) - 1 - int(hits[::-1].argmax())
+        return start + int(hits.argmax())
+    return None
+
+"""
+find the gain that peak normalises audio with the given peak, the same
+as pydub's normalize(audio, headroom)
+    peak: the max absolute sample value
+    headroom: how far below full scale the peak should sit, in dB
+
+    returns: the gain in dB (0 for silent audio)
+"""
+def peak_normalise_gain_db(peak, headroom=1.0):
+    if peak == 0:
+        return 0.0
+    target_peak = fdef.MAX_16BIT_AMP * 10 ** (-headroom / 20)
+    # math.log(x, 10) rather than log10, as in pydub's ratio_to_db
+    return 20 * math.log(target_peak / peak, 10)
+
+"""
+find the max absolute sample value (as pydub's AudioSegment.max)
+    samples: int16 array
+
+    returns: the peak as an int
+"""
+def peak_of_samples(samples):
+    if len(samples) == 0:
+        return 0
+    return max(int(samples.max()), -int(samples.min()))
+
+
+# these work on a batch of clips of different lengths packed into one
+# buffer, so each step is a single numpy operation over the whole batch
+# rather than one per clip
+
+# the number of samples gained at a time by apply_clip_gains
+# (so the float working buffer stays in the cpu cache)
+GAIN_BLOCK_SAMPLES = 64 * 1024
+
+"""
+join the clips into one buffer, with the offset of each clip within it
+    clips: a list of int16 arrays of any shape (each is flattened)
+
+    returns: (int16 buffer, int64 array of the len(clips) + 1 clip offsets)
+"""
+def pack_clips(clips):
+    offsets = np.zeros(len(clips) + 1, dtype=np.int64)
+    np.cumsum([clip.size for clip in clips], out=offsets[1:])
+    if not clips:
+        return np.zeros(0, dtype=np.int16), offsets
+    return np.concatenate([clip.reshape(-1) for clip in clips]), offsets
+
+"""
+split the packed buffer back into the clips, with the shapes of the given clips
+
+    returns: a list of int16 arrays (views of the buffer)
+"""
+def unpack_clips(buffer, offsets, clips):
+    return [buffer[offsets[i] : offsets[i + 1]].reshape(clip.shape) for i, clip in enumerate(clips)]
+
+"""
+find the peak of each of the packed clips (as peak_of_samples)
+    buffer, offsets: the packed clips (see pack_clips)
+
+    returns: int64 array of the peak of each clip, 0 for an empty clip
+"""
+def peaks_of_clips(buffer, offsets):
+    peaks = np.zeros(len(offsets) - 1, dtype=np.int64)
+    # reduceat needs the empty clips left out, they add nothing to the clip before them
+    non_empty = offsets[:-1] < offsets[1:]
+    if non_empty.any():
+        starts = offsets[:-1][non_empty]
+        maxs = np.maximum.reduceat(buffer, starts).astype(np.int64)
+        mins = np.minimum.reduceat(buffer, starts).astype(np.int64)
+        peaks[non_empty] = np.maximum(maxs, -mins)
+    return peaks
+
+"""
+find the rms of each of the packed clips
+    buffer, offsets: the packed clips (see pack_clips)
+
+    returns: float array of the rms of each clip, 0 for an empty clip
+"""
+def rms_of_clips(buffer, offsets):
+    rms = np.zeros(len(offsets) - 1)
+    lengths = np.diff(offsets)
+    non_empty = lengths > 0
+    if non_empty.any():
+        squares = np.square(buffer, dtype=np.float64)
+        rms[non_empty] = np.sqrt(np.add.reduceat(squares, offsets[:-1][non_empty]) / lengths[non_empty])
+    return rms
+
+"""
+apply a gain to each of the packed clips in a single sweep over the buffer,
+with the same rounding and saturation as apply_gain_samples. The sweep goes
+GAIN_BLOCK_SAMPLES at a time through one small float buffer, rather than
+making a float copy of the whole batch.
+    buffer, offsets: the packed clips (see pack_clips)
+    gains_db: the gain of each clip in dB
+
+    returns: the int16 buffer of the gained clips
+"""
+def apply_clip_gains(buffer, offsets, gains_db):
+    gained = np.empty_like(buffer)
+    working = np.empty(GAIN_BLOCK_SAMPLES)
+    for clip_num, gain_db in enumerate(gains_db):
+        # the factors are found the same way as pydub's db_to_float
+        factor = 10 ** (float(gain_db) / 20)
+        for start in range(offsets[clip_num], offsets[clip_num + 1], GAIN_BLOCK_SAMPLES):
+            end = min(start + GAIN_BLOCK_SAMPLES, offsets[clip_num + 1])
+            block = working[: end - start]
+            np.multiply(buffer[start:end], factor, out=block)
+            # audioop.mul rounds towards minus infinity and saturates
+            np.floor(block, out=block)
+            np.clip(block, -fdef.MAX_16BIT_AMP, fdef.MAX_16BIT_AMP - 1, out=block)
+            gained[start:end] = block
+    return gained
+
+
+
+#---------------------------------------#
+# AUDIO FILE GRAPHING HELPERS
+#---------------------------------------#
+
+"""
+display the properties of the audio file
+"""
+def display_wav_data(file):
+    import wave
+    # Open the WAV file
+    with wave.open(file, 'rb') as wav_file:
+        # Get the number of channels
+        num_channels = wav_file.getnchannels()
+        print("Number of Channels:", num_channels)
+
+        # Get the sampling frequency
+        sample_rate = wav_file.getframerate()
+        print("Sampling Frequency:", sample_rate)
+
+"""
+compare the two given audio files highlighing the section in the first audio file
+that exceeds the amplitude threshold and was thus extracted to make the second audio file
+    old_file: the original audio file
+    new_file: the extracted audio file
+    first_exceeding_time: the time in seconds at which the audio first exceeds the amplitude threshold
+    last_exceeding_time: the time in seconds at which the audio last exceeds the amplitude threshold
+"""
+def compare_extracted_target_graph(old_file, new_file, first_exceeding_time, last_exceeding_time):
+    from pydub import AudioSegment
+    import matplotlib.pyplot as plt
+    # Load the first WAV file using PyDub
+    audio_file_old = AudioSegment.from_wav(old_file)
+    # Convert the audio into a NumPy array
+    audio_array_old = np.array(audio_file_old.get_array_of_samples()) / fdef.MAX_16BIT_AMP
+    # Load the second WAV file using PyDub
+    audio_file2 = AudioSegment.from_wav(new_file)
+    # Convert the audio into a NumPy array
+    audio_array2 = np.array(audio_file2.get_array_of_samples()) / fdef.MAX_16BIT_AMP
+    # Create the time array for the first waveform
+    time1 = np.arange(len(audio_array_old)) / audio_file_old.frame_rate
+    # Create the time array for the second waveform
+    time2 = np.arange(len(audio_array2)) / audio_file2.frame_rate
+
+    # Create subplots with shared y-axis
+    fig, (ax1, ax2) = plt.subplots(1, 2, sharey=True)
+
+    # plot the org audio file
+    time = np.arange(len(audio_array_old)) / audio_file_old.frame_rate
+    ax1.plot(time, audio_array_old, color='lightskyblue')
+
+    # Highlight the exceeding section
+    # Find the indices within the specified range
+    target_indices = np.where((time >= first_exceeding_time) & (time <= last_exceeding_time))[0]
+    target_leadin_indices = np.where((time >= first_exceeding_time - fdef.LEAD_IN_TIME) 
+                                     & (time <= last_exceeding_time + fdef.LEAD_IN_TIME))[0]
+    # Highlight the lead in time
+    ax1.plot(time[target_leadin_indices], audio_array_old[target_leadin_indices], color='pink')
+    # Highlight the points within the specified range in red
+    ax1.plot(time[target_indices], audio_array_old[target_indices], color='lightcoral')
+    # Set labels and title for the graph
+    ax1.set(xlabel='Time (seconds)', ylabel='Amplitude', title='Original File')
+    ax1.grid(True)
+
+    # Plot trimed target audio file
+    ax2.plot(time2, audio_array2, color='lightcoral')
+    ax2.set(xlabel='Time (seconds)', ylabel='Amplitude', title='Target File')
+    ax2.grid(True)
+
+    file_name = "_".join(os.path.basename(old_file).split("_")[:3])
+    fig.suptitle(file_name)
+    # Adjust the spacing between subplots
+    plt.tight_layout()
+    # Show the graph
+    plt.show()
+
+"""
+display two graphs amplitudes overlayed on top of each other
+"""
+def display_amp_graph(file_old, file_new):
+    import matplotlib.pyplot as plt
+    from scipy.io import wavfile
+    # OLD AUDIO FILE
+    # Load the audio file
+    o_sample_rate, o_audio_data = wavfile.read(file_old)
+    # Extract the amplitude values
+    o_amplitude = o_audio_data / fdef.MAX_16BIT_AMP
+    # Create the time axis
+    o_time = np.arange(0, len(o_amplitude)) / o_sample_rate
+
+    # NEW AUDIO FILE
+    # Load the audio file
+    n_sample_rate, n_audio_data = wavfile.read(file_new)
+    # Extract the amplitude values
+    n_amplitude = n_audio_data / fdef.MAX_16BIT_AMP
+    # Create the time axis
+    n_time = np.arange(0, len(n_amplitude)) / n_sample_rate
+
+    # Create the figure and subplots
+    # if the old amp is larger i.e. we are decreasing the amp
+    if max(o_amplitude) > max(n_amplitude):
+        # we want to overlay the new amp on top of the old amp
+        plt.plot(o_time, o_amplitude, color='lightskyblue', label="Original Audio")
+        plt.plot(n_time, n_amplitude, color='lightcoral', label="Normalised Audio")
+    else: # if the new amp is larger i.e. we are increasing the amp
+        # we want to overlay the old amp on top of the new amp
+        plt.plot(n_time, n_amplitude, color='lightcoral', label="Normalised Audio")
+        plt.plot(o_time, o_amplitude, color='lightskyblue', label="Original Audio")
+
+    plt.xlabel('Time (s)')
+    plt.ylabel('Amplitude')
+    #ax1.set_title('Old Audio')
+    plt.grid(True)
+
+    # Display the legend
+    plt.legend(loc='upper right', title='Legend', fontsize='medium')
+
+    # put the title as the file source part of the file name
+    file_name = "_".join(os.path.basename(file_old).split("_")[:3])
+    plt.suptitle(file_name)
+    # Adjust the spacing between subplots
+    plt.tight_layout()
+    # Display the plot
     plt.show()
\ No newline at end of file
@@ -0,0 +1,364 @@
+"""
+Per-file instrumentation shared by all the stages.
+
+For each file a stage processes a record is kept of the time spent in each
+sub-step (decode, transform, encode, write) along with the bytes read, bytes
+written and samples decoded. The records are written as json lines, one file
+per process, so the stages record the same way whether they run serially or
+spread over worker processes:
+
+    {INSTRUMENTATION_FOLDER}/{run id}/{stage name}_{pid}.jsonl
+
+At the end of a run the records of every process are summarised as the
+p50/p95/p99 latency of each sub-step, along with the slowest files.
+
+The stages mark their sub-steps with
+    with ih.span("transform"):
+        ...
+the spans are exclusive, time spent in a nested span is not also counted
+in the span around it.
+
+A batch of files processed together still gets one record per file. The
+batch jobs mark the work of each file of the batch with
+    with ih.batch_file(file):
+        ...
+and the time (and counts) of the batch outside of these blocks (e.g. the
+transform of the whole batch at once) is split evenly over its files.
+"""
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+# folder navigation modules
+import os
+import glob
+# modules used for timing and recording the files
+from contextlib import contextmanager
+import json
+import time
+import numpy as np
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the environment variable holding the id of the current run
+# (so the worker processes write to the same run folder)
+RUN_ID_ENV_VAR = "CATSCAT_INSTRUMENTATION_RUN_ID"
+# the percentiles printed in the summary
+SUMMARY_PERCENTILES = [50, 95, 99]
+# the number of slowest files printed in the summary
+NUM_SLOWEST_FILES = 5
+#---------------------------------------#
+
+#---------------------------------------#
+# GOBAL VARIABLE TRACKERS
+#---------------------------------------#
+# the record of the file (or batch) currently being processed in this process
+current_record = None
+# the file of the batch the spans and counts are currently charged to (if any)
+current_batch_file = None
+# the stack of open spans, [sub-step, time it was last (re)started]
+open_spans = []
+# the number of files started in this process (the number of the current file)
+files_started = 0
+# the open records file of this process, and the path it was opened for
+records_file = None
+records_path = None
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# RUN HELPERS
+#---------------------------------------#
+
+"""
+start a new run of the given stage, the records of this process
+and of any worker processes started after this are kept together
+"""
+def start_run(stage_name):
+    global files_started
+    files_started = 0
+    if fdef.INSTRUMENT_STAGES:
+        os.environ[RUN_ID_ENV_VAR] = f"{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}"
+
+"""
+finish the run of the given stage, print the summary of its records
+and write it next to the records
+
+    returns: the summary dict, or None if the stages are not instrumented
+             (or no files were recorded)
+"""
+def finish_run(stage_name):
+    close_records_file()
+    if not fdef.INSTRUMENT_STAGES or RUN_ID_ENV_VAR not in os.environ:
+        return None
+
+    run_folder = get_run_folder()
+    records = load_records(run_folder, stage_name)
+    # nothing to summarise, e.g. every file was unchanged
+    if not records:
+        return None
+    summary = summarise_records(records)
+    with open(os.path.join(run_folder, f"{stage_name}_summary.json"), 'w') as f:
+        json.dump(summary, f, indent=1)
+    print_summary(stage_name, summary)
+    return summary
+
+"""
+find the folder of the records of the current run
+"""
+def get_run_folder():
+    return os.path.join(fdef.INSTRUMENTATION_FOLDER, os.environ[RUN_ID_ENV_VAR])
+
+
+
+
+#---------------------------------------#
+# PER FILE RECORDING
+#---------------------------------------#
+
+"""
+start the record of the given file (or batch of files)
+
+    stage_name: the name of the stage, e.g. "f2_mono_16khz"
+    file: the path to the file being processed (the first file of a batch)
+    batch_files: the paths to the files of the batch, when they are processed together
+"""
+def start_file(stage_name, file, batch_files=None):
+    global current_record, current_batch_file, open_spans, files_started
+    files_started += len(batch_files) if batch_files is not None else 1
+    open_spans = []
+    current_batch_file = None
+    if fdef.INSTRUMENT_STAGES and RUN_ID_ENV_VAR in os.environ:
+        current_record = make_record(stage_name, file)
+        current_record["perf_start"] = time.perf_counter()
+        if batch_files is not None:
+            # the record of each file of the batch, with the time spent within its batch_file blocks
+            current_record["batch_records"] = {batch_file: dict(make_record(stage_name, batch_file), total=0.0)
+                                               for batch_file in batch_files}
+
+"""
+make an empty record of the given file
+"""
+def make_record(stage_name, file):
+    return {"stage": stage_name, "file": file, "pid": os.getpid(), "start": time.time(),
+            "spans": {}, "bytes_read": 0, "bytes_written": 0, "samples": 0}
+
+"""
+finish the record of the current file (or one record for each file of the
+current batch) and write it out
+
+    error: the error the file (or batch) failed with, if any
+"""
+def finish_file(error=None):
+    global current_record, current_batch_file
+    if current_record is None:
+        return
+    record = current_record
+    current_record = None
+    current_batch_file = None
+
+    record["total"] = time.perf_counter() - record.pop("perf_start")
+    records = split_batch_record(record) if "batch_records" in record else [record]
+    for record in records:
+        if error is not None:
+            record["error"] = repr(error)
+        write_record(record)
+
+"""
+split the record of a batch into the record of each of its files. The time
+and counts of the batch outside of the batch_file blocks are split evenly.
+
+    returns: the list of the record of each file
+"""
+def split_batch_record(record):
+    batch_records = list(record.pop("batch_records").values())
+    num_files = len(batch_records)
+    # the time of the batch outside of the blocks of its files
+    record["total"] -= sum(batch_record["total"] for batch_record in batch_records)
+    for batch_record in batch_records:
+        batch_record["batch"] = record["file"]
+        batch_record["batch_files"] = num_files
+        batch_record["total"] += record["total"] / num_files
+        for sub_step, sub_step_time in record["spans"].items():
+            batch_record["spans"][sub_step] = batch_record["spans"].get(sub_step, 0.0) + sub_step_time / num_files
+    # the counts are whole numbers, the first file gets the remainders
+    for name in ["bytes_read", "bytes_written", "samples"]:
+        share, remainder = divmod(record[name], num_files)
+        for i, batch_record in enumerate(batch_records):
+            batch_record[name] += share + (remainder if i == 0 else 0)
+    return batch_records
+
+"""
+charge the spans and counts within the block to the given file of the current
+batch, rather than splitting them over the whole batch
+"""
+@contextmanager
+def batch_file(file):
+    global current_batch_file
+    if current_record is None or file not in current_record.get("batch_records", {}):
+        yield
+        return
+    started = time.perf_counter()
+    # the span around the block is charged to the batch up to here
+    if open_spans:
+        charge_span(open_spans[-1], started)
+        open_spans[-1][1] = started
+    current_batch_file = file
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        # and the span around the block is charged to the file up to here
+        if open_spans:
+            charge_span(open_spans[-1], now)
+            open_spans[-1][1] = now
+        current_batch_file = None
+        current_record["batch_records"][file]["total"] += now - started
+
+"""
+get the record the spans and counts are charged to, that of the current
+file of the batch (within a batch_file block) or of the current record
+"""
+def get_charged_record():
+    if current_batch_file is not None:
+        return current_record["batch_records"][current_batch_file]
+    return current_record
+
+"""
+get the number of the file being processed in this process
+(e.g. to pick which files to graph), the last file of a batch
+"""
+def get_file_num():
+    return files_started
+
+"""
+time a sub-step of the current file, e.g. "decode". Nothing is recorded
+outside of a file record (e.g. when a stage function is called directly).
+"""
+@contextmanager
+def span(sub_step):
+    if current_record is None:
+        yield
+        return
+    now = time.perf_counter()
+    # pause the span around this one
+    if open_spans:
+        charge_span(open_spans[-1], now)
+    open_spans.append([sub_step, now])
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        charge_span(open_spans.pop(), now)
+        # and restart the span around this one
+        if open_spans:
+            open_spans[-1][1] = now
+
+"""
+add the time since the span was last (re)started to its sub-step
+"""
+def charge_span(open_span, now):
+    if current_record is None:
+        return
+    sub_step, started = open_span
+    spans = get_charged_record()["spans"]
+    spans[sub_step] = spans.get(sub_step, 0.0) + now - started
+
+"""
+add to the counts of the current file, e.g. add_counts(bytes_read=1024, samples=512)
+"""
+def add_counts(**counts):
+    if current_record is None:
+        return
+    record = get_charged_record()
+    for name, count in counts.items():
+        record[name] = record.get(name, 0) + int(count)
+
+"""
+write the record to the records file of this process
+"""
+def write_record(record):
+    global records_file, records_path
+    path = os.path.join(get_run_folder(), f"{record['stage']}_{os.getpid()}.jsonl")
+    if records_path != path:
+        close_records_file()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        records_file = open(path, 'a')
+        records_path = path
+    records_file.write(json.dumps(record) + "\n")
+    records_file.flush()
+
+"""
+close the records file of this process
+"""
+def close_records_file():
+    global records_file, records_path
+    if records_file is not None:
+        records_file.close()
+    records_file = None
+    records_path = None
+
+
+
+
+#---------------------------------------#
+# SUMMARY HELPERS
+#---------------------------------------#
+
+"""
+load the records of the given stage written by every process of the run
+
+    returns: a list of record dicts
+"""
+def load_records(run_folder, stage_name):
+    records = []
+    for path in sorted(glob.glob(os.path.join(glob.escape(run_folder), f"{stage_name}_[0-9]*.jsonl"))):
+        with open(path, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+"""
+summarise the latency of each sub-step over the records
+
+    returns: a dict of the number of files (and records, which is the same as
+             there is one record for each file), the total counts, the
+             percentiles (in seconds) of each sub-step of a file and the slowest files
+"""
+def summarise_records(records):
+    sub_steps = sorted({sub_step for record in records for sub_step in record["spans"]})
+    latencies = {}
+    for sub_step in sub_steps + ["total"]:
+        if sub_step == "total":
+            times = np.array([record["total"] for record in records])
+        else:
+            times = np.array([record["spans"].get(sub_step, 0.0) for record in records])
+        latencies[sub_step] = {f"p{percentile}": float(np.percentile(times, percentile))
+                               for percentile in SUMMARY_PERCENTILES}
+        latencies[sub_step]["sum"] = float(times.sum())
+
+    slowest = sorted(records, key=lambda record: record["total"], reverse=True)[:NUM_SLOWEST_FILES]
+    return {"files": sum(record.get("num_files", 1) for record in records), "records": len(records),
+            "errors": sum("error" in record for record in records),
+            "bytes_read": sum(record["bytes_read"] for record in records),
+            "bytes_written": sum(record["bytes_written"] for record in records),
+            "samples": sum(record["samples"] for record in records),
+            "latency": latencies,
+            "slowest": [{"file": record["file"], "total": record["total"]} for record in slowest]}
+
+"""
+print the summary as a table of the sub-step latencies in ms
+"""
+def print_summary(stage_name, summary):
+    print(f"\n{stage_name}: {summary['files']} files ({summary['errors']} errors), "
+          f"{summary['bytes_read'] / 1e6:.1f} MB read, {summary['bytes_written'] / 1e6:.1f} MB written")
+    header = "".join(f"{f'p{percentile} ms':>10}" for percentile in SUMMARY_PERCENTILES)
+    print(f"    {'sub-step':<12}{header}{'total s':>10}")
+    for sub_step, latency in summary["latency"].items():
+        row = "".join(f"{latency[f'p{percentile}'] * 1000:>10.2f}" for percentile in SUMMARY_PERCENTILES)
+        print(f"    {sub_step:<12}{row}{latency['sum']:>10.2f}")
+    print("    slowest files:")
+    for slow_file in summary["slowest"]:
+        print(f"        {slow_file['total'] * 1000:.1f} ms {slow_file['file']}")
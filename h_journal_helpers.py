@@ -0,0 +1,161 @@
+"""
+Per-stage run journals, so a run that was killed part way can be resumed.
+
+While a stage runs, each completed input (and the outputs it produced) is
+appended to the journal of the stage, along with any state the stage needs
+to carry on in the same way (e.g. the naming plan and counters of f1):
+
+    journal = jh.RunJournal("f2_mono_16khz", resume=fdef.RESUME_RUNS)
+    ...
+    journal.record_file(file, {"outputs": [output_path]})
+    ...
+    journal.finish()
+
+The records are committed in groups of JOURNAL_COMMIT_FILES, and only once
+the outputs handed to the background writer have been written, so an input
+in the journal always has its outputs on disk. The outputs themselves are
+renamed into place when complete (see h_writer_helpers), so a killed run never
+leaves a half written output behind. A journal is removed when its run
+finishes. Without resume, the journal of an earlier run is thrown away.
+"""
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+import h_writer_helpers as wh
+# folder navigation modules
+import os
+# modules used for storing the journal
+import json
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the number of completed inputs recorded before they are committed to the journal
+# (at most this many inputs are redone after a crash)
+JOURNAL_COMMIT_FILES = 64
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# RUN JOURNAL
+#---------------------------------------#
+
+"""
+The journal of the current run of a stage
+
+    stage_name: the name of the stage journal, e.g. "f2_mono_16khz"
+    resume: whether to carry on from the journal of an earlier (killed) run,
+            otherwise any earlier journal is thrown away
+"""
+class RunJournal:
+    def __init__(self, stage_name, resume=False):
+        self.journal_path = get_journal_path(stage_name)
+        # input file -> journal entry, of the completed inputs
+        self.completed = {}
+        # state name -> value
+        self.states = {}
+        self.pending = []
+
+        if resume:
+            self.load()
+        elif os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        # the journal is there from the start, so a run killed before its
+        # first commit is still known to be unfinished
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        open(self.journal_path, 'a').close()
+
+    """
+    load the records of an earlier run, a record cut short by the crash is ignored
+    """
+    def load(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if "state" in record:
+                    self.states[record["state"]] = record["value"]
+                else:
+                    self.completed[record["input"]] = record["entry"]
+        print(f"Resuming from {self.journal_path}: {len(self.completed)} inputs already completed")
+
+    """
+    check if the given input was completed by an earlier run,
+    and all of its outputs are still there
+
+        returns: the journal entry of the input, or None
+    """
+    def get_completed(self, file):
+        entry = self.completed.get(file)
+        if entry is None or not all(os.path.exists(output) for output in entry["outputs"]):
+            return None
+        return entry
+
+    """
+    record that the given input has been completed
+
+        file: the input file
+        entry: a dict of (at least) the list of "outputs" of the input
+    """
+    def record_file(self, file, entry):
+        self.completed[file] = entry
+        self.pending.append({"input": file, "entry": entry})
+        if len(self.pending) >= JOURNAL_COMMIT_FILES:
+            self.commit()
+
+    """
+    record (and commit straight away) a piece of state of the run
+
+        name: the name of the state, e.g. "plan"
+        value: any json serialisable value
+    """
+    def record_state(self, name, value):
+        self.states[name] = value
+        self.pending.append({"state": name, "value": value})
+        self.commit()
+
+    """
+    get a piece of state recorded by this (or the earlier) run, or None
+    """
+    def get_state(self, name):
+        return self.states.get(name)
+
+    """
+    append the pending records to the journal, once the outputs they list have been written
+    """
+    def commit(self):
+        if not self.pending:
+            return
+        wh.wait_for_writes()
+        with open(self.journal_path, 'a') as f:
+            f.write("".join(json.dumps(record) + "\n" for record in self.pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    """
+    the run has finished, the journal is no longer needed
+    """
+    def finish(self):
+        self.pending = []
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+"""
+find the path to the journal of the given stage
+"""
+def get_journal_path(stage_name):
+    return os.path.join(fdef.JOURNAL_FOLDER, f"{stage_name}.jsonl")
+
+"""
+check if there is a journal of an unfinished run of the given stage
+"""
+def has_journal(stage_name):
+    return os.path.exists(get_journal_path(stage_name))
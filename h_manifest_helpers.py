@@ -0,0 +1,256 @@
+"""
+Per-stage manifests used to only re-process the inputs that have changed.
+
+Each stage keeps a json manifest mapping every input file to its content hash,
+the hash of the stage parameters it was processed with and the outputs it
+produced. On a re-run unchanged inputs are skipped, changed inputs are
+re-processed (after their old outputs are removed) and the outputs of inputs
+that no longer exist are deleted.
+
+Each completed input is also recorded in the run journal of the stage (see
+h_journal_helpers) as it finishes, so a run that is killed part way can be
+resumed (with RESUME_RUNS) without redoing the inputs it had completed.
+"""
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+import h_parallel_helpers as ph
+import h_catalog_helpers as ch
+import h_journal_helpers as jh
+import h_work_queue_helpers as qh
+# modules used for folder naviation
+import os
+# modules used for hashing and storing the manifest
+import hashlib
+import json
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the number of bytes read at a time when hashing a file
+HASH_BLOCK_SIZE = 1024 * 1024
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# INCREMENTAL RUNNER
+#---------------------------------------#
+
+"""
+run the given per-file job on only the files that have changed since the last run
+(or were processed with different stage parameters) and update the stage manifest.
+
+    stage_name: the name of the manifest, e.g. "f2_mono_16khz"
+    job: the per-file function, returns the output path(s) of the file (or None)
+    files: all of the input files of the stage
+    stage_params: the parameters that affect the outputs, e.g. {"LEAD_IN_TIME": 0.2}
+    batch_files: if given, the job is a batch job (see ph.run_file_jobs)
+    read_ahead_filter: optional function (wav header) -> whether the job needs
+                       the whole file (see ph.run_file_jobs)
+
+    returns: a dict of file path -> the value returned by the job for the processed files
+"""
+def run_incremental(stage_name, job, files, stage_params, batch_files=None, read_ahead_filter=None):
+    journal = jh.RunJournal(stage_name, resume=fdef.RESUME_RUNS)
+    params_hash = hash_params(stage_params)
+    file_infos = {}
+
+    # record each file in the journal as it is completed
+    def record_result(file, result):
+        entry = {"outputs": to_output_list(result)}
+        if file in file_infos:
+            entry = dict(file_infos[file], params=params_hash, **entry)
+        journal.record_file(file, entry)
+        return result
+
+    if not fdef.INCREMENTAL_RUNS:
+        # only the files completed by a killed run (if resuming) are skipped
+        resumed = {file: journal.get_completed(file) for file in files}
+        resumed = {file: entry["outputs"] for file, entry in resumed.items() if entry is not None}
+        results = run_jobs(stage_name, job, [file for file in files if file not in resumed],
+                           record_result, batch_files, read_ahead_filter)
+        ch.add_stage_outputs(dict(resumed, **{file: to_output_list(result) for file, result in results.items()}))
+        journal.finish()
+        return results
+
+    manifest = load_manifest(stage_name)
+    # the files completed by a killed run (if resuming) are as if they were in the manifest
+    resumed = {file: entry for file, entry in journal.completed.items() if "hash" in entry}
+    manifest.update(resumed)
+
+    files_to_process, file_infos = find_files_to_process(manifest, files, params_hash)
+    print(f"Skipping {len(files) - len(files_to_process)} unchanged files, "
+          f"processing {len(files_to_process)} files")
+
+    results = run_jobs(stage_name, job, files_to_process, record_result, batch_files, read_ahead_filter)
+
+    # record what each processed file produced
+    for file, result in results.items():
+        manifest[file] = dict(file_infos[file], params=params_hash, outputs=to_output_list(result))
+    save_manifest(stage_name, manifest)
+    journal.finish()
+    # and add the outputs to the file catalog (including those of the killed run)
+    ch.add_stage_outputs({file: manifest[file]["outputs"] for file in list(results) + list(resumed)
+                          if file in manifest})
+
+    return results
+
+"""
+run the job on the files, over the local worker processes or (with DISTRIBUTED_RUNS)
+through a work queue shared with the workers on other hosts (see h_work_queue_helpers)
+
+    returns: a dict of file path -> the value returned by on_result for each file
+"""
+def run_jobs(stage_name, job, files, on_result, batch_files=None, read_ahead_filter=None):
+    if fdef.DISTRIBUTED_RUNS and files:
+        return qh.run_distributed(stage_name, job, files, batch_files, on_result, read_ahead_filter)
+    return ph.run_file_jobs(job, files, on_result=on_result, stage_name=stage_name, batch_files=batch_files,
+                            read_ahead_filter=read_ahead_filter)
+
+"""
+find the files that need to be (re-)processed. The outputs of changed files
+and of files that have disappeared are deleted and removed from the manifest.
+
+    returns: (the list of files to process, a dict of file path -> size, mtime and hash)
+"""
+def find_files_to_process(manifest, files, params_hash):
+    files_to_process = []
+    file_infos = {}
+    for file in files:
+        file_infos[file] = get_file_info(file, manifest.get(file))
+        if not check_unchanged(manifest, file, file_infos[file], params_hash):
+            files_to_process.append(file)
+
+    remove_missing_inputs(manifest, files)
+    return files_to_process, file_infos
+
+"""
+check if the given file is unchanged since it was last processed (with the
+same parameters, and its outputs are still there). If it has changed its old
+outputs are deleted and it is removed from the manifest.
+
+    file_info: the size, mtime and hash of the file (see get_file_info)
+
+    returns: True if the file does not need to be processed again
+"""
+def check_unchanged(manifest, file, file_info, params_hash):
+    entry = manifest.get(file)
+    if (entry is not None and entry["hash"] == file_info["hash"]
+            and entry["params"] == params_hash
+            and all(os.path.exists(output) for output in entry["outputs"])):
+        return True
+    if entry is not None:
+        delete_outputs(entry["outputs"])
+        del manifest[file]
+    return False
+
+"""
+delete the outputs of the inputs in the manifest that no longer exist
+(are not in the given files), and remove them from the manifest
+"""
+def remove_missing_inputs(manifest, files):
+    current_files = set(files)
+    for file in [file for file in manifest if file not in current_files]:
+        delete_outputs(manifest[file]["outputs"])
+        del manifest[file]
+
+"""
+get the size, modification time and content hash of the given file.
+The hash is only recomputed if the size or modification time has changed
+since the manifest entry was made.
+
+    returns: a dict of size, mtime and hash
+"""
+def get_file_info(file, entry=None):
+    stat = os.stat(file)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        file_hash = entry["hash"]
+    else:
+        file_hash = hash_file(file)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": file_hash}
+
+"""
+convert the value returned by a stage job to a list of output paths
+"""
+def to_output_list(result):
+    if result is None:
+        return []
+    if isinstance(result, str):
+        return [result]
+    return list(result)
+
+"""
+delete the given output files if they exist (and remove them from the file catalog)
+"""
+def delete_outputs(outputs):
+    for output in outputs:
+        if os.path.exists(output):
+            os.remove(output)
+    ch.remove_files(outputs)
+
+
+
+
+#---------------------------------------#
+# HASHING HELPERS
+#---------------------------------------#
+
+"""
+find the content hash of the given file
+
+    returns: the hex digest of the file contents
+"""
+def hash_file(file):
+    file_hash = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+"""
+find the hash of the given stage parameters
+
+    returns: the hex digest of the parameters
+"""
+def hash_params(stage_params):
+    return hashlib.sha1(json.dumps(stage_params, sort_keys=True).encode()).hexdigest()
+
+
+
+
+#---------------------------------------#
+# MANIFEST FILE HELPERS
+#---------------------------------------#
+
+"""
+find the path to the manifest of the given stage
+"""
+def get_manifest_path(stage_name):
+    return os.path.join(fdef.MANIFEST_FOLDER, f"{stage_name}.json")
+
+"""
+load the manifest of the given stage, empty if there is none yet
+
+    returns: a dict of input file path -> manifest entry
+"""
+def load_manifest(stage_name):
+    manifest_path = get_manifest_path(stage_name)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+"""
+save the manifest of the given stage, replacing the old manifest in one step
+so that a crash never leaves a half written manifest
+"""
+def save_manifest(stage_name, manifest):
+    manifest_path = get_manifest_path(stage_name)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_path, manifest_path)
@@ -0,0 +1,189 @@
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+import h_instrumentation_helpers as ih
+import h_writer_helpers as wh
+import h_reader_helpers as rh
+# modules used for folder naviation
+import os
+# modules used for running the jobs in parallel
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+
+
+#---------------------------------------#
+# GOBAL VARIABLE TRACKERS
+#---------------------------------------#
+# set within the worker processes, so that the stages know
+# not to print progress or show graphs from the workers
+IS_WORKER_PROCESS = False
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# PARALLEL RUNNER
+#---------------------------------------#
+
+"""
+run the given per-file job on every file, spread over a pool of processes.
+The files are batched into chunks (small files together, large files alone)
+and the largest chunks are scheduled first to keep the workers balanced.
+With a single worker the files are processed serially, in order.
+The output files are written in the background (see h_writer_helpers),
+all of them have been written by the time the results are returned.
+
+    job: the per-file function, must be defined at module level so it can be pickled
+    files: the list of file paths to process
+    num_workers: the number of processes, None uses fdef.NUM_WORKERS
+                 (and None there uses all the cores)
+    chunk_bytes, max_chunk_files: the size of the chunks, None uses the fdef values
+    on_result: optional function (file, result) called in this process as each
+               file finishes, its return value is kept instead of the job result
+               (so large results do not have to be held in memory)
+    stage_name: if given, each file is recorded under this name by the
+                instrumentation (see h_instrumentation_helpers) and a summary
+                is printed at the end
+    batch_files: if given, the job is a batch job, called with lists of up to
+                 this many files and returning a list of results (one per file)
+    read_ahead_filter: optional function (wav header) -> whether the job needs the
+                       whole of a file with that header (see h_reader_helpers),
+                       a module level function so it can be pickled
+
+    returns: a dict of file path -> the value returned by the job (or on_result) for that file
+"""
+def run_file_jobs(job, files, num_workers=None, chunk_bytes=None, max_chunk_files=None,
+                  on_result=None, stage_name=None, batch_files=None, read_ahead_filter=None):
+    if stage_name is not None:
+        ih.start_run(stage_name)
+        try:
+            return run_file_jobs(partial(run_instrumented_job, stage_name, job, batch_files is not None),
+                                 files, num_workers, chunk_bytes, max_chunk_files, on_result,
+                                 batch_files=batch_files, read_ahead_filter=read_ahead_filter)
+        finally:
+            ih.finish_run(stage_name)
+
+    # the options are read from fdef when called (not when defined)
+    # so that they can be changed at runtime, e.g. by the catscat cli
+    if num_workers is None:
+        num_workers = fdef.NUM_WORKERS or os.cpu_count()
+    if chunk_bytes is None:
+        chunk_bytes = fdef.CHUNK_TARGET_BYTES
+    if max_chunk_files is None:
+        max_chunk_files = fdef.MAX_FILES_PER_CHUNK
+    if on_result is None:
+        on_result = lambda file, result: result
+
+    # serial, in order
+    if num_workers <= 1 or len(files) <= 1:
+        with wh.background_writes():
+            return {file: on_result(file, result)
+                    for file, result in iter_job_results(job, files, batch_files, read_ahead_filter)}
+
+    chunks = make_chunks(files, chunk_bytes, max_chunk_files)
+    results = {}
+    files_transformed = 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=init_worker) as executor:
+        # chunks are already ordered largest first
+        futures = [executor.submit(run_chunk, job, chunk, batch_files, read_ahead_filter) for chunk in chunks]
+        # merge the results and progress counts back as each chunk finishes
+        for future in as_completed(futures):
+            chunk_results = future.result()
+            for file, result in chunk_results.items():
+                results[file] = on_result(file, result)
+            files_transformed += len(chunk_results)
+            print(f"Number of files transformed: {files_transformed}", end='\r')
+
+    # return the results in the same order as the files were given
+    return {file: results[file] for file in files}
+
+"""
+split the files into chunks, largest files first. Files larger than chunk_bytes
+get a chunk of their own, smaller files are grouped until the chunk is full.
+
+    returns: a list of lists of file paths
+"""
+def make_chunks(files, chunk_bytes, max_chunk_files):
+    sized_files = sorted(((os.path.getsize(file), file) for file in files), reverse=True)
+
+    chunks = []
+    current_chunk = []
+    current_bytes = 0
+    for size, file in sized_files:
+        # start a new chunk if this file would overfill the current one
+        if current_chunk and (current_bytes + size > chunk_bytes
+                              or len(current_chunk) >= max_chunk_files):
+            chunks.append(current_chunk)
+            current_chunk = []
+            current_bytes = 0
+        current_chunk.append(file)
+        current_bytes += size
+
+    if current_chunk:
+        chunks.append(current_chunk)
+    return chunks
+
+"""
+run the job on every file in the chunk (within a worker process),
+the output files of the chunk are all written before it returns
+
+    returns: a dict of file path -> the value returned by the job
+"""
+def run_chunk(job, chunk, batch_files=None, read_ahead_filter=None):
+    with wh.background_writes():
+        return dict(iter_job_results(job, chunk, batch_files, read_ahead_filter))
+
+"""
+run the job on each of the files in turn, or on batches of the files.
+The next files are read ahead while the job runs (see h_reader_helpers).
+
+    batch_files: the max files in each batch, None if the job is a per-file job
+    read_ahead_filter: optional function (wav header) -> whether the job needs the whole file
+
+    returns: a generator of (file path, the value returned by the job for the file)
+"""
+def iter_job_results(job, files, batch_files=None, read_ahead_filter=None):
+    with rh.read_ahead(files, read_ahead_filter):
+        if batch_files is None:
+            for file in files:
+                result = job(file)
+                rh.release_files([file])
+                yield file, result
+            return
+        for start in range(0, len(files), batch_files):
+            batch = files[start : start + batch_files]
+            results = job(batch)
+            rh.release_files(batch)
+            yield from zip(batch, results)
+
+"""
+run the job on the file (or batch of files), recording it with the
+instrumentation, and report the progress (when not in a worker process)
+
+    is_batch: whether the job is a batch job (file is then a list of files)
+
+    returns: the value returned by the job
+"""
+def run_instrumented_job(stage_name, job, is_batch, file):
+    if is_batch:
+        ih.start_file(stage_name, file[0], batch_files=file)
+    else:
+        ih.start_file(stage_name, file)
+    try:
+        result = job(file)
+    except BaseException as error:
+        ih.finish_file(error)
+        raise
+    ih.finish_file()
+
+    if not IS_WORKER_PROCESS:
+        print(f"Number of files transformed: {ih.get_file_num()}", end='\r')
+    return result
+
+"""
+mark the current process as a worker process
+"""
+def init_worker():
+    global IS_WORKER_PROCESS
+    IS_WORKER_PROCESS = True
@@ -0,0 +1,138 @@
+"""
+A scheduler running the stages as a DAG of per-file tasks, so each file moves
+on to the next stage as soon as its output from the stage before is written,
+rather than every stage waiting for the whole corpus to finish the one before.
+
+Each stage has its own pool of worker processes and a bounded queue of inputs
+waiting for it. A stage does not start new tasks while the queue of a stage
+it feeds is full, so the files in flight (and the memory they hold) stay
+bounded and the slowest stage sets the pace. The output(s) of each task are
+routed to the stage(s) they go to next:
+
+    stages = [hp.PipelineStage("f2", f2.convert_audio_file_mono_16khz, 2, ["f3"]), ...]
+    hp.run_pipeline(stages, [("f2", file) for file in files])
+"""
+# Internal helpers and definitions
+import h_parallel_helpers as ph
+# modules used for running the stages
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the max number of inputs waiting for each stage
+STAGE_QUEUE_SIZE = 64
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# PIPELINE SCHEDULER
+#---------------------------------------#
+
+"""
+A stage of the pipeline
+
+    name: the name of the stage, e.g. "f2"
+    job: the per-file job (a module level function), returns the output path(s) of the file (or None)
+    num_workers: the number of processes running the job
+    next_stages: the names of the stages the outputs may go to
+    route: optional function (output path) -> the next stages the output goes to,
+           by default all of next_stages
+    skip: optional function (input) -> the outputs of an input that does not need
+          to be processed again (e.g. it is unchanged since the last run), or None
+    on_result: optional function (input, result) called in the scheduler as each task is done
+"""
+class PipelineStage:
+    def __init__(self, name, job, num_workers=1, next_stages=(), route=None, skip=None, on_result=None):
+        self.name = name
+        self.job = job
+        self.num_workers = num_workers
+        self.next_stages = list(next_stages)
+        self.route = route if route is not None else lambda output: self.next_stages
+        self.skip = skip
+        self.on_result = on_result
+        # the inputs waiting for this stage, and the number of tasks running
+        self.waiting = deque()
+        self.num_running = 0
+        self.num_done = 0
+
+"""
+run the pipeline until every input (and everything made from it) has been
+through all of its stages
+
+    stages: the list of PipelineStages, in order (upstream first)
+    inputs: a list of (stage name, input) to feed into the pipeline
+    queue_size: the max number of inputs waiting for each stage
+"""
+def run_pipeline(stages, inputs, queue_size=None):
+    if queue_size is None:
+        queue_size = STAGE_QUEUE_SIZE
+    stages_by_name = {stage.name: stage for stage in stages}
+    inputs = deque(inputs)
+
+    executors = {stage.name: ProcessPoolExecutor(max_workers=stage.num_workers, initializer=ph.init_worker)
+                 for stage in stages}
+    # future -> (stage, input) of each running task
+    running = {}
+    try:
+        while inputs or running or any(stage.waiting for stage in stages):
+            # feed the inputs in while their first stage has room
+            while inputs and len(stages_by_name[inputs[0][0]].waiting) < queue_size:
+                stage_name, file = inputs.popleft()
+                stages_by_name[stage_name].waiting.append(file)
+
+            # start the tasks that can start, downstream first
+            # (so the files already in flight are finished first)
+            for stage in reversed(stages):
+                while (stage.waiting and stage.num_running < stage.num_workers
+                       and all(len(stages_by_name[name].waiting) < queue_size for name in stage.next_stages)):
+                    file = stage.waiting.popleft()
+                    outputs = stage.skip(file) if stage.skip is not None else None
+                    if outputs is not None:
+                        route_outputs(stages_by_name, stage, outputs)
+                        continue
+                    # run as a chunk of one, so the outputs are written before it is done
+                    future = executors[stage.name].submit(ph.run_chunk, stage.job, [file])
+                    running[future] = (stage, file)
+                    stage.num_running += 1
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, file = running.pop(future)
+                stage.num_running -= 1
+                result = future.result()[file]
+                if stage.on_result is not None:
+                    stage.on_result(file, result)
+                route_outputs(stages_by_name, stage, result)
+            print_progress(stages)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(cancel_futures=True)
+    print_progress(stages)
+    print()
+
+"""
+inform the user of the number of files each stage has done
+"""
+def print_progress(stages):
+    print("Files done: " + ", ".join(f"{stage.name} {stage.num_done}" for stage in stages), end='\r')
+
+"""
+count the input of the given stage as done and pass its outputs on to their next stages
+
+    outputs: the output path(s) of the input (or None)
+"""
+def route_outputs(stages_by_name, stage, outputs):
+    stage.num_done += 1
+    if outputs is None:
+        return
+    for output in [outputs] if isinstance(outputs, str) else outputs:
+        for next_stage in stage.route(output):
+            stages_by_name[next_stage].waiting.append(output)
@@ -0,0 +1,289 @@
+"""
+Read-ahead of the stage input files.
+
+Within a read_ahead(files) block a small pool of i/o threads reads the bytes
+of the upcoming files (in order) while the stage is still processing the
+current one, so the read latency of the next files (most of the time on
+network storage) is hidden behind the processing of this one:
+
+    with rh.read_ahead(files):
+        for file in files:
+            job(file)
+            rh.release_files([file])
+
+The wav readers of h_folder_nav_helpers take the bytes of a file from the
+read-ahead when they are there (see get_file_buffer), so the stage functions
+do not change. At most READ_AHEAD_FILES files are read ahead of the stage,
+and the files read but not yet handed to the stage are kept within
+READ_AHEAD_MAX_BYTES. A file that is too large (e.g. a long recording that
+is streamed), could not be read, or is needed before its read has started,
+is read by the stage itself, in the same way as without the read-ahead.
+
+A stage that does not need the samples of every file (e.g. f2 only links the
+files that are already mono & 16kHz) gives a read_ahead_filter, the header of
+each file is then read first and only the files it passes are read in full.
+"""
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+import h_writer_helpers as wh
+# folder navigation modules
+import os
+import struct
+# modules used for reading in the background
+from contextlib import contextmanager
+import threading
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# files larger than this fraction of the read-ahead memory are read by the
+# stage itself, so a few large files do not hold up the read-ahead
+MAX_FILE_FRACTION = 0.25
+# the states of a file that has not been read ahead (yet),
+# once read its state is the buffer of its bytes
+WAITING = "waiting"
+READING = "reading"
+SKIPPED = "skipped"
+#---------------------------------------#
+
+#---------------------------------------#
+# GOBAL VARIABLE TRACKERS
+#---------------------------------------#
+# the reader of the current read_ahead() block (if any)
+active_reader = None
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# READING THE FILES
+#---------------------------------------#
+
+"""
+read the given files ahead of the stage for the duration of the block
+(nothing is read ahead when already within a block, or with READ_AHEAD off)
+
+    files: the paths to the files, in the order the stage processes them
+    read_ahead_filter: optional function (wav header) -> whether the stage
+                       needs the whole of a file with that header
+"""
+@contextmanager
+def read_ahead(files, read_ahead_filter=None):
+    global active_reader
+    if active_reader is not None or not fdef.READ_AHEAD or len(files) <= 1:
+        yield
+        return
+
+    active_reader = ReadAheadReader(files, read_ahead_filter=read_ahead_filter)
+    try:
+        yield
+    finally:
+        active_reader.close()
+        active_reader = None
+
+"""
+get the bytes of the given file if it was read ahead, waiting for its read
+to finish if it has started. The buffer must not be changed.
+
+    returns: the bytes of the file, or None if the stage should read it itself
+"""
+def get_file_buffer(file):
+    if active_reader is None:
+        return None
+    return active_reader.get_buffer(file)
+
+"""
+the stage has finished with the given files, their buffers are let go
+and the read-ahead moves on
+"""
+def release_files(files):
+    if active_reader is not None:
+        active_reader.release(files)
+
+
+
+
+#---------------------------------------#
+# READ-AHEAD READER
+#---------------------------------------#
+
+"""
+A pool of i/o threads reading the bytes of the files ahead of the stage.
+
+    files: the paths to the files, in the order the stage processes them
+    num_threads: the number of i/o threads, None uses fdef.READ_AHEAD_THREADS
+    max_bytes: the max bytes of files read but not yet handed to the stage,
+               None uses fdef.READ_AHEAD_MAX_BYTES (kept below
+               wh.MAX_FREE_MEMORY_FRACTION of the free memory)
+    max_files: the max number of files read ahead of the stage,
+               None uses fdef.READ_AHEAD_FILES
+    read_ahead_filter: optional function (wav header) -> whether to read the whole
+                       file, the files it does not pass (or whose header cannot be
+                       read) are left to the stage
+"""
+class ReadAheadReader:
+    def __init__(self, files, num_threads=None, max_bytes=None, max_files=None, read_ahead_filter=None):
+        self.files = list(files)
+        self.read_ahead_filter = read_ahead_filter
+        self.file_set = set(self.files)
+        self.max_bytes = min(max_bytes or fdef.READ_AHEAD_MAX_BYTES, wh.get_free_memory_budget())
+        self.max_files = max_files or fdef.READ_AHEAD_FILES
+        # file -> WAITING, READING, SKIPPED or the buffer, of the files claimed by the i/o threads
+        self.states = {}
+        # file -> buffer, of the files handed to the stage (until they are released)
+        self.handed = {}
+        # the files the stage has asked for or released
+        self.taken = set()
+        # the index of the next file to be claimed
+        self.next_index = 0
+        # the bytes of the files read (or being read) but not yet handed over
+        self.held_bytes = 0
+        self.closing = False
+        self.condition = threading.Condition()
+
+        self.threads = [threading.Thread(target=self.run_thread, daemon=True)
+                        for _ in range(min(num_threads or fdef.READ_AHEAD_THREADS, len(self.files)))]
+        for thread in self.threads:
+            thread.start()
+
+    """
+    get the bytes of the given file (see get_file_buffer)
+    """
+    def get_buffer(self, file):
+        with self.condition:
+            if file not in self.file_set:
+                return None
+            if file in self.handed:
+                return self.handed[file]
+            if file not in self.taken:
+                self.taken.add(file)
+                self.condition.notify_all()
+            state = self.states.get(file)
+            if state is None or state is WAITING:
+                # not started, the stage reads it rather than waiting
+                self.states[file] = SKIPPED
+                self.condition.notify_all()
+                return None
+            while state is READING:
+                self.condition.wait()
+                state = self.states[file]
+            if state is SKIPPED:
+                return None
+            # hand the buffer over
+            self.handed[file] = state
+            self.states[file] = SKIPPED
+            self.held_bytes -= len(state)
+            self.condition.notify_all()
+            return state
+
+    """
+    let go of the buffers of the given files (see release_files)
+    """
+    def release(self, files):
+        with self.condition:
+            for file in files:
+                if file not in self.file_set:
+                    continue
+                self.handed.pop(file, None)
+                self.taken.add(file)
+                # read ahead but never asked for
+                if isinstance(self.states.get(file), bytes):
+                    self.held_bytes -= len(self.states[file])
+                # (a file still being read is let go once its read finishes)
+                self.states[file] = SKIPPED
+            self.condition.notify_all()
+
+    """
+    stop the i/o threads and let go of all the buffers
+    """
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.states = {}
+        self.handed = {}
+
+    """
+    claim the next file to read, waiting until it is within max_files of the stage
+    (the condition must be held)
+
+        returns: the file, or None when there are no more files (or closing)
+    """
+    def claim_next_file(self):
+        while True:
+            while (not self.closing and self.next_index < len(self.files)
+                   and self.next_index >= len(self.taken) + self.max_files):
+                self.condition.wait()
+            if self.closing or self.next_index >= len(self.files):
+                return None
+            file = self.files[self.next_index]
+            self.next_index += 1
+            # the stage has already asked for (or released) it
+            if file not in self.states and file not in self.taken:
+                self.states[file] = WAITING
+                return file
+
+    """
+    the loop of each i/o thread, read the next file until there are none left
+    """
+    def run_thread(self):
+        while True:
+            with self.condition:
+                file = self.claim_next_file()
+                if file is None:
+                    return
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                size = None
+
+            with self.condition:
+                # wait for the stage to take enough of the files already read,
+                # a file is always read when nothing else is held
+                while (size is not None and size <= self.max_bytes * MAX_FILE_FRACTION
+                       and self.held_bytes and self.held_bytes + size > self.max_bytes
+                       and self.states[file] is WAITING and not self.closing):
+                    self.condition.wait()
+                if (size is None or size > self.max_bytes * MAX_FILE_FRACTION
+                        or self.states[file] is not WAITING or self.closing):
+                    self.states[file] = SKIPPED
+                    self.condition.notify_all()
+                    continue
+                self.states[file] = READING
+                self.held_bytes += size
+
+            buffer = self.read_file(file)
+
+            with self.condition:
+                self.held_bytes -= size
+                # the file was released while it was read
+                if buffer is None or self.states[file] is not READING or self.closing:
+                    self.states[file] = SKIPPED
+                else:
+                    self.states[file] = buffer
+                    self.held_bytes += len(buffer)
+                self.condition.notify_all()
+
+    """
+    read the whole of the given file, if it passes the read_ahead_filter
+
+        returns: the bytes of the file, or None if it is left to the stage
+    """
+    def read_file(self, file):
+        # (imported here, as h_folder_nav_helpers imports this module)
+        import h_folder_nav_helpers as fh
+        try:
+            with open(file, 'rb') as f:
+                if self.read_ahead_filter is not None:
+                    if not self.read_ahead_filter(fh.parse_wav_header(f, file)):
+                        return None
+                    f.seek(0)
+                return f.read()
+        except (OSError, ValueError, struct.error):
+            # the stage reads it itself (and raises the error)
+            return None
@@ -0,0 +1,181 @@
+"""
+Packed, memory mappable shards of clips, instead of one small wav file per clip.
+
+Each shard holds up to CLIPS_PER_SHARD clips as three files:
+    shard_00000_samples.npy: int16 matrix (clips, max length), zero padded
+    shard_00000_lengths.npy: int32 array of the length of each clip in samples
+    shard_00000_index.json:  the sample rate and, for each clip, the category,
+                             source id, recording number, perturbation tag
+                             and original file name
+The .npy files can be opened with np.load(..., mmap_mode='r') for random access.
+"""
+# Internal helpers and definitions
+import h_folder_nav_helpers as fh
+# modules used for folder naviation
+import os
+# modules used for writing the shards
+import json
+import numpy as np
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the number of clips in each shard
+CLIPS_PER_SHARD = 4096
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# SHARD WRITING
+#---------------------------------------#
+
+"""
+Writes clips into fixed size shards in the given folder, the samples are
+written straight into a memory mapped shard file. Any existing shards in
+the folder are removed.
+
+    shard_folder: the folder to write the shards to
+    max_length: the max clip length in samples (e.g. MAX_LENGTH_S * 16000)
+    sample_rate: the sample rate of all the clips
+"""
+class ShardWriter:
+    def __init__(self, shard_folder, max_length, sample_rate, clips_per_shard=CLIPS_PER_SHARD):
+        self.shard_folder = shard_folder
+        self.max_length = max_length
+        self.sample_rate = sample_rate
+        self.clips_per_shard = clips_per_shard
+        self.shard_num = 0
+        self.num_clips = 0
+        self.samples = None
+
+        os.makedirs(shard_folder, exist_ok=True)
+        for file in os.listdir(shard_folder):
+            if file.startswith("shard_"):
+                os.remove(os.path.join(shard_folder, file))
+
+    """
+    add a clip to the current shard, starting a new shard if it is full
+
+        samples: the int16 samples of the clip
+        file_name: the file name the clip would have had as a wav file,
+                   e.g. "meow_000001_001_+05dB_mono_16khz_normalised_centered_1-2s.wav"
+        perturbation: the perturbation tag of the clip, e.g. "+05dB"
+    """
+    def add_clip(self, samples, file_name, perturbation):
+        samples = fh.to_mono_samples(samples)
+        if len(samples) > self.max_length:
+            raise ValueError(f"Clip {file_name} is longer than {self.max_length} samples")
+        if self.samples is None:
+            self.open_shard()
+
+        row = len(self.index)
+        self.samples[row, :len(samples)] = samples
+        self.lengths[row] = len(samples)
+        self.index.append(make_index_entry(file_name, perturbation))
+        self.num_clips += 1
+
+        if len(self.index) == self.clips_per_shard:
+            self.close_shard()
+
+    """
+    start a new, empty shard
+    """
+    def open_shard(self):
+        self.samples = np.lib.format.open_memmap(
+            self.get_shard_path("samples.npy"), mode='w+', dtype=np.int16,
+            shape=(self.clips_per_shard, self.max_length))
+        self.lengths = np.zeros(self.clips_per_shard, dtype=np.int32)
+        self.index = []
+
+    """
+    write out the lengths and index of the current shard. A partly filled
+    shard has its sample matrix cut down to the clips it holds.
+    """
+    def close_shard(self):
+        num_shard_clips = len(self.index)
+        samples_path = self.get_shard_path("samples.npy")
+        if num_shard_clips < self.clips_per_shard:
+            trimmed = np.lib.format.open_memmap(
+                f"{samples_path}.tmp", mode='w+', dtype=np.int16,
+                shape=(num_shard_clips, self.max_length))
+            trimmed[:] = self.samples[:num_shard_clips]
+            trimmed.flush()
+            del trimmed
+            self.samples = None
+            os.replace(f"{samples_path}.tmp", samples_path)
+        else:
+            self.samples.flush()
+            self.samples = None
+
+        np.save(self.get_shard_path("lengths.npy"), self.lengths[:num_shard_clips])
+        with open(self.get_shard_path("index.json"), 'w') as f:
+            json.dump({"sample_rate": self.sample_rate, "clips": self.index}, f)
+        self.shard_num += 1
+
+    """
+    finish writing the last shard
+    """
+    def close(self):
+        if self.samples is not None:
+            self.close_shard()
+
+    """
+    find the path of a file of the current shard
+    """
+    def get_shard_path(self, suffix):
+        return os.path.join(self.shard_folder, f"shard_{self.shard_num:05}_{suffix}")
+
+"""
+make the index entry of a clip from its wav file name
+Format: "{category}_{recording num}_{source id}_{perturbation}_{properties}.wav"
+
+    returns: a dict of category, source_id, recording_num, perturbation, file_name
+"""
+def make_index_entry(file_name, perturbation):
+    name_sections = os.path.basename(file_name).split("_")
+    return {"category": name_sections[0], "source_id": int(name_sections[2]),
+            "recording_num": int(name_sections[1]), "perturbation": perturbation,
+            "file_name": os.path.basename(file_name)}
+
+
+
+
+#---------------------------------------#
+# SHARD READING
+#---------------------------------------#
+
+"""
+find the shards in the given folder
+
+    returns: the sorted list of shard path prefixes, e.g. ".../shard_00000"
+"""
+def list_shards(shard_folder):
+    return sorted(os.path.join(shard_folder, file[:-len("_index.json")])
+                  for file in os.listdir(shard_folder) if file.endswith("_index.json"))
+
+"""
+open a shard for random access, the samples are memory mapped
+
+    shard_path: the shard path prefix, e.g. ".../shard_00000"
+
+    returns: (int16 samples matrix, lengths array, index dict)
+"""
+def load_shard(shard_path):
+    samples = np.load(f"{shard_path}_samples.npy", mmap_mode='r')
+    lengths = np.load(f"{shard_path}_lengths.npy", mmap_mode='r')
+    with open(f"{shard_path}_index.json", 'r') as f:
+        index = json.load(f)
+    return samples, lengths, index
+
+"""
+get a single clip (without the padding) from an opened shard
+
+    returns: the int16 samples of the clip
+"""
+def get_clip(shard, clip_num):
+    samples, lengths, _ = shard
+    return samples[clip_num, :lengths[clip_num]]
@@ -0,0 +1,467 @@
+"""
+A work queue on a shared folder, for spreading a stage over several hosts.
+
+The process running the stage (the coordinator) splits the files to process
+into work units and writes them to a queue folder within WORK_QUEUE_FOLDER.
+Workers on any host that can see the folder (at the same relative paths as
+the coordinator, e.g. the same network mount) claim the units one at a time,
+run the stage job on them (over their own local worker processes) and report
+the results back, with no broker other than the folder itself:
+
+    python catscat.py --distributed run f2    # on one host, also works on the queue
+    python catscat.py worker                  # on every other host
+
+Each run of a stage gets a new queue folder, "{stage name}/{queue id}" (a
+random id), so a worker still running a unit of an earlier queue of the stage
+(e.g. the backup of a straggler, or a run that was restarted) cannot mark the
+unit of the same name in the new queue as done. The queue folder holds:
+    queue.json:                 the queue id, stage module, job and number of units
+    units/unit_00000.json:      the files of each unit
+    claims/unit_00000.lock:     the claim of the worker processing the unit,
+                                its modification time is the lease, renewed
+                                while the worker is alive
+    done/unit_00000.json:       the results of each finished unit
+    failed/unit_00000.json:     the error of each unit whose job raised
+
+A claim is made by creating the lock file (which fails if it exists), so only
+one worker gets each unit. A claim whose lease has not been renewed for
+LEASE_EXPIRY_S (the worker died) is taken over by the next worker to look.
+Once every unit is claimed, idle workers also back up the units that have
+been running for more than STRAGGLER_S, and whichever copy finishes first is
+kept. The outputs are written atomically, so a unit that is run twice (or
+by a worker whose claim was taken over) writes the same files.
+"""
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+import h_parallel_helpers as ph
+# folder navigation modules
+import os
+import sys
+import shutil
+# modules used for the queue files and loading the stage jobs
+import json
+import time
+import socket
+import threading
+import importlib
+import traceback
+import uuid
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the bytes of input files in each work unit
+WORK_UNIT_BYTES = 64 * 1024 * 1024
+# the max number of input files in each work unit
+WORK_UNIT_MAX_FILES = 256
+# a claim that has not been renewed for this long is taken to be dead (seconds)
+LEASE_EXPIRY_S = 60.0
+# how often a worker renews the claims it holds (seconds)
+LEASE_RENEW_S = 10.0
+# a unit claimed for longer than this may be backed up by an idle worker (seconds)
+STRAGGLER_S = 120.0
+# how often the queue is checked while waiting (seconds)
+POLL_S = 1.0
+# how long a worker waits for a queue to appear before it stops (seconds)
+WORKER_IDLE_TIMEOUT_S = 60.0
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# COORDINATOR
+#---------------------------------------#
+
+"""
+run the given stage job on every file through a work queue in WORK_QUEUE_FOLDER,
+working on the queue in this process too, until every unit is done
+
+    stage_name: the name of the queue, e.g. "f2_mono_16khz"
+    job: the per-file (or batch) job of the stage, a module level function
+    files: the files to process
+    batch_files: if given, the job is a batch job (see ph.run_file_jobs)
+    on_result: optional function (file, result) called in this process as each unit is done,
+               the result is what the job returned, after a round trip through json
+    read_ahead_filter: optional module level function (wav header) -> whether the job
+                       needs the whole file (see ph.run_file_jobs), from the module of the job
+
+    returns: a dict of file path -> the value returned by the job (or on_result)
+"""
+def run_distributed(stage_name, job, files, batch_files=None, on_result=None, read_ahead_filter=None):
+    if on_result is None:
+        on_result = lambda file, result: result
+    queue_id = uuid.uuid4().hex
+    queue_folder = get_queue_folder(stage_name, queue_id)
+    num_units = create_queue(queue_folder, queue_id, job, files, batch_files, read_ahead_filter)
+    print(f"Queued {len(files)} files in {num_units} work units at {queue_folder}")
+
+    worker = QueueWorker()
+    results = {}
+    collected = set()
+    try:
+        while len(collected) < num_units:
+            worked = worker.work_on_unit(queue_folder)
+            # merge the results of the units done (by any worker) so far
+            for unit_name in sorted(list_unit_names(queue_folder, "done")):
+                if unit_name in collected:
+                    continue
+                done = read_json(get_unit_path(queue_folder, "done", unit_name))
+                if done.get("queue_id") != queue_id:
+                    continue
+                for file, result in done["results"].items():
+                    results[file] = on_result(file, result)
+                collected.add(unit_name)
+                print(f"Work units done: {len(collected)}/{num_units}", end='\r')
+            raise_failed_units(queue_folder)
+            if not worked:
+                time.sleep(POLL_S)
+    finally:
+        worker.close()
+    print()
+
+    shutil.rmtree(queue_folder, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(queue_folder))
+    except OSError: # a newer queue of the stage has been made
+        pass
+    # return the results in the same order as the files were given
+    return {file: results[file] for file in files}
+
+"""
+write a new queue of the given files (replacing any earlier queue of the stage)
+
+    queue_folder: the folder of the new queue (see get_queue_folder)
+    queue_id: the random id of the new queue
+
+    returns: the number of work units
+"""
+def create_queue(queue_folder, queue_id, job, files, batch_files, read_ahead_filter=None):
+    shutil.rmtree(os.path.dirname(queue_folder), ignore_errors=True)
+    for sub_folder in ["units", "claims", "done", "failed"]:
+        os.makedirs(os.path.join(queue_folder, sub_folder), exist_ok=True)
+
+    units = ph.make_chunks(files, WORK_UNIT_BYTES, WORK_UNIT_MAX_FILES)
+    for unit_num, unit_files in enumerate(units):
+        write_json(get_unit_path(queue_folder, "units", get_unit_name(unit_num)), unit_files)
+    # written last, the queue is not worked on before it is complete
+    write_json(os.path.join(queue_folder, "queue.json"),
+               {"queue_id": queue_id, "module": get_job_module(job), "job": job.__name__,
+                "batch_files": batch_files,
+                "read_ahead_filter": read_ahead_filter and read_ahead_filter.__name__,
+                "num_units": len(units)})
+    return len(units)
+
+"""
+find the importable module name of the given job
+(a stage run as a script is "__main__" in this process)
+"""
+def get_job_module(job):
+    if job.__module__ != "__main__":
+        return job.__module__
+    return os.path.splitext(os.path.basename(sys.modules["__main__"].__file__))[0]
+
+"""
+raise the error of the first unit whose job failed (on any worker)
+"""
+def raise_failed_units(queue_folder):
+    for unit_name in sorted(list_unit_names(queue_folder, "failed")):
+        failure = read_json(get_unit_path(queue_folder, "failed", unit_name))
+        raise RuntimeError(f"Work unit {unit_name} failed on {failure['worker']}:\n{failure['error']}")
+
+
+
+
+#---------------------------------------#
+# WORKERS
+#---------------------------------------#
+
+"""
+work on the open queues until there are none left, e.g. on each host of the render farm
+
+    queue_names: the queues to work on (e.g. ["f2_mono_16khz"]), None for all of them
+"""
+def run_worker(queue_names=None):
+    worker = QueueWorker()
+    print(f"Worker {worker.worker_id} waiting for work in {fdef.WORK_QUEUE_FOLDER}")
+    idle_since = time.monotonic()
+    try:
+        while True:
+            queue_folders = [queue_folder for queue_folder in list_queue_folders()
+                             if queue_names is None or get_queue_stage_name(queue_folder) in queue_names]
+            worked = False
+            for queue_folder in queue_folders:
+                while worker.work_on_unit(queue_folder):
+                    worked = True
+            # a queue left behind by a killed coordinator has nothing left to do
+            if worked or not all(is_queue_finished(queue_folder) for queue_folder in queue_folders):
+                idle_since = time.monotonic()
+            elif time.monotonic() - idle_since > WORKER_IDLE_TIMEOUT_S:
+                break
+            if not worked:
+                time.sleep(POLL_S)
+    finally:
+        worker.close()
+    print(f"Worker {worker.worker_id} finished, {worker.units_done} work units done")
+
+"""
+A worker on the queues, claiming and running one unit at a time.
+The leases of its claims are renewed in a background thread.
+"""
+class QueueWorker:
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}_{os.getpid()}"
+        self.units_done = 0
+        # the lock files of the claims held
+        self.claims = set()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.lease_thread = threading.Thread(target=self.renew_leases, daemon=True)
+        self.lease_thread.start()
+
+    """
+    claim a unit of the given queue and run the job on it
+
+        returns: True if a unit was worked on, False if there was nothing to claim
+    """
+    def work_on_unit(self, queue_folder):
+        queue = read_json(os.path.join(queue_folder, "queue.json"))
+        if queue is None:
+            return False
+        claim = self.claim_unit(queue_folder, queue["num_units"])
+        if claim is None:
+            return False
+        unit_name, lock_path = claim
+        try:
+            files = read_json(get_unit_path(queue_folder, "units", unit_name))
+            # the queue was finished (and removed) by the coordinator
+            if files is None:
+                return True
+            try:
+                module = importlib.import_module(queue["module"])
+                read_ahead_filter = queue.get("read_ahead_filter")
+                results = ph.run_file_jobs(getattr(module, queue["job"]), files, batch_files=queue["batch_files"],
+                                           read_ahead_filter=read_ahead_filter and getattr(module, read_ahead_filter))
+            except Exception:
+                write_unit_marker(queue_folder, "failed", unit_name,
+                                  {"queue_id": queue["queue_id"], "worker": self.worker_id,
+                                   "error": traceback.format_exc()})
+                return True
+            # the first copy of the unit to finish is kept
+            write_unit_marker(queue_folder, "done", unit_name,
+                              {"queue_id": queue["queue_id"], "worker": self.worker_id, "results": results})
+            self.units_done += 1
+        finally:
+            self.release(lock_path)
+        return True
+
+    """
+    claim the first unit that is neither done nor claimed (taking over expired
+    claims), or failing that back up a straggling unit
+
+        returns: (unit name, lock file) of the claim, or None
+    """
+    def claim_unit(self, queue_folder, num_units):
+        open_units = [unit_name for unit_name in map(get_unit_name, range(num_units))
+                      if not is_unit_finished(queue_folder, unit_name)]
+        for unit_name in open_units:
+            lock_path = get_unit_path(queue_folder, "claims", unit_name, ".lock")
+            if self.try_claim(lock_path):
+                return unit_name, lock_path
+
+        # every unit is claimed, back up those that have been running the longest
+        for unit_name in open_units:
+            lock_path = get_unit_path(queue_folder, "claims", unit_name, ".lock")
+            claim = read_json(lock_path)
+            if (claim is None or claim["worker"] == self.worker_id
+                    or time.time() - claim["claimed_at"] < STRAGGLER_S):
+                continue
+            backup_path = get_unit_path(queue_folder, "claims", unit_name, ".backup.lock")
+            if self.try_claim(backup_path):
+                print(f"Backing up straggling work unit {unit_name} of {claim['worker']}")
+                return unit_name, backup_path
+        return None
+
+    """
+    try to create the given lock file (taking it over if its lease has expired)
+
+        returns: True if the claim was made
+    """
+    def try_claim(self, lock_path):
+        if is_lease_expired(lock_path):
+            # only one worker can move the expired lock out of the way
+            expired_path = f"{lock_path}.{self.worker_id}.expired"
+            try:
+                os.rename(lock_path, expired_path)
+                os.remove(expired_path)
+            except FileNotFoundError:
+                pass
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except (FileExistsError, FileNotFoundError): # claimed, or the queue was removed
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"worker": self.worker_id, "claimed_at": time.time()}, f)
+        with self.lock:
+            self.claims.add(lock_path)
+        return True
+
+    """
+    give up the given claim
+    """
+    def release(self, lock_path):
+        with self.lock:
+            self.claims.discard(lock_path)
+        claim = read_json(lock_path)
+        # the claim may have been taken over (if the lease expired)
+        if claim is not None and claim["worker"] == self.worker_id:
+            remove_file(lock_path)
+
+    """
+    renew the leases of the claims held, until the worker is closed
+    """
+    def renew_leases(self):
+        while not self.closing.wait(LEASE_RENEW_S):
+            with self.lock:
+                claims = list(self.claims)
+            for lock_path in claims:
+                try:
+                    os.utime(lock_path)
+                except FileNotFoundError:
+                    pass
+
+    """
+    stop renewing the leases
+    """
+    def close(self):
+        self.closing.set()
+        self.lease_thread.join()
+
+"""
+check if the lease of the given lock file has expired (False if there is no lock)
+"""
+def is_lease_expired(lock_path):
+    try:
+        return time.time() - os.path.getmtime(lock_path) > LEASE_EXPIRY_S
+    except FileNotFoundError:
+        return False
+
+"""
+check if every unit of the given queue is done (or has failed)
+"""
+def is_queue_finished(queue_folder):
+    queue = read_json(os.path.join(queue_folder, "queue.json"))
+    return queue is None or all(is_unit_finished(queue_folder, get_unit_name(unit_num))
+                                for unit_num in range(queue["num_units"]))
+
+"""
+check if the given unit is done, or has failed
+"""
+def is_unit_finished(queue_folder, unit_name):
+    return (os.path.exists(get_unit_path(queue_folder, "done", unit_name))
+            or os.path.exists(get_unit_path(queue_folder, "failed", unit_name)))
+
+"""
+write the done (or failed) marker of a unit, unless there already is one.
+The marker is written under a temporary name and then hardlinked into place,
+which fails if another worker got there first.
+"""
+def write_unit_marker(queue_folder, marker, unit_name, contents):
+    marker_path = get_unit_path(queue_folder, marker, unit_name)
+    temp_path = f"{marker_path}.{socket.gethostname()}_{os.getpid()}.tmp"
+    try:
+        write_json(temp_path, contents, replace=False)
+        os.link(temp_path, marker_path)
+    except (FileExistsError, FileNotFoundError): # done first elsewhere, or the queue was removed
+        pass
+    finally:
+        remove_file(temp_path)
+
+
+
+
+#---------------------------------------#
+# QUEUE FILE HELPERS
+#---------------------------------------#
+
+"""
+find the folder of the given queue of the stage
+"""
+def get_queue_folder(stage_name, queue_id):
+    return os.path.join(fdef.WORK_QUEUE_FOLDER, stage_name, queue_id)
+
+"""
+find the stage name of the given queue folder, e.g. "f2_mono_16khz"
+"""
+def get_queue_stage_name(queue_folder):
+    return os.path.basename(os.path.dirname(queue_folder))
+
+"""
+find the queue folders that are open (fully written)
+"""
+def list_queue_folders():
+    if not os.path.isdir(fdef.WORK_QUEUE_FOLDER):
+        return []
+    queue_folders = []
+    for stage_name in sorted(os.listdir(fdef.WORK_QUEUE_FOLDER)):
+        stage_folder = os.path.join(fdef.WORK_QUEUE_FOLDER, stage_name)
+        if not os.path.isdir(stage_folder):
+            continue
+        queue_folders.extend(os.path.join(stage_folder, queue_id) for queue_id in sorted(os.listdir(stage_folder))
+                             if os.path.exists(os.path.join(stage_folder, queue_id, "queue.json")))
+    return queue_folders
+
+"""
+get the name of the given unit, e.g. "unit_00000"
+"""
+def get_unit_name(unit_num):
+    return f"unit_{unit_num:05}"
+
+"""
+find the path of a unit file within the given sub folder of the queue
+"""
+def get_unit_path(queue_folder, sub_folder, unit_name, suffix=".json"):
+    return os.path.join(queue_folder, sub_folder, f"{unit_name}{suffix}")
+
+"""
+list the units with a file in the given sub folder of the queue
+"""
+def list_unit_names(queue_folder, sub_folder):
+    try:
+        return [os.path.splitext(file)[0] for file in os.listdir(os.path.join(queue_folder, sub_folder))
+                if file.endswith(".json")]
+    except FileNotFoundError:
+        return []
+
+"""
+read the given json file
+
+    returns: the contents, or None if the file is not there (or still being written)
+"""
+def read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+"""
+write the given json file, by default to a temporary name that is then renamed into place
+"""
+def write_json(path, contents, replace=True):
+    temp_path = f"{path}.tmp" if replace else path
+    with open(temp_path, 'w') as f:
+        json.dump(contents, f)
+    if replace:
+        os.replace(temp_path, path)
+
+"""
+remove the given file if it is there
+"""
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,268 @@
+"""
+Write-behind of the stage output files.
+
+Within a background_writes() block the output files are handed to a small
+pool of i/o threads and the stage carries on with the next file, rather than
+waiting on each write (which is most of the time on network storage):
+
+    with wh.background_writes():
+        ...
+        wh.write_file(path, [header, samples])
+
+Each file is written to a temporary name next to it and then renamed into
+place, so a file is either complete or not there at all. The folders that
+have been made are remembered, so each is only made once. When the queued
+files reach WRITE_QUEUE_MAX_BYTES (or WRITE_QUEUE_MAX_FILES) the stage waits
+for the writes to catch up, so the memory held by the queue stays bounded.
+
+Outside of a background_writes() block (or with WRITE_BEHIND off) the files
+are written straight away, in the same way.
+"""
+# Internal helpers and definitions
+import h_FOLDER_DEFINITIONS as fdef
+# folder navigation modules
+import os
+# modules used for writing in the background
+from contextlib import contextmanager
+from collections import deque
+import threading
+
+
+
+#---------------------------------------#
+# CONSTANT DEFINITIONS
+#---------------------------------------#
+# the suffix of the temporary files (while they are being written),
+# these are skipped when listing the files of a folder
+TEMP_FILE_SUFFIX = ".writing"
+# the max fraction of the free memory the queued files may take up
+MAX_FREE_MEMORY_FRACTION = 0.25
+#---------------------------------------#
+
+#---------------------------------------#
+# GOBAL VARIABLE TRACKERS
+#---------------------------------------#
+# the background writer of the current background_writes() block (if any)
+active_writer = None
+# the folders that have already been made
+made_folders = set()
+#---------------------------------------#
+
+
+
+
+#---------------------------------------#
+# WRITING THE FILES
+#---------------------------------------#
+
+"""
+write the given file, in the background if within a background_writes() block.
+The buffers must not be changed after they are handed over.
+
+    path: the path to write the file to
+    buffers: a list of bytes like objects (e.g. the header and the samples)
+             that are written one after the other
+"""
+def write_file(path, buffers):
+    if active_writer is not None:
+        active_writer.submit(path, buffers)
+    else:
+        write_file_now(path, buffers)
+
+"""
+write the given file now, to a temporary name that is then renamed into place
+"""
+def write_file_now(path, buffers):
+    make_folder(os.path.dirname(path))
+    temp_path = get_temp_path(path)
+    try:
+        with open(temp_path, 'wb') as f:
+            for buffer in buffers:
+                f.write(buffer)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+"""
+get the temporary name a file is written to before it is renamed into place
+(unique to the process and thread writing it)
+"""
+def get_temp_path(path):
+    return f"{path}.{os.getpid()}_{threading.get_ident()}{TEMP_FILE_SUFFIX}"
+
+"""
+remove the temporary files left within the given folder by a run that was killed
+(only call this when no other run is writing to the folder)
+
+    returns: the number of files removed
+"""
+def remove_temp_files(folder):
+    num_removed = 0
+    for root, _, files in os.walk(folder):
+        for file in files:
+            if file.endswith(TEMP_FILE_SUFFIX):
+                os.remove(os.path.join(root, file))
+                num_removed += 1
+    return num_removed
+
+"""
+make the given folder (and its parents) if it has not already been made
+"""
+def make_folder(folder):
+    if folder and folder not in made_folders:
+        os.makedirs(folder, exist_ok=True)
+        made_folders.add(folder)
+
+"""
+wait for all the files handed over so far to be written
+(e.g. before a file that was just saved is graphed)
+"""
+def wait_for_writes():
+    if active_writer is not None:
+        active_writer.flush()
+
+"""
+write the files in the background for the duration of the block. All the
+files are written (or the first write error is raised) by the end of the block.
+"""
+@contextmanager
+def background_writes():
+    global active_writer
+    # already writing in the background (or turned off)
+    if active_writer is not None or not fdef.WRITE_BEHIND:
+        yield
+        return
+
+    active_writer = BackgroundWriter()
+    try:
+        yield
+    except BaseException:
+        # still finish the writes that were handed over, but keep the original error
+        try:
+            active_writer.close()
+        except Exception:
+            pass
+        raise
+    else:
+        active_writer.close()
+    finally:
+        active_writer = None
+
+
+
+
+#---------------------------------------#
+# BACKGROUND WRITER
+#---------------------------------------#
+
+"""
+A pool of i/o threads writing the files handed to it, with a bounded queue.
+The first write error is raised by the next submit, flush or close.
+
+    num_threads: the number of i/o threads, None uses fdef.WRITER_THREADS
+    max_bytes: the max bytes of queued files, None uses fdef.WRITE_QUEUE_MAX_BYTES
+               (kept below MAX_FREE_MEMORY_FRACTION of the free memory)
+    max_files: the max number of queued files, None uses fdef.WRITE_QUEUE_MAX_FILES
+"""
+class BackgroundWriter:
+    def __init__(self, num_threads=None, max_bytes=None, max_files=None):
+        self.max_bytes = min(max_bytes or fdef.WRITE_QUEUE_MAX_BYTES, get_free_memory_budget())
+        self.max_files = max_files or fdef.WRITE_QUEUE_MAX_FILES
+        # the files waiting to be written, [path, buffers, size]
+        self.pending = deque()
+        # the bytes of the files that are queued or being written
+        self.queued_bytes = 0
+        self.num_writing = 0
+        self.error = None
+        self.closing = False
+        self.condition = threading.Condition()
+
+        self.threads = [threading.Thread(target=self.run_thread, daemon=True)
+                        for _ in range(num_threads or fdef.WRITER_THREADS)]
+        for thread in self.threads:
+            thread.start()
+
+    """
+    hand over a file to be written, waiting first if the queue is full
+    """
+    def submit(self, path, buffers):
+        size = sum(memoryview(buffer).nbytes for buffer in buffers)
+        with self.condition:
+            self.raise_error()
+            # backpressure, a file that is larger than the whole queue still goes when the queue is empty
+            while self.queued_bytes and (self.queued_bytes + size > self.max_bytes
+                                         or len(self.pending) + self.num_writing >= self.max_files):
+                self.condition.wait()
+                self.raise_error()
+            self.pending.append((path, buffers, size))
+            self.queued_bytes += size
+            self.condition.notify_all()
+
+    """
+    wait for all the files handed over so far to be written
+    """
+    def flush(self):
+        with self.condition:
+            while self.pending or self.num_writing:
+                self.condition.wait()
+            self.raise_error()
+
+    """
+    write the remaining files and stop the i/o threads
+    """
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self.condition:
+                self.closing = True
+                self.condition.notify_all()
+            for thread in self.threads:
+                thread.join()
+
+    """
+    raise the first write error (if any), the condition must be held
+    """
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    """
+    the loop of each i/o thread, write the next pending file until closed
+    """
+    def run_thread(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                path, buffers, size = self.pending.popleft()
+                self.num_writing += 1
+
+            try:
+                write_file_now(path, buffers)
+            except BaseException as error:
+                with self.condition:
+                    if self.error is None:
+                        self.error = error
+            finally:
+                with self.condition:
+                    self.queued_bytes -= size
+                    self.num_writing -= 1
+                    self.condition.notify_all()
+
+"""
+find the most memory the queued files may take up, a fraction of the free memory
+
+    returns: the bytes, or the WRITE_QUEUE_MAX_BYTES if the free memory is not known
+"""
+def get_free_memory_budget():
+    try:
+        free_bytes = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return fdef.WRITE_QUEUE_MAX_BYTES
+    return int(free_bytes * MAX_FREE_MEMORY_FRACTION)